@@ -0,0 +1,538 @@
+"""
+Database - the data access layer for the invoice process.
+Every query in the process is written for MySQL and runs through a connection from one of the
+backends below, which share the same small part of the mysql.connector connection API that the
+process uses: cursor(), commit(), close(), connection_id and unread_result.
+The MySQL backend hands out real MySQL connections. The SQLite backend keeps the whole database
+in a local file, and translates each query into SQLite's dialect on the way through, so smaller
+sub accounts can be invoiced without a database server and the process can be benchmarked offline.
+SQLite has no exact decimal type, and would add up and multiply amounts in floating point, so the
+sums in each query are worked out with Decimals instead, the same as MySQL would, see
+translate_sqlite.
+"""
+
+import operator
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from datetime import date
+from decimal import Decimal
+from functools import lru_cache
+
+import mysql.connector
+from mysql.connector import pooling
+
+# SQLite has no decimal type, so Decimals are stored as text and read back as numbers
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_adapter(date, date.isoformat)
+
+
+class MySQLBackend:
+    """
+    Hands out connections to a MySQL database, from a connection pool that is created when the
+    first connection is asked for.
+    """
+
+    def __init__(self, database, user, password, host, pool_size=5, health_check=True):
+        """
+        Initialise class
+        :param database: The name of the database.
+        :param user: MySQL user name.
+        :param password: MySQL password.
+        :param host: MySQL host.
+        :param pool_size: The number of connections in the pool. None opens a plain connection
+        each time instead, which scripts that only need one connection can use.
+        :param health_check: Whether pooled connections are pinged before they are handed out.
+        """
+        self.database = database
+        self.user = user
+        self.password = password
+        self.host = host
+        self.pool_size = pool_size
+        self.health_check = health_check
+
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """
+        Called when the backend is pickled to be sent to a worker process.
+        The connection pool and lock cannot be sent, so the worker will create its own.
+        :return: Dictionary of the instance attributes
+        """
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        """
+        Called when the backend is unpickled in a worker process. Recreates the lock that was
+        left out by __getstate__.
+        :param state: Dictionary of the instance attributes
+        :return: None
+        """
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """
+        Retrieves a connection from the connection pool, creating the pool first if this is the
+        first time a connection has been asked for. If health checks are turned on, the
+        connection is pinged before it is handed out and will be reconnected if the server has
+        dropped it.
+        :return: A MySQL connection. Calling close on a pooled one will return it to the pool.
+        """
+        if self.pool_size is None:
+            return mysql.connector.connect(user=self.user, password=self.password,
+                                           host=self.host, database=self.database)
+
+        with self._lock:
+            if self._pool is None:
+                self._pool = pooling.MySQLConnectionPool(pool_name='invoice_creation',
+                                                         pool_size=self.pool_size,
+                                                         user=self.user, password=self.password,
+                                                         host=self.host, database=self.database)
+
+        cnx = self._pool.get_connection()
+
+        if self.health_check:
+            cnx.ping(reconnect=True, attempts=3, delay=1)
+
+        return cnx
+
+
+class SQLiteBackend:
+    """
+    Hands out connections to a SQLite database file. A new connection is opened each time, as
+    they are cheap to open and cannot be shared between threads.
+    """
+
+    def __init__(self, database):
+        """
+        Initialise class
+        :param database: The SQLite database file. Can include path.
+        """
+        self.database = database
+        self._connection_count = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """
+        Called when the backend is pickled to be sent to a worker process.
+        :return: Dictionary of the instance attributes
+        """
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        """
+        Called when the backend is unpickled in a worker process.
+        :param state: Dictionary of the instance attributes
+        :return: None
+        """
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def connect(self):
+        """
+        Opens a connection to the database file, with the MySQL functions the queries use
+        added to it.
+        :return: SQLiteConnection
+        """
+        cnx = sqlite3.connect(self.database, timeout=30)
+        cnx.create_function('CRC32', 1, _crc32, deterministic=True)
+        cnx.create_function('CONCAT_WS', -1, _concat_ws, deterministic=True)
+        cnx.create_function('DECIMAL_ADD', 2, _decimal_add, deterministic=True)
+        cnx.create_function('DECIMAL_SUBTRACT', 2, _decimal_subtract, deterministic=True)
+        cnx.create_function('DECIMAL_MULTIPLY', 2, _decimal_multiply, deterministic=True)
+        cnx.create_aggregate('DECIMAL_SUM', 1, DecimalSum)
+        cnx.execute('PRAGMA foreign_keys = ON;')
+
+        # The process id is part of the id, as each worker process counts its connections from
+        # 1 and the ids of every process are put together at the end of the run
+        with self._lock:
+            self._connection_count += 1
+            connection_id = (os.getpid(), self._connection_count)
+
+        return SQLiteConnection(cnx, connection_id)
+
+
+class SQLiteConnection:
+    """
+    Wraps a sqlite3 connection so it can be used in the same way as a MySQL connection.
+    """
+
+    # MySQL needs unread rows to be read off before a connection is reused, SQLite does not
+    unread_result = False
+
+    def __init__(self, cnx, connection_id):
+        """
+        Initialise class
+        :param cnx: sqlite3 Connection.
+        :param connection_id: Identifies the connection, like MySQL's connection ids. Unique
+        across processes.
+        """
+        self._cnx = cnx
+        self.connection_id = connection_id
+
+    def cursor(self, **kwargs):
+        """
+        Creates a cursor. Any MySQL cursor options, such as buffered, are ignored.
+        :return: SQLiteCursor
+        """
+        return SQLiteCursor(self._cnx.cursor())
+
+    def commit(self):
+        self._cnx.commit()
+
+    def rollback(self):
+        self._cnx.rollback()
+
+    def consume_results(self):
+        pass
+
+    def close(self):
+        self._cnx.close()
+
+
+class SQLiteCursor:
+    """
+    Wraps a sqlite3 cursor so that MySQL queries can be run through it. Each query is
+    translated into SQLite's dialect, and numbers with decimal places come back as Decimals,
+    as they would from MySQL.
+    """
+
+    def __init__(self, cursor):
+        """
+        Initialise class
+        :param cursor: sqlite3 Cursor.
+        """
+        self._cursor = cursor
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def execute(self, sql, params=()):
+        self._cursor.execute(translate_sqlite(sql), params)
+
+    def executemany(self, sql, seq_of_params):
+        self._cursor.executemany(translate_sqlite(sql), seq_of_params)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        return None if row is None else _convert_row(row)
+
+    def fetchmany(self, size):
+        return [_convert_row(row) for row in self._cursor.fetchmany(size)]
+
+    def fetchall(self):
+        return [_convert_row(row) for row in self._cursor.fetchall()]
+
+    def close(self):
+        self._cursor.close()
+
+
+@lru_cache(maxsize=256)
+def translate_sqlite(sql):
+    """
+    Translates a query written for MySQL into SQLite's dialect. Only covers what the queries
+    in this process use:
+        Placeholders: %(name)s becomes :name and %s becomes ?
+        Upserts: ON DUPLICATE KEY UPDATE becomes ON CONFLICT DO UPDATE SET, with VALUES(column)
+        becoming excluded.column
+        Tables: INT AUTO_INCREMENT PRIMARY KEY becomes INTEGER PRIMARY KEY, and
+        ALTER TABLE ... ADD INDEX becomes CREATE INDEX
+        Sums: SUM becomes DECIMAL_SUM, and any +, - or * in what is being summed becomes
+        DECIMAL_ADD, DECIMAL_SUBTRACT or DECIMAL_MULTIPLY, see decimal_sums
+    CRC32, CONCAT_WS and the decimal functions are added to each connection as functions rather
+    than translated.
+    :param sql: MySQL query string.
+    :return: SQLite query string.
+    """
+    sql = re.sub(r'%\((\w+)\)s', r':\1', sql)
+    sql = sql.replace('%s', '?').replace('%%', '%')
+
+    if 'ON DUPLICATE KEY UPDATE' in sql:
+        sql = sql.replace('ON DUPLICATE KEY UPDATE', 'ON CONFLICT DO UPDATE SET')
+        sql = re.sub(r'VALUES\((\w+)\)', r'excluded.\1', sql)
+
+    sql = re.sub(r'\bINT AUTO_INCREMENT PRIMARY KEY', 'INTEGER PRIMARY KEY', sql)
+    sql = re.sub(r'ALTER TABLE (\w+)\s+ADD INDEX (\w+)\s*\(', r'CREATE INDEX \2 ON \1 (', sql)
+
+    return decimal_sums(sql)
+
+
+# The parts of an expression: a quoted string, a name or number, or a single character
+_token_pattern = re.compile(r"\s*('(?:[^']|'')*'|[\w.]+|\S)")
+
+# The decimal function each arithmetic operator becomes
+_decimal_operators = {'+': 'DECIMAL_ADD', '-': 'DECIMAL_SUBTRACT', '*': 'DECIMAL_MULTIPLY'}
+
+
+def decimal_sums(sql):
+    """
+    Swaps each SUM in a query for DECIMAL_SUM, and the arithmetic inside it for the decimal
+    functions, so that MySQL's exact DECIMAL arithmetic is done in SQLite as well. SQLite keeps
+    the DECIMAL columns as floating point numbers, which are only ever near the amounts, so a
+    rate of 0.0740 times 7.5000 kg comes to 0.55499999..., which rounds to 0.55 rather than the
+    0.56 MySQL gives. The decimal functions read each number as the Decimal it was stored as and
+    work out the result exactly.
+    Only arithmetic inside a SUM is swapped, which is all the queries in this process do.
+    :param sql: SQLite query string.
+    :return: SQLite query string.
+    """
+    parts = []
+    end = 0
+
+    for match in re.finditer(r'\bSUM\(', sql):
+        if match.start() < end:
+            continue
+
+        tokens = [token for token in _token_pattern.findall(sql, match.end())]
+        expression, used = _decimal_expression(tokens, 0)
+
+        if tokens[used:used + 1] != [')']:
+            raise ValueError('Could not translate the sum in {} for SQLite.'.format(sql))
+
+        # Finding where the sum's closing bracket is in the query
+        closing = match.end()
+        for token in tokens[:used + 1]:
+            closing = sql.index(token, closing) + len(token)
+
+        parts.append(sql[end:match.start()])
+        parts.append('DECIMAL_SUM({})'.format(expression))
+        end = closing
+
+    parts.append(sql[end:])
+
+    return ''.join(parts)
+
+
+def _decimal_expression(tokens, start):
+    """
+    Reads an expression of sums and differences from a list of tokens, with each +, - or *
+    swapped for its decimal function, see decimal_sums.
+    :param tokens: List of token strings.
+    :param start: Where the expression starts in the list.
+    :return: Tuple of the translated expression and where it ends in the list.
+    """
+    expression, start = _decimal_term(tokens, start)
+
+    while tokens[start:start + 1] in (['+'], ['-']):
+        right, end = _decimal_term(tokens, start + 1)
+        expression = '{}({}, {})'.format(_decimal_operators[tokens[start]], expression, right)
+        start = end
+
+    return expression, start
+
+
+def _decimal_term(tokens, start):
+    """
+    Reads a product from a list of tokens, see _decimal_expression.
+    :param tokens: List of token strings.
+    :param start: Where the product starts in the list.
+    :return: Tuple of the translated product and where it ends in the list.
+    """
+    expression, start = _decimal_value(tokens, start)
+
+    while tokens[start:start + 1] == ['*']:
+        right, end = _decimal_value(tokens, start + 1)
+        expression = 'DECIMAL_MULTIPLY({}, {})'.format(expression, right)
+        start = end
+
+    return expression, start
+
+
+def _decimal_value(tokens, start):
+    """
+    Reads a single value from a list of tokens, which is a name, number or string, a function
+    call, a bracketed expression or a negated value, see _decimal_expression.
+    :param tokens: List of token strings.
+    :param start: Where the value starts in the list.
+    :return: Tuple of the translated value and where it ends in the list.
+    """
+    if start >= len(tokens):
+        raise ValueError('Unexpected end of a sum.')
+
+    token = tokens[start]
+
+    if token == '-':
+        expression, end = _decimal_value(tokens, start + 1)
+        return '-' + expression, end
+
+    if token == '(':
+        expression, end = _decimal_expression(tokens, start + 1)
+        if tokens[end:end + 1] != [')']:
+            raise ValueError('Unclosed bracket in a sum.')
+        return expression, end + 1
+
+    if not re.match(r"[\w.']", token):
+        raise ValueError('Unexpected {} in a sum.'.format(token))
+
+    # A function call, whose arguments are translated as well
+    if tokens[start + 1:start + 2] == ['(']:
+        arguments = []
+        end = start + 2
+
+        while tokens[end:end + 1] != [')']:
+            argument, end = _decimal_expression(tokens, end)
+            arguments.append(argument)
+            if tokens[end:end + 1] == [',']:
+                end += 1
+
+        return '{}({})'.format(token, ', '.join(arguments)), end + 1
+
+    return token, start + 1
+
+
+def _convert_row(row):
+    """
+    Turns the floating point numbers SQLite keeps numbers with decimal places in back into
+    Decimals. See _to_decimal.
+    :param row: Tuple of values.
+    :return: Tuple of values.
+    """
+    return tuple([_to_decimal(value) if isinstance(value, float) else value for value in row])
+
+
+def _to_decimal(value):
+    """
+    Reads a number from SQLite as the Decimal it stands for.
+    A floating point number is only ever near the decimal number it was made from, but the
+    shortest way of writing it that reads back as the same float is always that decimal number,
+    as long as it has no more than 15 significant figures. That covers every DECIMAL column in
+    the database, and every sum of them that is less than ten million with the 8 decimal places
+    of a rate times a weight.
+    :param value: Integer, float, string or None.
+    :return: Decimal, or None.
+    """
+    if value is None:
+        return None
+
+    if isinstance(value, float):
+        return Decimal(repr(value))
+
+    return Decimal(value)
+
+
+def _from_decimal(value, whole):
+    """
+    Hands the result of a decimal function back to SQLite, which has no decimal type.
+    :param value: Decimal, or None.
+    :param whole: Whether every number it was worked out from was an integer, in which case it
+    is handed back as an integer, as SQLite's own arithmetic would.
+    :return: Integer, float or None.
+    """
+    if value is None:
+        return None
+
+    return int(value) if whole else float(value)
+
+
+def _decimal_function(operation):
+    """
+    Makes one of the decimal arithmetic functions for SQLite, see decimal_sums. Like SQL's own
+    arithmetic, the result is NULL if either number is.
+    :param operation: Function of two Decimals, such as operator.add.
+    :return: Function of two SQLite numbers.
+    """
+    def function(left, right):
+        if left is None or right is None:
+            return None
+
+        return _from_decimal(operation(_to_decimal(left), _to_decimal(right)),
+                             isinstance(left, int) and isinstance(right, int))
+
+    return function
+
+
+_decimal_add = _decimal_function(operator.add)
+_decimal_subtract = _decimal_function(operator.sub)
+_decimal_multiply = _decimal_function(operator.mul)
+
+
+class DecimalSum:
+    """
+    MySQL's SUM of exact decimals, as an aggregate function for SQLite, see decimal_sums.
+    Like SUM, it is NULL if there are no numbers to add up.
+    """
+
+    def __init__(self):
+        """
+        Initialise class
+        """
+        self.total = None
+        self.whole = True
+
+    def step(self, value):
+        """
+        Adds on the next number.
+        :param value: Integer, float, string or None, which is skipped.
+        :return: None
+        """
+        if value is None:
+            return
+
+        self.whole = self.whole and isinstance(value, int)
+        self.total = _to_decimal(value) if self.total is None else \
+            self.total + _to_decimal(value)
+
+    def finalize(self):
+        """
+        Hands the total back to SQLite.
+        :return: Integer, float or None.
+        """
+        return _from_decimal(self.total, self.whole)
+
+
+def _crc32(value):
+    """
+    MySQL's CRC32 function, for SQLite.
+    :param value: Any value, or None.
+    :return: Integer, or None.
+    """
+    if value is None:
+        return None
+    return zlib.crc32(str(value).encode())
+
+
+def _concat_ws(separator, *values):
+    """
+    MySQL's CONCAT_WS function, for SQLite. Skips None values like MySQL does.
+    :param separator: String to put between the values.
+    :param values: Any values.
+    :return: String
+    """
+    return str(separator).join([str(value) for value in values if value is not None])
+
+
+# The backends that can be chosen with the database_backend setting
+backends = {'mysql': MySQLBackend, 'sqlite': SQLiteBackend}
+
+
+def create_backend(backend, database, user=None, password=None, host=None, pool_size=5,
+                   health_check=True):
+    """
+    Creates one of the backends.
+    :param backend: 'mysql' or 'sqlite'.
+    :param database: The MySQL database name, or the SQLite database file.
+    :param user: MySQL user name. Not used by SQLite.
+    :param password: MySQL password. Not used by SQLite.
+    :param host: MySQL host. Not used by SQLite.
+    :param pool_size: MySQL connection pool size, see MySQLBackend. Not used by SQLite.
+    :param health_check: Whether MySQL connections are pinged. Not used by SQLite.
+    :return: MySQLBackend or SQLiteBackend
+    """
+    if backend == 'sqlite':
+        return SQLiteBackend(database)
+
+    if backend == 'mysql':
+        return MySQLBackend(database, user, password, host, pool_size, health_check)
+
+    raise ValueError('Unknown database backend {}, expected one of {}.'
+                     .format(backend, ', '.join(backends)))
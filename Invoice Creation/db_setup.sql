@@ -1,6 +1,8 @@
-DROP TABLE IF EXISTS address_data;
-DROP TABLE IF EXISTS rates_data;
+DROP TABLE IF EXISTS schema_migrations;
+DROP TABLE IF EXISTS sales_quarter_summary;
 DROP TABLE IF EXISTS sales_data;
+DROP TABLE IF EXISTS rates_data;
+DROP TABLE IF EXISTS address_data;
 
 CREATE TABLE address_data (
     Country_Code CHAR(2) PRIMARY KEY,
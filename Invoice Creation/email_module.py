@@ -9,58 +9,84 @@ from email.mime.base import MIMEBase
 from email import encoders
 import os.path
 import datetime
+from contextlib import nullcontext
 
 
 def send_email_365(email_recipient, email_subject, email_message,
-                   email_sender, email_password, attachments=tuple()):
+                   email_sender, email_password, attachments=tuple(), timer=None,
+                   smtp_host='smtp.office365.com', smtp_port=587, smtp_tls=True):
     """
-    Function to send emails using office 365
+    Function to send emails using office 365, or another SMTP server if one is given
     :param email_recipient: string for who will receive the email.
     For multiple recipients combine them with spaces and commas.
     :param email_subject: string subject
     :param email_message: string message
     :param email_sender: string email address
     :param email_password: string password
-    :param attachments: tuple containing string file names
+    :param attachments: tuple containing string file names, or tuples of a file name and the
+    bytes of the file, which are attached straight from memory without the file being read
+    :param timer: optional function that takes a step name ('mime build' or 'smtp send') and
+    returns a context manager to time that step with, such as RunTimer.time in run_timings.py
+    :param smtp_host: string host name of the SMTP server
+    :param smtp_port: integer port of the SMTP server
+    :param smtp_tls: boolean of whether to switch to TLS and log in before sending. Turn this off
+    for a local server that accepts mail without logging in, such as the one in smtp_sink.py
     :return: Will return a tuple containing two elements. The first element will be a boolean value
     of whether the email was sent successfully or not. The second element will be a
     string of what happened with timestamp.
     """
 
+    if timer is None:
+        def timer(step):
+            return nullcontext()
+
+    # The file names of the attachments, for the status message
+    attachment_names = tuple([item[0] if isinstance(item, tuple) else item
+                              for item in attachments])
+
     # Creating timestamp
     time_zone = datetime.datetime.now().astimezone().tzinfo
     current_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     time_stamp = '{} {}'.format(current_time, time_zone)
 
     # Creating email
-    msg = MIMEMultipart()
-    msg['From'] = email_sender
-    msg['To'] = email_recipient
-    msg['Subject'] = email_subject
-    msg.attach(MIMEText(email_message))
+    with timer('mime build'):
+        msg = MIMEMultipart()
+        msg['From'] = email_sender
+        msg['To'] = email_recipient
+        msg['Subject'] = email_subject
+        msg.attach(MIMEText(email_message))
 
-    # Adding attachments
-    try:
-        for item in attachments:
-            part = MIMEBase('application', "octet-stream")
-            with open(item, 'rb') as file:
-                part.set_payload(file.read())
-            encoders.encode_base64(part)
-            part.add_header('Content-Disposition',
-                            'attachment; filename="{}"'.format(os.path.basename(item)))
-            msg.attach(part)
+        # Adding attachments
+        try:
+            for item in attachments:
+                part = MIMEBase('application', "octet-stream")
+                if isinstance(item, tuple):
+                    item, data = item
+                    part.set_payload(data)
+                else:
+                    with open(item, 'rb') as file:
+                        part.set_payload(file.read())
+                encoders.encode_base64(part)
+                part.add_header('Content-Disposition',
+                                'attachment; filename="{}"'.format(os.path.basename(item)))
+                msg.attach(part)
 
-    except Exception as err:
-        return (False, '{}\nUnable to add attachments {} to email.\n'
-                'Error Description: {}.\n'.format(time_stamp, attachments, err))
+        except Exception as err:
+            return (False, '{}\nUnable to add attachments {} to email.\n'
+                    'Error Description: {}.\n'.format(time_stamp, attachment_names, err))
+
+        msg_text = msg.as_string()
 
     # Connecting to server and sending our email
     try:
-        server = smtplib.SMTP('smtp.office365.com', 587)
-        server.starttls()
-        server.login(email_sender, email_password)
-        server.sendmail(email_sender, email_recipient, msg.as_string())
-        server.quit()
+        with timer('smtp send'):
+            server = smtplib.SMTP(smtp_host, smtp_port)
+            if smtp_tls:
+                server.starttls()
+                server.login(email_sender, email_password)
+            server.sendmail(email_sender, email_recipient, msg_text)
+            server.quit()
 
     except Exception as err:
         return (False, '{}\nUnable to send email to {}.\n'
@@ -69,4 +95,4 @@ def send_email_365(email_recipient, email_subject, email_message,
     # Confirming if successful
     else:
         return (True, '{}\nEmail sent successfully to recipient {} with attachments {}.\n'
-                .format(time_stamp, email_recipient, attachments))
+                .format(time_stamp, email_recipient, attachment_names))
@@ -0,0 +1,215 @@
+"""
+Index Benchmark - measures what the migrations do for the invoice queries.
+For each table size asked for, the tables are recreated from db_setup.sql in a separate benchmark
+database and filled with synthetic data. Every invoice query is then explained and timed, both
+for single customers and for the whole quarter at once, before and after the migrations are
+applied.
+
+Usage:
+    python index_benchmark.py --database billings_benchmark --rows 1000000 10000000
+
+The benchmark database is wiped, so it must not be the one the real data is kept in.
+"""
+
+import argparse
+import os
+import shelve
+import statistics
+import time
+
+import migrate
+import synthetic_data
+from invoice_creation import Customer, Params
+
+setup_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db_setup.sql')
+
+
+def explain(cnx, sql, param_dict):
+    """
+    Runs EXPLAIN for a query.
+    :param cnx: MySQL connection.
+    :param sql: The query.
+    :param param_dict: The query parameters.
+    :return: List of strings, one for each table the plan reads.
+    """
+    cursor = cnx.cursor(dictionary=True)
+    cursor.execute('EXPLAIN ' + sql, param_dict)
+    plan = ['{:<6} type={:<7} key={:<26} rows={:<10} {}'
+            .format(str(row['table']), str(row['type']), str(row['key']), str(row['rows']),
+                    row['Extra'] or '')
+            for row in cursor.fetchall()]
+    cursor.close()
+    return plan
+
+
+def time_query(cnx, sql, param_dict):
+    """
+    Runs a query and fetches every row.
+    :param cnx: MySQL connection.
+    :param sql: The query.
+    :param param_dict: The query parameters.
+    :return: Seconds taken.
+    """
+    cursor = cnx.cursor()
+    start = time.perf_counter()
+    cursor.execute(sql, param_dict)
+    cursor.fetchall()
+    finish = time.perf_counter()
+    cursor.close()
+    return finish - start
+
+
+def measure(cnx, param_dict, customers, repeat):
+    """
+    Explains and times each of the invoice queries.
+    :param cnx: MySQL connection.
+    :param param_dict: Dictionary with the year, sub_account and qtr to query.
+    :param customers: The Country_Codes to time the single customer queries with.
+    :param repeat: How many times to run each query for each customer.
+    :return: Dictionary of query names to a dictionary of results.
+    """
+    results = {}
+
+    for name in Customer.query_names:
+        customer_sql = getattr(Customer, name + '_sql').format(
+            customer_filter=Params.customer_filter)
+        quarter_sql = getattr(Customer, name + '_sql').format(customer_filter='')
+
+        single = []
+        for customer in customers:
+            customer_dict = dict(param_dict, customer=customer)
+            single += [time_query(cnx, customer_sql, customer_dict) for _ in range(repeat)]
+
+        results[name] = {'plan': explain(cnx, customer_sql,
+                                         dict(param_dict, customer=customers[0])),
+                         'single_median': statistics.median(single),
+                         'single_max': max(single),
+                         'quarter': min([time_query(cnx, quarter_sql, param_dict)
+                                         for _ in range(repeat)])}
+
+    return results
+
+
+def analyze(cnx):
+    """
+    Refreshes the table statistics so the query planner knows about the new rows and indexes.
+    :param cnx: MySQL connection.
+    :return: None
+    """
+    cursor = cnx.cursor()
+    cursor.execute('ANALYZE TABLE sales_data, rates_data, address_data;')
+    cursor.fetchall()
+    cursor.close()
+
+
+def report_size(rows, seconds, before, after, report):
+    """
+    Prints the results for one table size.
+    :param rows: Number of sales rows.
+    :param seconds: Dictionary of how long seeding and migrating took.
+    :param before: Results of the measure function without the indexes.
+    :param after: Results of the measure function with the indexes.
+    :param report: Open file to print to.
+    :return: None
+    """
+    print('=' * 100, file=report)
+    print('{:,} SALES ROWS (seeded in {:.0f}s, migrated in {:.0f}s)'
+          .format(rows, seconds['seed'], seconds['migrate']), file=report)
+    print('=' * 100, file=report)
+
+    for name in Customer.query_names:
+        print('\n{}'.format(name), file=report)
+        for label, results in (('Before', before), ('After', after)):
+            print('  {}: one customer median {:.1f}ms, max {:.1f}ms. Whole quarter {:.1f}ms.'
+                  .format(label, results[name]['single_median'] * 1000,
+                          results[name]['single_max'] * 1000,
+                          results[name]['quarter'] * 1000), file=report)
+            for line in results[name]['plan']:
+                print('    ' + line, file=report)
+
+        print('  Speed up: one customer {:.1f}x, whole quarter {:.1f}x.'
+              .format(before[name]['single_median'] / max(after[name]['single_median'], 1e-9),
+                      before[name]['quarter'] / max(after[name]['quarter'], 1e-9)),
+              file=report)
+
+    print('', file=report)
+
+
+def parse_args(argv=None):
+    """
+    Reads the command line options.
+    :param argv: List of command line arguments. Defaults to sys.argv.
+    :return: argparse Namespace
+    """
+    parser = argparse.ArgumentParser(description='Benchmarks the invoice queries before and '
+                                                 'after the schema migrations.')
+    parser.add_argument('--database', required=True,
+                        help='Database to run the benchmark in. It is wiped and recreated.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000000, 10000000],
+                        help='Numbers of sales rows to benchmark with.')
+    parser.add_argument('--customers', type=int, default=50,
+                        help='Number of customers to spread the sales rows across.')
+    parser.add_argument('--sample', type=int, default=5,
+                        help='Number of customers to time the single customer queries with.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='How many times to run each query.')
+    parser.add_argument('--report', help='File to write the report to as well as the screen.')
+    args = parser.parse_args(argv)
+
+    with shelve.open('params') as data_base:
+        if args.database == data_base['database_name']:
+            parser.error('the benchmark database must not be the one in the params shelve')
+
+    return args
+
+
+def main(argv=None):
+    """
+    Runs the benchmark for each table size.
+    :param argv: List of command line arguments. Defaults to sys.argv.
+    :return: None
+    """
+    args = parse_args(argv)
+    param_dict = {'year': 2019, 'sub_account': synthetic_data.sub_accounts[0], 'qtr': 1,
+                  'customer': None}
+
+    # The plans and statistics are MySQL's, so this always runs against MySQL
+    cnx = migrate.connect(backend='mysql')
+    cursor = cnx.cursor()
+    cursor.execute('CREATE DATABASE IF NOT EXISTS `{}`;'.format(args.database))
+    cursor.close()
+    cnx.database = args.database
+
+    report = open(args.report, 'w') if args.report else None
+
+    for rows in args.rows:
+        seconds = {}
+        migrate.run_script(cnx, setup_script)
+
+        start = time.perf_counter()
+        customers = synthetic_data.seed_database(cnx, rows, args.customers,
+                                                 year=param_dict['year'])
+        seconds['seed'] = time.perf_counter() - start
+        analyze(cnx)
+
+        before = measure(cnx, param_dict, customers[:args.sample], args.repeat)
+
+        start = time.perf_counter()
+        migrate.apply_migrations(cnx)
+        seconds['migrate'] = time.perf_counter() - start
+        analyze(cnx)
+
+        after = measure(cnx, param_dict, customers[:args.sample], args.repeat)
+
+        report_size(rows, seconds, before, after, None)
+        if report:
+            report_size(rows, seconds, before, after, report)
+
+    if report:
+        report.close()
+
+    cnx.close()
+
+
+if __name__ == '__main__':
+    main()
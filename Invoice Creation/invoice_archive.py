@@ -0,0 +1,173 @@
+"""
+Invoice Archive - saves copies of the rendered invoices to disk in the background.
+Invoices are rendered into memory and attached to the customer's email straight from there, so
+they no longer have to be written to the save location and read back in again before they can
+be sent. Saving the copy for the records is handed to a background thread instead, which the
+rest of the process does not wait for until the end of the run.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class InvoiceArchive:
+    """
+    Saves invoices on a background thread and keeps a record of each one saved.
+    When sent to a worker process it arrives empty, in the same way as RunTimer, and the main
+    process collects the records with the take and extend methods.
+    """
+
+    # The most invoices that can be waiting to be saved at once, so that a slow disk holds up
+    # the run rather than letting rendered invoices pile up in memory
+    max_pending = 8
+
+    def __init__(self):
+        """
+        Initialise class
+        """
+        self.records = []
+        self._lock = threading.Lock()
+        self._pending = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+
+    def __getstate__(self):
+        """
+        Called when the archive is pickled to be sent to a worker process. The background
+        thread, locks and the records of the main process are left behind.
+        :return: Dictionary of the instance attributes
+        """
+        return {'records': []}
+
+    def __setstate__(self, state):
+        """
+        Called when the archive is unpickled in a worker process. Recreates what was left out
+        by __getstate__.
+        :param state: Dictionary of the instance attributes
+        :return: None
+        """
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._pending = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+
+    def save(self, file_name, data, on_saved=None, customer=None):
+        """
+        Hands an invoice over to be saved in the background. Waits first if max_pending
+        invoices are already waiting to be saved.
+        :param file_name: The file to save to. Can include path.
+        :param data: Bytes of the pdf.
+        :param on_saved: Optional function to call once the file has been saved, such as
+        recording it in the run journal.
+        :param customer: The Country_Code of the customer the invoice belongs to, so that a
+        failure can be put down to them, see failures.
+        :return: None
+        """
+        self._pending.acquire()
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ARCHIVE')
+            executor = self._executor
+
+        executor.submit(self._save, file_name, data, on_saved, customer)
+
+    def _save(self, file_name, data, on_saved, customer):
+        """
+        Saves one invoice, on the background thread. Any error is recorded rather than raised,
+        as the invoice will usually have been emailed already.
+        :param file_name: The file to save to.
+        :param data: Bytes of the pdf.
+        :param on_saved: Function to call once the file has been saved, or None.
+        :param customer: The Country_Code of the customer, or None.
+        :return: None
+        """
+        error = None
+
+        try:
+            with open(file_name, 'wb') as pdf_file:
+                pdf_file.write(data)
+
+            if on_saved is not None:
+                on_saved()
+        except Exception as err:
+            error = str(err)
+        finally:
+            self._pending.release()
+
+        with self._lock:
+            self.records.append({'file': file_name, 'bytes': len(data), 'error': error,
+                                 'customer': customer})
+
+    def wait(self):
+        """
+        Waits for every invoice handed over so far to be saved.
+        :return: None
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def take(self):
+        """
+        Hands over the records collected so far and starts again with none.
+        :return: List of record dictionaries
+        """
+        with self._lock:
+            records, self.records = self.records, []
+
+        return records
+
+    def extend(self, records):
+        """
+        Adds records collected somewhere else, such as in a worker process.
+        :param records: List of record dictionaries
+        :return: None
+        """
+        with self._lock:
+            self.records.extend(records)
+
+    def summary(self):
+        """
+        Describes what was saved for the run log.
+        :return: List of strings, the first one summing up and then one for each failure.
+        """
+        with self._lock:
+            records = list(self.records)
+
+        failed = [record for record in records if record['error'] is not None]
+        saved = [record for record in records if record['error'] is None]
+
+        lines = ['{} invoice(s) saved ({:.1f}MB), {} failed.'
+                 .format(len(saved), sum([x['bytes'] for x in saved]) / 1024 ** 2, len(failed))]
+        for record in failed:
+            lines.append(failure_message(record))
+
+        return lines
+
+    def failures(self):
+        """
+        Puts together the invoices that could not be saved by the customer they belong to, so
+        that each customer can be logged as an error once.
+        :return: Dictionary of Country_Codes to lists of strings, one for each failure, in the
+        order the customers were saved.
+        """
+        with self._lock:
+            records = list(self.records)
+
+        failures = {}
+        for record in records:
+            if record['error'] is not None:
+                failures.setdefault(record['customer'], []).append(failure_message(record))
+
+        return failures
+
+
+def failure_message(record):
+    """
+    Describes an invoice that could not be saved.
+    :param record: Record dictionary, see InvoiceArchive._save.
+    :return: String
+    """
+    return 'Unable to save {}: {}.'.format(record['file'], record['error'])
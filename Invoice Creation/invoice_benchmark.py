@@ -0,0 +1,286 @@
+"""
+Invoice Benchmark - runs the whole invoice process against synthetic data, end to end.
+A separate benchmark database is filled with a set number of customers, lanes per customer and
+sales rows per lane for one quarter, and the migrations are applied. The process is then run
+on its own, in a scratch folder with its own params shelve, sending its emails to a local SMTP
+sink instead of Office 365. Reports customers per second, sales rows per second and the peak
+memory used, so that every change can be measured against the same baseline.
+
+Usage:
+    python invoice_benchmark.py --database billings_benchmark --customers 20 --lanes 30
+        --rows-per-lane 200 -- --pipeline
+
+Anything after -- is passed on to invoice_creation.py. The params shelve of the run is made
+from benchmark_settings and does not need the real one. With --backend mysql the user, password
+and host are read from the params shelve database in the current folder if there is one, and the
+benchmark database is wiped, so it must not be the one the real data is kept in. With --backend
+sqlite the database is a local file and no database server or params shelve is needed at all.
+"""
+
+import argparse
+import dbm
+import json
+import os
+import shelve
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import migrate
+import synthetic_data
+from database import create_backend
+from smtp_sink import SMTPSink
+
+script_folder = os.path.dirname(os.path.abspath(__file__))
+
+# The settings of the benchmark run, apart from those pointing it at its own database, folder and
+# sink, which are added by write_params. The customers' addresses come from the synthetic
+# reference data.
+benchmark_settings = {'officer': 'Benchmark Officer',
+                      'company': 'Benchmark Company',
+                      'department': 'Accounts',
+                      'email_sender': 'invoices@example.com',
+                      'email_password': '',
+                      'manager_email': 'manager@example.com'}
+
+
+def production_settings():
+    """
+    Reads the params shelve database in the current folder, without creating one if there is
+    none.
+    :return: Dictionary of its settings, empty if there is no shelve.
+    """
+    if not dbm.whichdb('params'):
+        return {}
+
+    with shelve.open('params', flag='r') as data_base:
+        return dict(data_base)
+
+
+def connect(args, database):
+    """
+    Opens a single connection for seeding the benchmark database. MySQL uses the user, password
+    and host from the params shelve database in the current folder.
+    :param args: argparse Namespace.
+    :param database: The database to connect to, or the file for SQLite. None connects to the
+    MySQL server without choosing a database.
+    :return: Connection, see database.py
+    """
+    settings = production_settings() if args.backend == 'mysql' else {}
+
+    return create_backend(args.backend, database,
+                          user=settings.get('user'),
+                          password=settings.get('password'),
+                          host=settings.get('host'),
+                          pool_size=None).connect()
+
+
+def seed(cnx, args, param_dict):
+    """
+    Recreates the tables, fills them with synthetic data and applies the migrations.
+    :param cnx: Connection to the benchmark database.
+    :param args: argparse Namespace.
+    :param param_dict: Dictionary with the year, sub_account and qtr to make data for.
+    :return: The number of sales rows inserted.
+    """
+    migrate.run_script(cnx, os.path.join(script_folder, 'db_setup.sql'))
+
+    customers = synthetic_data.customer_codes(args.customers)
+    synthetic_data.seed_reference_data(cnx, customers, param_dict['year'])
+    rows = synthetic_data.insert_sales(
+        cnx, synthetic_data.lane_sales_rows(customers, args.lanes, args.rows_per_lane,
+                                            param_dict['year'], param_dict['qtr'],
+                                            param_dict['sub_account']))
+
+    migrate.apply_migrations(cnx)
+
+    return rows
+
+
+def write_params(folder, args, param_dict, sink):
+    """
+    Makes the params shelve database for the benchmark run from benchmark_settings, pointing it
+    at the benchmark database, the scratch folder and the sink. MySQL also gets the user,
+    password and host from the params shelve database in the current folder.
+    :param folder: The scratch folder the process will run in.
+    :param args: argparse Namespace.
+    :param param_dict: Dictionary with the year, sub_account and qtr.
+    :param sink: The running SMTPSink.
+    :return: None
+    """
+    settings = dict(benchmark_settings)
+    if args.backend == 'mysql':
+        production = production_settings()
+        settings.update({key: production.get(key) for key in ('user', 'password', 'host')})
+
+    settings.update(param_dict)
+    settings.update({'database_backend': args.backend,
+                     'database_name': args.database,
+                     'customers': None,
+                     'save_location': folder + os.sep,
+                     'log_location': folder + os.sep,
+                     'journal_location': os.path.join(folder, 'run_journal.db'),
+                     'smtp_host': sink.host,
+                     'smtp_port': sink.port,
+                     'smtp_tls': False})
+
+    with shelve.open(os.path.join(folder, 'params')) as data_base:
+        data_base.update(settings)
+
+
+def run_process(folder, process_args):
+    """
+    Runs invoice_creation.py in its own process in the scratch folder, so that its memory use
+    can be measured separately from the seeding.
+    :param folder: The scratch folder to run in.
+    :param process_args: List of command line arguments for invoice_creation.py.
+    :return: Tuple of the seconds taken and the peak memory in megabytes, or None where it
+    cannot be measured.
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(script_folder, 'invoice_creation.py')] +
+                   process_args, cwd=folder, check=True)
+    seconds = time.perf_counter() - start
+
+    # The resource module is only on Unix, so elsewhere the peak memory is not reported
+    try:
+        import resource
+    except ImportError:
+        return seconds, None
+
+    # The peak of the largest process that has finished, which on Linux is in kilobytes
+    peak_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    return seconds, peak_mb
+
+
+def log_footer(folder):
+    """
+    Reads the timing lines from the end of the full log of the run.
+    :param folder: The scratch folder the process ran in.
+    :return: List of strings
+    """
+    for file_name in os.listdir(folder):
+        if file_name.endswith('Full Log.txt'):
+            with open(os.path.join(folder, file_name)) as log_file:
+                return [line.rstrip('\n') for line in log_file if line.startswith('TIMING ')]
+
+    return []
+
+
+def parse_args(argv=None):
+    """
+    Reads the command line options. Anything after -- is kept for invoice_creation.py.
+    :param argv: List of command line arguments. Defaults to sys.argv.
+    :return: argparse Namespace, with the arguments for invoice_creation.py in process_args.
+    """
+    argv = list(sys.argv[1:] if argv is None else argv)
+    process_args = []
+    if '--' in argv:
+        process_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser(description='Benchmarks the whole invoice process against '
+                                                 'synthetic data.')
+    parser.add_argument('--database', required=True,
+                        help='Database to run the benchmark in, or the file for SQLite. It is '
+                             'wiped and recreated.')
+    parser.add_argument('--backend', choices=['mysql', 'sqlite'], default='mysql',
+                        help='Database backend to run the benchmark against.')
+    parser.add_argument('--customers', type=int, default=20,
+                        help='Number of customers to invoice.')
+    parser.add_argument('--lanes', type=int, default=30,
+                        help='Number of lanes each customer has, up to {}.'
+                        .format(synthetic_data.max_lanes()))
+    parser.add_argument('--rows-per-lane', type=int, default=200,
+                        help='Number of sales rows on each lane.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the scratch folder with the invoices and logs.')
+    parser.add_argument('--history',
+                        help='JSON lines file to add the results to, to compare runs over time.')
+    args = parser.parse_args(argv)
+    args.process_args = process_args
+
+    # The process runs in a scratch folder, so the file needs its full path
+    if args.backend == 'sqlite':
+        args.database = os.path.abspath(args.database)
+
+    if args.lanes > synthetic_data.max_lanes():
+        parser.error('--lanes can be no more than {}'.format(synthetic_data.max_lanes()))
+
+    if args.database == production_settings().get('database_name'):
+        parser.error('the benchmark database must not be the one in the params shelve')
+
+    return args
+
+
+def main(argv=None):
+    """
+    Seeds the benchmark database, runs the process and reports how it went.
+    :param argv: List of command line arguments. Defaults to sys.argv.
+    :return: Dictionary of the results.
+    """
+    args = parse_args(argv)
+    param_dict = {'year': 2019, 'sub_account': synthetic_data.sub_accounts[0], 'qtr': 1}
+
+    if args.backend == 'mysql':
+        cnx = connect(args, None)
+        cursor = cnx.cursor()
+        cursor.execute('CREATE DATABASE IF NOT EXISTS `{}`;'.format(args.database))
+        cursor.close()
+        cnx.close()
+
+    cnx = connect(args, args.database)
+
+    start = time.perf_counter()
+    rows = seed(cnx, args, param_dict)
+    seed_seconds = time.perf_counter() - start
+    cnx.close()
+
+    folder = tempfile.mkdtemp(prefix='invoice_benchmark_')
+
+    with SMTPSink() as sink:
+        write_params(folder, args, param_dict, sink)
+        seconds, peak_mb = run_process(folder, args.process_args)
+
+    results = {'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+               'customers': args.customers,
+               'lanes': args.lanes,
+               'rows_per_lane': args.rows_per_lane,
+               'sales_rows': rows,
+               'process_args': args.process_args,
+               'seed_seconds': round(seed_seconds, 2),
+               'seconds': round(seconds, 2),
+               'customers_per_sec': round(args.customers / seconds, 2),
+               'rows_per_sec': round(rows / seconds, 1),
+               'peak_rss_mb': None if peak_mb is None else round(peak_mb, 1),
+               'emails': sink.messages,
+               'email_mb': round(sink.bytes / 1024 ** 2, 2)}
+
+    peak_rss = 'unavailable' if peak_mb is None else '{}MB'.format(results['peak_rss_mb'])
+
+    print('{customers} customer(s), {lanes} lane(s) each, {rows_per_lane} row(s) per lane, '
+          '{sales_rows:,} sales rows. Seeded in {seed_seconds}s.'.format(**results))
+    print('Invoiced in {seconds}s: {customers_per_sec} customers/sec, {rows_per_sec:,} rows/sec, '
+          'peak RSS {peak_rss}. {emails} email(s) received, {email_mb}MB.'
+          .format(peak_rss=peak_rss, **results))
+    for line in log_footer(folder):
+        print(line)
+
+    if args.keep:
+        print('Invoices and logs kept in {}'.format(folder))
+    else:
+        shutil.rmtree(folder)
+
+    if args.history:
+        with open(args.history, 'a') as history:
+            print(json.dumps(results), file=history)
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
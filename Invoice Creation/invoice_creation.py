@@ -5,28 +5,126 @@ This file imports pdf objects from another module and uses an imported function
 The Main() function at the end runs the actual process.
 """
 
+import argparse
+import cProfile
+import os
+import pickle
 import shelve
+import threading
 import time
-from datetime import datetime
-import mysql.connector
-
-# The following three imports are all from other modules I have made
-from invoice_pdf_objects import SummaryInvoice, DetailInvoice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal, ROUND_HALF_UP
+from functools import partial
+
+# The following imports are all from other modules I have made
+from database import create_backend
+from invoice_archive import InvoiceArchive
+from invoice_pdf_objects import SummaryInvoice, DetailVolumes, output_profiles, check_profile
+from invoice_pipeline import InvoicePipeline
+from quarter_summary import check_sql, check_message
+from run_journal import RunJournal
+from run_log import RunLog
+from run_timings import RunTimer
+from scheduling import lpt_order, in_order, schedule_report
+from sharding import (shard_methods, parse_shard, shard_customers, write_results,
+                      load_results, merge_logs)
 from email_module import send_email_365
 from assorted_functions import number_name
 
 
+def round_decimal(value, places):
+    """
+    Rounds a number the same way MySQL's ROUND and FORMAT functions round exact values,
+    which is half away from zero.
+    :param value: Decimal or integer.
+    :param places: Number of decimal places to round to.
+    :return: Decimal
+    """
+    return Decimal(value).quantize(Decimal(1).scaleb(-places), rounding=ROUND_HALF_UP)
+
+
+def number_formatter(places, prefix=''):
+    """
+    Creates a function that formats numbers like MySQL's FORMAT function, rounded to a number
+    of decimal places with commas separating the thousands, such as 1,234.50.
+    :param places: Number of decimal places to show.
+    :param prefix: String to put in front of the number, such as a dollar sign.
+    :return: Function that takes a Decimal or integer (or None) and returns a string (or None).
+    """
+    def formatter(value):
+        if value is None:
+            return None
+        return '{}{:,.{}f}'.format(prefix, round_decimal(value, places), places)
+
+    return formatter
+
+
+def text_formatter(value):
+    """
+    Formats the non-numeric columns of the invoices. Dates are shown as YYYY-MM-DD.
+    :param value: Any value from a query, or None.
+    :return: String, or None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    return str(value)
+
+
+def format_row(row, formatters):
+    """
+    Turns a raw row from a query into the strings that the invoices print.
+    :param row: Tuple of values.
+    :param formatters: Tuple of functions, one for each column that should be kept. Any columns
+    past the end of the formatters are dropped.
+    :return: Tuple of strings
+    """
+    return tuple([formatter(value) for formatter, value in zip(formatters, row)])
+
+
+def format_rows(rows, formatters):
+    """
+    Turns the raw rows from a query into the strings that the invoices print.
+    Each column has its own formatter, worked out once for all of the rows.
+    :param rows: Iterable of tuples.
+    :param formatters: Tuple of functions, see format_row.
+    :return: List containing tuples of strings
+    """
+    return [format_row(row, formatters) for row in rows]
+
+
+# The total amount due, as it is shown on the summary invoice and in the email
+format_money = number_formatter(2, prefix='$')
+
+
 class Params:
     """
     Initializing this class will load in parameters from a shelve database that are
     important for the whole process to run.
     """
 
-    def __init__(self):
+    # Restricts a customer query to a single customer
+    customer_filter = 'sd.Country_Code = %(customer)s AND '
+
+    # Rough number of bytes each prefetched sales row takes up in memory
+    prefetch_row_bytes = 600
+
+    # Rough milliseconds a customer takes, for scheduling parallel runs, taken from the
+    # invoice benchmark. Each customer has a fixed cost for its queries, email and pdf setup,
+    # then each sales row is a line of the detail invoice and each lane a line of the summary.
+    cost_per_customer = 20
+    cost_per_row = 0.35
+    cost_per_lane = 0.5
+
+    def __init__(self, load_customers=True):
         """
         Loads key parameters into the master class for this process from a shelve database.
         If this shelve database does not specify customers, it will call the private load
         customers method.
+        :param load_customers: Whether customers should be loaded from the database if the shelve
+        database does not specify them. Merging shards only needs the settings.
         :return: None
         """
         with shelve.open('params') as data_base:
@@ -34,11 +132,41 @@ class Params:
             self.log_location = data_base['log_location']
             self.customers = data_base['customers']
 
+            # Which database the data comes from, see database.py. For SQLite the database
+            # name is the database file and no user, password or host are needed.
+            self.database_backend = data_base.get('database_backend', 'mysql')
             self.database_name = data_base['database_name']
-            self.user = data_base['user']
-            self.password = data_base['password']
-            self.host = data_base['host']
+            self.user = data_base.get('user')
+            self.password = data_base.get('password')
+            self.host = data_base.get('host')
             self.manager_email = data_base['manager_email']
+            # Connection pool settings, optional in the shelve database
+            self.pool_size = data_base.get('pool_size', 5)
+            self.pool_health_check = data_base.get('pool_health_check', True)
+            # The most memory the prefetch mode is allowed to use, in megabytes
+            self.prefetch_memory_mb = data_base.get('prefetch_memory_mb', 512)
+            # How many rows at a time are read when the detail rows are streamed
+            self.stream_batch_size = data_base.get('stream_batch_size', 1000)
+            # The SQLite file the run journal is kept in, next to this shelve by default
+            self.journal_location = data_base.get('journal_location', 'run_journal.db')
+            # How often the run logs are flushed to disk, and whether a JSON lines version of
+            # the full log is written as well
+            self.log_flush_seconds = data_base.get('log_flush_seconds', 5)
+            self.log_jsonl = data_base.get('log_jsonl', False)
+            # Whether copies of the invoices are saved to the save location. They are emailed
+            # straight from memory either way.
+            self.archive_invoices = data_base.get('archive_invoices', True)
+            # Splits a big detail invoice into several pdfs once it reaches this many pages or
+            # megabytes of page content, see DetailVolumes. None for no limit.
+            self.detail_volume_pages = data_base.get('detail_volume_pages')
+            self.detail_volume_mb = data_base.get('detail_volume_mb')
+            # The most megabytes of attachments in each email when a detail invoice is split,
+            # see Customer.send_invoices. None sends each volume in an email of its own.
+            self.email_max_mb = data_base.get('email_max_mb')
+            # How the invoices are compressed and written, one of the names in output_profiles
+            self.output_profile = data_base.get('output_profile', 'standard')
+            # Whether summary invoices are read from the sales_quarter_summary rollup table
+            self.use_quarter_summary = data_base.get('use_quarter_summary', False)
             self.date_stamp = datetime.now().strftime('%Y-%m-%d %H-%M-%S')
 
             self.param_dict = {'year': data_base['year'],
@@ -52,9 +180,384 @@ class Params:
                               'email_sender': data_base['email_sender'],
                               'email_password': data_base['email_password']}
 
-        if self.customers is None:
+            # The email server, optional in the shelve database
+            self.smtp_dict = {'smtp_host': data_base.get('smtp_host', 'smtp.office365.com'),
+                              'smtp_port': data_base.get('smtp_port', 587),
+                              'smtp_tls': data_base.get('smtp_tls', True)}
+
+        # For MySQL, the connection pool is only created when the first query is run.
+        # The semaphore makes threads wait for a free connection rather than the pool erroring.
+        self.backend = create_backend(self.database_backend, self.database_name, self.user,
+                                      self.password, self.host, self.pool_size,
+                                      self.pool_health_check)
+        self._pool_slots = threading.BoundedSemaphore(self.pool_size)
+        self._lock = threading.Lock()
+        # Counters for the run log, see the run_query method
+        self.connection_ids = set()
+        self.query_count = 0
+        # How long each stage of the run takes for each customer
+        self.timer = RunTimer()
+        # Saves the invoices to the save location in the background
+        self.archive = InvoiceArchive()
+        # Customer data for the whole quarter, loaded by the validate_quarter and
+        # prefetch_quarter methods. Keyed by query name and then by Country_Code.
+        self.prefetched = {}
+        # The RunJournal instance for this run, set up by main
+        self.journal = None
+        # Fingerprints of each customer's data, loaded by the load_fingerprints method, and
+        # whether customers whose fingerprint has not changed since they were last invoiced
+        # should be skipped
+        self.fingerprints = {}
+        self.incremental = False
+        # Whether the detail rows are streamed from the database as the detail invoice is
+        # rendered, rather than being fetched all at once beforehand
+        self.stream_detail = False
+        # Whether each customer's summary and detail data are fetched at the same time, and the
+        # process pool summary invoices are rendered in while the detail invoice is rendered,
+        # set up by main
+        self.concurrent_invoices = False
+        self.render_pool = None
+
+        if self.customers is None and load_customers:
             self._load_customers()
 
+    def __getstate__(self):
+        """
+        Called when the parameters are pickled to be sent to a worker process.
+        The locks cannot be sent, so the worker will create its own, and the backend leaves its
+        connection pool behind in the same way. The render pool is left behind too.
+        :return: Dictionary of the instance attributes
+        """
+        state = self.__dict__.copy()
+        del state['_pool_slots']
+        del state['_lock']
+        state['render_pool'] = None
+        return state
+
+    def __setstate__(self, state):
+        """
+        Called when the parameters are unpickled in a worker process. Recreates the locks that
+        were left out by __getstate__.
+        :param state: Dictionary of the instance attributes
+        :return: None
+        """
+        self.__dict__.update(state)
+        self._pool_slots = threading.BoundedSemaphore(self.pool_size)
+        self._lock = threading.Lock()
+
+    def _get_connection(self):
+        """
+        Retrieves a connection from the database backend. For MySQL this comes from the
+        connection pool, which is created the first time a connection is asked for, and if
+        health checks are turned on the connection is pinged before it is handed out and will be
+        reconnected if the server has dropped it.
+        :return: A connection. Calling close on it will return it to the pool.
+        """
+        cnx = self.backend.connect()
+
+        # Every reconnect gets a new id from the server, so this tells us how many
+        # connections were actually opened over the course of the run
+        with self._lock:
+            self.connection_ids.add(cnx.connection_id)
+
+        return cnx
+
+    def run_query(self, sql, param_dict, label='other'):
+        """
+        Runs a single query against the MySQL database using a connection from the pool.
+        All of the queries in this process should go through this method.
+        :param sql: The SQL string to execute.
+        :param param_dict: Dictionary of parameters for the SQL string.
+        :param label: Name the query is timed under, such as the name of a customer query.
+        :return: List containing tuples
+        """
+        customer = param_dict.get('customer')
+
+        with self._pool_slots:
+            with self.timer.time('connect', customer):
+                cnx = self._get_connection()
+
+            try:
+                with self.timer.time('query ' + label, customer):
+                    my_cursor = cnx.cursor()
+                    my_cursor.execute(sql, param_dict)
+                    go_fetch = my_cursor.fetchall()
+                    my_cursor.close()
+            finally:
+                cnx.close()
+
+        with self._lock:
+            self.query_count += 1
+
+        return go_fetch
+
+    def stream_query(self, sql, param_dict, label='other'):
+        """
+        Runs a single query like the run_query method, but hands back the rows a batch at a
+        time as they are read instead of fetching them all at once. The cursor is unbuffered,
+        so MySQL sends the rows as they are asked for and only one batch of them is ever held
+        in memory. The connection is held until the last row has been read.
+        :param sql: The SQL string to execute.
+        :param param_dict: Dictionary of parameters for the SQL string.
+        :param label: Name the query is timed under. Only the time until the first row is
+        ready is counted, as the rest depends on how quickly the rows are used.
+        :return: Generator of tuples
+        """
+        customer = param_dict.get('customer')
+
+        with self._pool_slots:
+            with self.timer.time('connect', customer):
+                cnx = self._get_connection()
+
+            try:
+                with self.timer.time('query ' + label, customer):
+                    my_cursor = cnx.cursor(buffered=False)
+                    my_cursor.execute(sql, param_dict)
+
+                with self._lock:
+                    self.query_count += 1
+
+                while True:
+                    rows = my_cursor.fetchmany(self.stream_batch_size)
+                    if not rows:
+                        break
+                    yield from rows
+
+                my_cursor.close()
+            finally:
+                # If the rows stopped being read part of the way through, the rest have to be
+                # read off before the connection can go back to the pool
+                if cnx.unread_result:
+                    cnx.consume_results()
+                cnx.close()
+
+    def query_sql(self, name):
+        """
+        Looks up the SQL for one of the sets of data that a customer needs. If the
+        use_quarter_summary setting is on and the query has a version that reads from the
+        sales_quarter_summary rollup table, that version is used instead.
+        :param name: The name of the query, such as 'summary_body' for summary_body_sql.
+        :return: SQL string with a {customer_filter} placeholder.
+        """
+        if self.use_quarter_summary and hasattr(Customer, name + '_rollup_sql'):
+            return getattr(Customer, name + '_rollup_sql')
+
+        return getattr(Customer, name + '_sql')
+
+    def check_quarter_summary(self):
+        """
+        Compares the sales_quarter_summary rollup table against the live totals of the sales
+        data for the quarter. If they do not match, the use_quarter_summary setting is turned
+        off for this run so that the invoices are still right.
+        :return: A string describing the outcome, for the run log.
+        """
+        differences = self.run_query(check_sql, self.param_dict, 'quarter summary check')
+
+        if differences:
+            self.use_quarter_summary = False
+            return '{}\nThe summary invoices were created from the sales data instead. Run ' \
+                   'quarter_summary.py --rebuild to bring the rollup up to date.' \
+                   .format(check_message(differences))
+
+        return check_message(differences)
+
+    def customer_query(self, name, customer):
+        """
+        Retrieves one of the sets of data that a customer needs, as named by the SQL class
+        attributes of the Customer class. If that set of data has already been loaded for the
+        whole quarter, the customer's slice of it is returned instead of querying the database.
+        :param name: The name of the query, such as 'summary_body' for summary_body_sql.
+        :param customer: The Country_Code of the customer.
+        :return: List containing tuples, without the leading Country_Code column.
+        """
+        if name in self.prefetched:
+            return list(self.prefetched[name].get(customer, []))
+
+        sql = self.query_sql(name).format(customer_filter=self.customer_filter)
+        param_dict = dict(self.param_dict, customer=customer)
+
+        return [row[1:] for row in self.run_query(sql, param_dict, name)]
+
+    def customer_stream(self, name, customer):
+        """
+        Same as the customer_query method, but the rows are streamed from the database a
+        batch at a time by the stream_query method rather than all being fetched at once.
+        :param name: The name of the query, such as 'detail' for detail_sql.
+        :param customer: The Country_Code of the customer.
+        :return: Generator of tuples, without the leading Country_Code column.
+        """
+        if name in self.prefetched:
+            yield from self.prefetched[name].get(customer, [])
+            return
+
+        sql = self.query_sql(name).format(customer_filter=self.customer_filter)
+        param_dict = dict(self.param_dict, customer=customer)
+
+        for row in self.stream_query(sql, param_dict, name):
+            yield row[1:]
+
+    def _bulk_query(self, name):
+        """
+        Runs one of the customer queries once for the whole quarter, and partitions the rows
+        by Country_Code into the prefetched class attribute for the customer_query method to use.
+        :param name: The name of the query, such as 'summary_body' for summary_body_sql.
+        :return: None
+        """
+        sql = self.query_sql(name).format(customer_filter='')
+        partitions = {}
+
+        for row in self.run_query(sql, self.param_dict, name + ' (quarter)'):
+            partitions.setdefault(row[0], []).append(row[1:])
+
+        self.prefetched[name] = partitions
+
+    def validate_quarter(self, file_name):
+        """
+        Pre-flight check of every customer in the quarter. Finds all of the missing rates and
+        all of the customer address details in two queries, rather than two queries per
+        customer, and writes a report of the customers that cannot be invoiced.
+        Customers then check themselves against these results instead of the database.
+        :param file_name: What txt file to write the validation report to.
+        :return: The number of customers that cannot be invoiced.
+        """
+        self._bulk_query('rates_issues')
+        self._bulk_query('details')
+
+        invalid = []
+
+        for customer in self.customers:
+            rates_issues = tuple([''.join([str(x) for x in row]) for row in
+                                  self.prefetched['rates_issues'].get(customer, [])])
+            details = self.prefetched['details'].get(customer, [(None, None, None)])[0]
+            details = {'Country_Name': details[0],
+                       'Physical_Address': details[1],
+                       'Email_Address': details[2]}
+
+            if None in details.values() or len(rates_issues) > 0:
+                invalid.append((customer, issues_message(rates_issues, details)))
+
+        with open(file_name, 'w') as report:
+            print('{} of {} customer(s) can be invoiced for {}.\n'
+                  .format(len(self.customers) - len(invalid), len(self.customers),
+                          self.quarter_key), file=report)
+
+            for num, (customer, message) in enumerate(invalid):
+                print('{}. {}\n{}'.format(num + 1, customer, message), file=report)
+
+        return len(invalid)
+
+    def prefetch_quarter(self):
+        """
+        Loads the data for every customer in the quarter with one bulk query per data set, rather
+        than querying once per customer. The rows are partitioned by Country_Code into the
+        prefetched class attribute, which the customer_query method will then use.
+        The sales rows are counted first, and if the estimated size of the data is over the
+        prefetch_memory_mb setting, nothing is loaded and customers are queried one at a time.
+        :return: A string describing the outcome, for the run log.
+        """
+        sql = 'SELECT COUNT(*) ' \
+              'FROM sales_data ' \
+              'WHERE ' \
+              'Sub_Account_Type = %(sub_account)s AND ' \
+              'Despatch_Year = %(year)s AND ' \
+              'Qtr = %(qtr)s;'
+
+        row_count = self.run_query(sql, self.param_dict, 'sales count')[0][0]
+        estimate_mb = row_count * self.prefetch_row_bytes / 1024 ** 2
+
+        if estimate_mb > self.prefetch_memory_mb:
+            return 'Skipped, an estimated {:,.0f}MB for {:,} sales rows is over the {}MB ' \
+                   'ceiling.'.format(estimate_mb, row_count, self.prefetch_memory_mb)
+
+        # The validation data will usually have been loaded already, and the detail rows are
+        # left out when they are being streamed so that they are never all held in memory. The
+        # sizes of the rates combinations are only needed when they are.
+        names = [name for name in Customer.query_names if name not in self.prefetched and
+                 name != ('detail' if self.stream_detail else 'detail_groups')]
+
+        for name in names:
+            self._bulk_query(name)
+
+        return '{:,} sales rows loaded in {} queries.'.format(row_count, len(names) + 1)
+
+    @property
+    def quarter_key(self):
+        """
+        String identifying the sub account, year and quarter of this run, which fingerprints
+        are saved against in the run journal.
+        :return: String
+        """
+        return '{sub_account} {year} Q{qtr}'.format(**self.param_dict)
+
+    def load_fingerprints(self):
+        """
+        Works out a cheap fingerprint of the data behind each customer's invoices in one query,
+        and loads them into the fingerprints class attribute as a dictionary keyed by
+        Country_Code. The fingerprint is made of row counts, the highest IDs and checksums of
+        the sales rows and the rates and address rows they join to, so it changes whenever any
+        of these rows are added, removed or edited.
+        :return: None
+        """
+        sql = 'SELECT ' \
+              'sd.Country_Code, ' \
+              'COUNT(*), ' \
+              'MAX(sd.ID), ' \
+              'SUM(CRC32(CONCAT_WS(\'|\', sd.ID, sd.Despatch_Date, sd.Serial_Number, ' \
+              'sd.Operator, sd.Origin, sd.Destination, sd.Mail_Category, sd.Subclass, sd.PL, ' \
+              'sd.No_of_ItRates, sd.Weight_Kgs))), ' \
+              'COUNT(rd.ID), ' \
+              'MAX(rd.ID), ' \
+              'SUM(CRC32(CONCAT_WS(\'|\', rd.ID, rd.Rate_Ltr_Kg, rd.Rate_Ltr_Itm, ' \
+              'rd.Rate_Bulk_Kg, rd.Rate_Bulk_Itm))), ' \
+              'MAX(CRC32(CONCAT_WS(\'|\', ad.Country_Name, ad.Physical_Address, ' \
+              'ad.Email_Address))) ' \
+              '' \
+              'FROM sales_data sd ' \
+              '' \
+              'LEFT JOIN rates_data rd ' \
+              'USING (Despatch_Year, Operator, PL, Mail_Category, Subclass) ' \
+              '' \
+              'LEFT JOIN address_data ad ' \
+              'ON ad.Country_Code = sd.Country_Code ' \
+              '' \
+              'WHERE ' \
+              'sd.Sub_Account_Type = %(sub_account)s AND ' \
+              'sd.Despatch_Year = %(year)s AND ' \
+              'sd.Qtr = %(qtr)s ' \
+              '' \
+              'GROUP BY sd.Country_Code;'
+
+        self.fingerprints = {row[0]: '-'.join([str(x) for x in row[1:]])
+                             for row in self.run_query(sql, self.param_dict, 'fingerprints')}
+
+    def customer_sizes(self):
+        """
+        Counts the sales rows and lanes of every customer in the quarter in one query. A lane is
+        each combination of the columns the summary invoice groups by.
+        :return: Dictionary of Country_Codes to tuples of their sales rows and lanes.
+        """
+        sql = 'SELECT Country_Code, COUNT(*), ' \
+              'COUNT(DISTINCT CONCAT_WS(\'|\', Operator, PL, Origin, Destination, ' \
+              'Mail_Category, Subclass)) ' \
+              'FROM sales_data ' \
+              'WHERE ' \
+              'Sub_Account_Type = %(sub_account)s AND ' \
+              'Despatch_Year = %(year)s AND ' \
+              'Qtr = %(qtr)s ' \
+              'GROUP BY Country_Code;'
+
+        return {row[0]: tuple(row[1:]) for row in self.run_query(sql, self.param_dict,
+                                                                   'customer sizes')}
+
+    def estimate_cost(self, rows, lanes):
+        """
+        Estimates how long a customer will take from the size of its invoices.
+        :param rows: The number of sales rows the customer has.
+        :param lanes: The number of lanes the customer has.
+        :return: Rough milliseconds
+        """
+        return self.cost_per_customer + rows * self.cost_per_row + lanes * self.cost_per_lane
+
     def _load_customers(self):
         """
         Loads a tuple of unique Country_Codes from the MySQL database that
@@ -63,11 +566,6 @@ class Params:
         Loads the tuple directly into the customers class attribute.
         :return: None
         """
-        cnx = mysql.connector.connect(user=self.user, password=self.password,
-                                      host=self.host, database=self.database_name)
-
-        my_cursor = cnx.cursor()
-
         sql = 'SELECT DISTINCT(Country_Code) ' \
               'FROM sales_data ' \
               'WHERE ' \
@@ -76,11 +574,8 @@ class Params:
               'Qtr = %(qtr)s ' \
               'ORDER BY Country_Code;'
 
-        my_cursor.execute(sql, self.param_dict)
-
-        self.customers = tuple([x[0] for x in my_cursor.fetchall()])
-
-        cnx.close()
+        self.customers = tuple([x[0] for x in self.run_query(sql, self.param_dict,
+                                                             'customers')])
 
 
 class Customer:
@@ -89,13 +584,263 @@ class Customer:
     Contains a large cohort of methods that retrieve all the necessary information for the
     invoices from the MySQL database, create invoice objects, and then email them off.
     """
-    def __init__(self, master):
+
+    # The SQL for each set of data a customer needs.
+    # Every query returns the Country_Code as its first column and has a {customer_filter}
+    # placeholder, so that the same query can either be run for a single customer or be run
+    # once for the whole quarter by the Params.prefetch_quarter method.
+
+    # How the columns of the summary and detail queries are printed on the invoices
+    summary_body_formats = (text_formatter, text_formatter, text_formatter, text_formatter,
+                            text_formatter, number_formatter(0), number_formatter(2),
+                            number_formatter(4), number_formatter(4), number_formatter(2),
+                            number_formatter(4), number_formatter(4), number_formatter(2),
+                            number_formatter(2))
+    summary_totals_formats = (number_formatter(0), number_formatter(2), number_formatter(2),
+                              number_formatter(2), format_money)
+    detail_formats = (text_formatter, text_formatter, text_formatter, text_formatter,
+                      text_formatter, text_formatter, number_formatter(0), number_formatter(2))
+    detail_totals_formats = (number_formatter(0), number_formatter(2))
+
+    # The names of the queries below, which is what Params.customer_query expects
+    query_names = ('rates_issues', 'details', 'summary_body', 'summary_totals', 'detail',
+                   'detail_groups')
+
+    # Missing rates for the customer
+    rates_issues_sql = 'SELECT DISTINCT ' \
+                       'sd.Country_Code, ' \
+                       'sd.Despatch_Year, ' \
+                       'sd.Operator, ' \
+                       'sd.PL, ' \
+                       'sd.Mail_Category, ' \
+                       'sd.Subclass ' \
+                       '' \
+                       'FROM sales_data sd ' \
+                       '' \
+                       'LEFT JOIN rates_data rd ' \
+                       'USING (Despatch_Year, Operator, PL, Mail_Category, Subclass) ' \
+                       '' \
+                       'WHERE ' \
+                       'sd.Sub_Account_Type = %(sub_account)s AND ' \
+                       'sd.Despatch_Year = %(year)s AND ' \
+                       '{customer_filter}' \
+                       'sd.Qtr = %(qtr)s AND ' \
+                       'rd.Rate_Ltr_Kg IS NULL ' \
+                       '' \
+                       'ORDER BY sd.Country_Code;'
+
+    # Name, address and email of the customer
+    details_sql = 'SELECT DISTINCT ' \
+                  'sd.Country_Code, ' \
+                  'ad.Country_Name, ' \
+                  'ad.Physical_Address, ' \
+                  'ad.Email_Address ' \
+                  '' \
+                  'FROM sales_data sd ' \
+                  'LEFT JOIN address_data ad ' \
+                  'USING (Country_Code) ' \
+                  '' \
+                  'WHERE ' \
+                  'sd.Sub_Account_Type = %(sub_account)s AND ' \
+                  'sd.Despatch_Year = %(year)s AND ' \
+                  '{customer_filter}' \
+                  'sd.Qtr = %(qtr)s ' \
+                  '' \
+                  'ORDER BY sd.Country_Code;'
+
+    # The bulk part of the summary invoice
+    summary_body_sql = 'SELECT ' \
+                       'sd.Country_Code, ' \
+                       'sd.Operator, ' \
+                       'sd.Origin, ' \
+                       'sd.Destination, ' \
+                       'sd.Mail_Category, ' \
+                       'sd.Subclass, ' \
+                       'SUM(sd.No_of_ItRates), ' \
+                       'SUM(sd.Weight_Kgs), ' \
+                       '' \
+                       'rd.Rate_Ltr_Itm, ' \
+                       'rd.Rate_Bulk_Itm, ' \
+                       '' \
+                       'SUM((rd.Rate_Ltr_Itm + rd.Rate_Bulk_Itm) * sd.No_of_ItRates), ' \
+                       '' \
+                       'rd.Rate_Ltr_Kg, ' \
+                       'rd.Rate_Bulk_Kg, ' \
+                       '' \
+                       'SUM((rd.Rate_Ltr_Kg + rd.Rate_Bulk_Kg) * sd.Weight_Kgs), ' \
+                       '' \
+                       'SUM((rd.Rate_Ltr_Itm + rd.Rate_Bulk_Itm) * sd.No_of_ItRates + ' \
+                       '(rd.Rate_Ltr_Kg + rd.Rate_Bulk_Kg) * sd.Weight_Kgs) ' \
+                       '' \
+                       'FROM sales_data sd ' \
+                       '' \
+                       'LEFT JOIN rates_data rd ' \
+                       'USING (Despatch_Year, Operator, PL, Mail_Category, Subclass) ' \
+                       '' \
+                       'WHERE ' \
+                       'sd.Sub_Account_Type = %(sub_account)s AND ' \
+                       'sd.Despatch_Year = %(year)s AND ' \
+                       '{customer_filter}' \
+                       'sd.Qtr = %(qtr)s ' \
+                       '' \
+                       'GROUP BY ' \
+                       'sd.Country_Code, ' \
+                       'sd.Operator, ' \
+                       'sd.Origin, ' \
+                       'sd.Destination, ' \
+                       'sd.Mail_Category, ' \
+                       'sd.Subclass, ' \
+                       'rd.Rate_Ltr_Itm, ' \
+                       'rd.Rate_Bulk_Itm, ' \
+                       'rd.Rate_Ltr_Kg, ' \
+                       'rd.Rate_Bulk_Kg ' \
+                       '' \
+                       'ORDER BY ' \
+                       'sd.Country_Code, ' \
+                       'sd.Operator, ' \
+                       'sd.Origin, ' \
+                       'sd.Destination, ' \
+                       'sd.Mail_Category, ' \
+                       'sd.Subclass;'
+
+    # The totals section underneath the bulk part of the summary invoice
+    summary_totals_sql = 'SELECT ' \
+                         'sd.Country_Code, ' \
+                         'SUM(sd.No_of_ItRates), ' \
+                         'SUM(sd.Weight_Kgs), ' \
+                         'SUM((rd.Rate_Ltr_Itm + rd.Rate_Bulk_Itm) * sd.No_of_ItRates), ' \
+                         'SUM((rd.Rate_Ltr_Kg + rd.Rate_Bulk_Kg) * sd.Weight_Kgs), ' \
+                         'SUM((rd.Rate_Ltr_Itm + rd.Rate_Bulk_Itm) * sd.No_of_ItRates + ' \
+                         '(rd.Rate_Ltr_Kg + rd.Rate_Bulk_Kg) * sd.Weight_Kgs) ' \
+                         '' \
+                         'FROM sales_data sd ' \
+                         '' \
+                         'LEFT JOIN rates_data rd ' \
+                         'USING (Despatch_Year, Operator, PL, Mail_Category, Subclass) ' \
+                         '' \
+                         'WHERE ' \
+                         'sd.Sub_Account_Type = %(sub_account)s AND ' \
+                         'sd.Despatch_Year = %(year)s AND ' \
+                         '{customer_filter}' \
+                         'sd.Qtr = %(qtr)s ' \
+                         '' \
+                         'GROUP BY sd.Country_Code ' \
+                         '' \
+                         'ORDER BY sd.Country_Code;'
+
+    # The two summary queries again, reading from the sales_quarter_summary rollup table instead
+    # of adding up every sales row. Params.query_sql uses these when the use_quarter_summary
+    # setting is on. The rollup totals have the same names as the sales_data columns, so only
+    # the table is different.
+    summary_body_rollup_sql = summary_body_sql.replace('FROM sales_data sd',
+                                                       'FROM sales_quarter_summary sd')
+    summary_totals_rollup_sql = summary_totals_sql.replace('FROM sales_data sd',
+                                                           'FROM sales_quarter_summary sd')
+
+    # The detail invoice. The first half of the union is the bulk part of the detail invoice
+    # and the second half is the totals for each unique rates combination. Row_Type is what
+    # puts each totals row directly underneath the rows that it is totalling.
+    detail_sql = 'SELECT ' \
+                 'sd.Country_Code, ' \
+                 'sd.Despatch_Date, ' \
+                 'sd.Origin, ' \
+                 'sd.Destination, ' \
+                 'sd.Mail_Category, ' \
+                 'sd.Subclass, ' \
+                 'sd.Serial_Number, ' \
+                 'sd.No_of_ItRates, ' \
+                 'sd.Weight_Kgs, ' \
+                 '0 AS Row_Type ' \
+                 '' \
+                 'FROM sales_data sd ' \
+                 '' \
+                 'WHERE ' \
+                 'sd.Sub_Account_Type = %(sub_account)s AND ' \
+                 'sd.Despatch_Year = %(year)s AND ' \
+                 '{customer_filter}' \
+                 'sd.Qtr = %(qtr)s ' \
+                 '' \
+                 'UNION ALL ' \
+                 '' \
+                 'SELECT ' \
+                 'sd.Country_Code, ' \
+                 'NULL, ' \
+                 'sd.Origin, ' \
+                 'sd.Destination, ' \
+                 'sd.Mail_Category, ' \
+                 'sd.Subclass, ' \
+                 'NULL, ' \
+                 'SUM(sd.No_of_ItRates), ' \
+                 'SUM(sd.Weight_Kgs), ' \
+                 '1 ' \
+                 '' \
+                 'FROM sales_data sd ' \
+                 '' \
+                 'WHERE ' \
+                 'sd.Sub_Account_Type = %(sub_account)s AND ' \
+                 'sd.Despatch_Year = %(year)s AND ' \
+                 '{customer_filter}' \
+                 'sd.Qtr = %(qtr)s ' \
+                 '' \
+                 'GROUP BY ' \
+                 'sd.Country_Code, ' \
+                 'sd.Origin, ' \
+                 'sd.Destination, ' \
+                 'sd.Mail_Category, ' \
+                 'sd.Subclass ' \
+                 '' \
+                 'ORDER BY ' \
+                 'Country_Code, ' \
+                 'Origin, ' \
+                 'Destination, ' \
+                 'Mail_Category, ' \
+                 'Subclass, ' \
+                 'Row_Type, ' \
+                 'Serial_Number, ' \
+                 'Despatch_Date;'
+
+    # The number of detail rows in each rates combination, in the same order as the detail
+    # query, so the pages of a streamed detail invoice can be planned before its rows are read
+    detail_groups_sql = 'SELECT ' \
+                        'sd.Country_Code, ' \
+                        'COUNT(*) ' \
+                        '' \
+                        'FROM sales_data sd ' \
+                        '' \
+                        'WHERE ' \
+                        'sd.Sub_Account_Type = %(sub_account)s AND ' \
+                        'sd.Despatch_Year = %(year)s AND ' \
+                        '{customer_filter}' \
+                        'sd.Qtr = %(qtr)s ' \
+                        '' \
+                        'GROUP BY ' \
+                        'sd.Country_Code, ' \
+                        'sd.Origin, ' \
+                        'sd.Destination, ' \
+                        'sd.Mail_Category, ' \
+                        'sd.Subclass ' \
+                        '' \
+                        'ORDER BY ' \
+                        'sd.Country_Code, ' \
+                        'sd.Origin, ' \
+                        'sd.Destination, ' \
+                        'sd.Mail_Category, ' \
+                        'sd.Subclass;'
+
+    def __init__(self, master, customer_code=None):
         """
         Loads important information into the class attributes and determines whether or not
         the Country_Code supplied through the master parameter is valid.
         :param master: Should be an instance of the Params class.
+        :param customer_code: The Country_Code of the customer. Will use the customer in the
+        master parameter dictionary if none provided.
         """
         self.master = master
+        # The customer keeps its own copy of the parameters so that several customers can be
+        # worked on at the same time
+        self.param_dict = dict(master.param_dict)
+        if customer_code is not None:
+            self.param_dict['customer'] = customer_code
         self.rates_issues = self._get_rates_issues()
         self.details = self._get_details()
         self.valid = self._is_valid()
@@ -103,40 +848,40 @@ class Customer:
         self.status = None
         # Where the total amount the customer is to be billed will be stored
         self.total_due = None
+        # Where the invoice data, and then the invoice file names and rendered pdfs, are stored
+        # between stages. The detail invoice can be split into several files, see DetailVolumes.
+        self.summary_data = None
+        self.detail_data = None
+        # The number of rows in each rates combination of the detail invoice, for planning its
+        # pages when the detail rows are streamed, see DetailInvoice.insert_lines
+        self.detail_groups = None
+        self.summary_file = None
+        self.detail_file = None
+        self.detail_files = None
+        self.summary_pdf = None
+        self.detail_pdfs = None
+        # The stages this customer already finished in an earlier attempt at the same run
+        if master.journal is None:
+            self.completed = {}
+        else:
+            self.completed = master.journal.completed(self.param_dict['customer'])
+
+        # The run this customer was last invoiced in, if its data has not changed since
+        self.fingerprint = master.fingerprints.get(self.param_dict['customer'])
+        self.unchanged_since = None
+        if master.incremental and master.journal is not None and self.fingerprint is not None:
+            last = master.journal.last_fingerprint(self.param_dict['customer'],
+                                                   master.quarter_key)
+            if last is not None and last[0] == self.fingerprint:
+                self.unchanged_since = last[1]
 
     def _get_rates_issues(self):
         """
         Queries the MySQL database to find if this customer has any missing rates.
         :return: A tuple of the missing rate references, if any.
         """
-        cnx = mysql.connector.connect(user=self.master.user, password=self.master.password,
-                                      host=self.master.host, database=self.master.database_name)
-
-        my_cursor = cnx.cursor()
-
-        sql = 'SELECT DISTINCT ' \
-              'CONVERT(sd.Despatch_Year, CHAR), ' \
-              'sd.Operator, ' \
-              'sd.PL, ' \
-              'sd.Mail_Category, ' \
-              'sd.Subclass ' \
-              '' \
-              'FROM sales_data sd ' \
-              '' \
-              'LEFT JOIN rates_data rd ' \
-              'USING (Despatch_Year, Operator, PL, Mail_Category, Subclass) ' \
-              '' \
-              'WHERE ' \
-              'sd.Sub_Account_Type = %(sub_account)s AND ' \
-              'sd.Despatch_Year = %(year)s AND ' \
-              'sd.Qtr = %(qtr)s AND ' \
-              'sd.Country_Code = %(customer)s AND ' \
-              'rd.Rate_Ltr_Kg IS NULL;'
-
-        my_cursor.execute(sql, self.master.param_dict)
-        go_fetch = my_cursor.fetchall()
-        go_fetch = tuple([''.join(x) for x in go_fetch])
-        cnx.close()
+        go_fetch = self.master.customer_query('rates_issues', self.param_dict['customer'])
+        go_fetch = tuple([''.join([str(x) for x in row]) for row in go_fetch])
         return go_fetch
 
     def _get_details(self):
@@ -144,32 +889,10 @@ class Customer:
         Queries the MySQL database to retrieve customer information.
         :return: A dictionary object containing Country_Name, Physical_Address, Email_Address
         """
-        cnx = mysql.connector.connect(user=self.master.user, password=self.master.password,
-                                      host=self.master.host, database=self.master.database_name)
-
-        my_cursor = cnx.cursor()
-
-        sql = 'SELECT DISTINCT ' \
-              'ad.Country_Name, ' \
-              'ad.Physical_Address, ' \
-              'ad.Email_Address ' \
-              '' \
-              'FROM sales_data sd ' \
-              'LEFT JOIN address_data ad ' \
-              'USING (Country_Code) ' \
-              '' \
-              'WHERE ' \
-              'sd.Sub_Account_Type = %(sub_account)s AND ' \
-              'sd.Despatch_Year = %(year)s AND ' \
-              'sd.Qtr = %(qtr)s AND ' \
-              'sd.Country_Code = %(customer)s;'
-
-        my_cursor.execute(sql, self.master.param_dict)
-        go_fetch = my_cursor.fetchall()[0]
+        go_fetch = self.master.customer_query('details', self.param_dict['customer'])[0]
         go_fetch = {'Country_Name': go_fetch[0],
                     'Physical_Address': go_fetch[1],
                     'Email_Address': go_fetch[2]}
-        cnx.close()
         return go_fetch
 
     def _is_valid(self):
@@ -189,97 +912,16 @@ class Customer:
         data to construct the summary invoice.
         :return: List containing tuples
         """
+        summary_body = self.master.customer_query('summary_body',
+                                                  self.param_dict['customer'])
+        summary_totals = self.master.customer_query('summary_totals',
+                                                    self.param_dict['customer'])[0]
 
-        cnx = mysql.connector.connect(user=self.master.user, password=self.master.password,
-                                      host=self.master.host, database=self.master.database_name)
-        my_cursor = cnx.cursor()
-
-        # The bulk part of the invoice
-        sql = 'SELECT ' \
-              'sd.Operator, ' \
-              'sd.Origin, ' \
-              'sd.Destination, ' \
-              'sd.Mail_Category, ' \
-              'sd.Subclass, ' \
-              'FORMAT(SUM(sd.No_of_ItRates), 0), ' \
-              'FORMAT(SUM(sd.Weight_Kgs), 2), ' \
-              '' \
-              'FORMAT(rd.Rate_Ltr_Itm, 4), ' \
-              'FORMAT(rd.Rate_Bulk_Itm, 4), ' \
-              '' \
-              'FORMAT(SUM((rd.Rate_Ltr_Itm + rd.Rate_Bulk_Itm) * sd.No_of_ItRates), 2), ' \
-              '' \
-              'FORMAT(rd.Rate_Ltr_Kg, 4), ' \
-              'FORMAT(rd.Rate_Bulk_Kg, 4), ' \
-              '' \
-              'FORMAT(SUM((rd.Rate_Ltr_Kg + rd.Rate_Bulk_Kg) * sd.Weight_Kgs), 2), ' \
-              '' \
-              'FORMAT(SUM((rd.Rate_Ltr_Itm + rd.Rate_Bulk_Itm) * sd.No_of_ItRates + ' \
-              '(rd.Rate_Ltr_Kg + rd.Rate_Bulk_Kg) * sd.Weight_Kgs), 2) ' \
-              '' \
-              'FROM sales_data sd ' \
-              '' \
-              'LEFT JOIN rates_data rd ' \
-              'USING (Despatch_Year, Operator, PL, Mail_Category, Subclass) ' \
-              '' \
-              'WHERE ' \
-              'sd.Sub_Account_Type = %(sub_account)s AND ' \
-              'sd.Despatch_Year = %(year)s AND ' \
-              'sd.Qtr = %(qtr)s AND ' \
-              'sd.Country_Code = %(customer)s ' \
-              '' \
-              'GROUP BY ' \
-              'sd.Operator, ' \
-              'sd.Origin, ' \
-              'sd.Destination, ' \
-              'sd.Mail_Category, ' \
-              'sd.Subclass, ' \
-              'rd.Rate_Ltr_Itm, ' \
-              'rd.Rate_Bulk_Itm, ' \
-              'rd.Rate_Ltr_Kg, ' \
-              'rd.Rate_Bulk_Kg ' \
-              '' \
-              'ORDER BY ' \
-              'sd.Operator, ' \
-              'sd.Origin, ' \
-              'sd.Destination, ' \
-              'sd.Mail_Category, ' \
-              'sd.Subclass;'
-
-        my_cursor.execute(sql, self.master.param_dict)
-        summary_body = my_cursor.fetchall()
+        # The exact total, rounded to the cent as it is printed on the invoice
+        self.total_due = round_decimal(summary_totals[-1], 2)
 
-        # The totals section underneath
-        sql = 'SELECT ' \
-              'FORMAT(SUM(sd.No_of_ItRates), 0), ' \
-              'FORMAT(SUM(sd.Weight_Kgs), 2), ' \
-              'FORMAT(SUM((rd.Rate_Ltr_Itm + rd.Rate_Bulk_Itm) * sd.No_of_ItRates), 2), ' \
-              'FORMAT(SUM((rd.Rate_Ltr_Kg + rd.Rate_Bulk_Kg) * sd.Weight_Kgs), 2), ' \
-              'CONCAT(\'$\', FORMAT(SUM((rd.Rate_Ltr_Itm + rd.Rate_Bulk_Itm) ' \
-              '* sd.No_of_ItRates + ' \
-              '(rd.Rate_Ltr_Kg + rd.Rate_Bulk_Kg) * sd.Weight_Kgs), 2)) ' \
-              '' \
-              'FROM sales_data sd ' \
-              '' \
-              'LEFT JOIN rates_data rd ' \
-              'USING (Despatch_Year, Operator, PL, Mail_Category, Subclass) ' \
-              '' \
-              'WHERE ' \
-              'sd.Sub_Account_Type = %(sub_account)s AND ' \
-              'sd.Despatch_Year = %(year)s AND ' \
-              'sd.Qtr = %(qtr)s AND ' \
-              'sd.Country_Code = %(customer)s ' \
-              '' \
-              'GROUP BY sd.Country_Code;'
-
-        my_cursor.execute(sql, self.master.param_dict)
-        summary_totals = my_cursor.fetchall()
-
-        cnx.close()
-
-        summary_body.append(summary_totals[0])
-
-        self.total_due = summary_body[-1][-1]
+        summary_body = format_rows(summary_body, self.summary_body_formats)
+        summary_body += format_rows([summary_totals], self.summary_totals_formats)
 
         return summary_body
 
@@ -288,105 +930,33 @@ class Customer:
         Will query the MySQL database and retrieve all necessary
         data to construct the detail invoice.
         Is a bit more complicated than the summary data method because the detail invoice
-        has so many subtotal rows.
-        :return: List containing tuples
+        has so many subtotal rows. The detail rows and the subtotal rows are retrieved together
+        in a single query, with the subtotal row sorted to the end of each rates combination.
+        If the detail rows are being streamed, nothing is retrieved yet. The rows are read from
+        the database as the detail invoice is rendered, and only the number of rows in each
+        rates combination is retrieved now, so that its pages can still be planned.
+        :return: List containing tuples, or a generator of them if streaming.
         """
-        cnx = mysql.connector.connect(user=self.master.user, password=self.master.password,
-                                      host=self.master.host, database=self.master.database_name)
-        my_cursor = cnx.cursor()
+        if self.master.stream_detail:
+            self.detail_groups = [row[0] for row in
+                                  self.master.customer_query('detail_groups',
+                                                             self.param_dict['customer'])]
+            return self._detail_lines()
 
-        # Starting off by getting a list of unique rates combinations for this customer
-        sql = 'SELECT DISTINCT ' \
-              'Origin,' \
-              'Destination,' \
-              'Mail_Category, ' \
-              'Subclass ' \
-              '' \
-              'FROM sales_data ' \
-              '' \
-              'WHERE ' \
-              'Sub_Account_Type = %(sub_account)s AND ' \
-              'Despatch_Year = %(year)s AND ' \
-              'Qtr = %(qtr)s AND ' \
-              'Country_Code = %(customer)s ' \
-              '' \
-              'ORDER BY ' \
-              'Origin, ' \
-              'Destination, ' \
-              'Mail_Category, ' \
-              'Subclass;'
-
-        my_cursor.execute(sql, self.master.param_dict)
-        unique_cb_list = my_cursor.fetchall()
-
-        # Looping through this new unique list and adding our results to the detail_list
-        detail_list = []
-
-        for row in unique_cb_list:
-            new_param_dict = {'origin': row[0],
-                              'destination': row[1],
-                              'mail_category': row[2],
-                              'subclass': row[3]}
-            new_param_dict.update(self.master.param_dict)
-
-            # Getting the bulk part of the detail invoice
-            sql = 'SELECT ' \
-                  'DATE_FORMAT(Despatch_Date, \'%Y-%m-%d\'), ' \
-                  'Origin, ' \
-                  'Destination, ' \
-                  'Mail_Category, ' \
-                  'Subclass, ' \
-                  'CONVERT(Serial_Number, CHAR), ' \
-                  'FORMAT(No_of_ItRates, 0), ' \
-                  'FORMAT(Weight_Kgs, 2) ' \
-                  '' \
-                  'FROM sales_data ' \
-                  '' \
-                  'WHERE ' \
-                  'Sub_Account_Type = %(sub_account)s AND ' \
-                  'Despatch_Year = %(year)s AND ' \
-                  'Qtr = %(qtr)s AND ' \
-                  'Country_Code = %(customer)s AND ' \
-                  'Origin = %(origin)s AND ' \
-                  'Destination = %(destination)s AND ' \
-                  'Mail_Category = %(mail_category)s AND ' \
-                  'Subclass = %(subclass)s ' \
-                  '' \
-                  'ORDER BY ' \
-                  'Origin, ' \
-                  'Destination, ' \
-                  'Mail_Category, ' \
-                  'Subclass, ' \
-                  'Serial_Number, ' \
-                  'Despatch_Date;'
-
-            my_cursor.execute(sql, new_param_dict)
-
-            for item in my_cursor.fetchall():
-                detail_list.append(item)
-
-            # Getting the totals for this bulk section
-            sql = 'SELECT ' \
-                  'FORMAT(SUM(No_of_ItRates), 0), ' \
-                  'FORMAT(SUM(Weight_Kgs), 2) ' \
-                  '' \
-                  'FROM sales_data ' \
-                  '' \
-                  'WHERE ' \
-                  'Sub_Account_Type = %(sub_account)s AND ' \
-                  'Despatch_Year = %(year)s AND ' \
-                  'Qtr = %(qtr)s AND ' \
-                  'Country_Code = %(customer)s AND ' \
-                  'Origin = %(origin)s AND ' \
-                  'Destination = %(destination)s AND ' \
-                  'Mail_Category = %(mail_category)s AND ' \
-                  'Subclass = %(subclass)s;'
-
-            my_cursor.execute(sql, new_param_dict)
-            detail_list.append(my_cursor.fetchall()[0])
+        return list(self._detail_lines())
 
-        cnx.close()
-        return detail_list
+    def _detail_lines(self):
+        """
+        Reads the detail rows and subtotal rows one at a time and formats them for the detail
+        invoice.
+        :return: Generator of tuples
+        """
+        for row in self.master.customer_stream('detail', self.param_dict['customer']):
+            # Totals rows only need the two summed columns
+            if row[8] == 1:
+                yield format_row(row[6:8], self.detail_totals_formats)
+            else:
+                yield format_row(row, self.detail_formats)
 
     def run_invoices(self):
         """
@@ -396,62 +966,284 @@ class Customer:
         """
         assert self.valid
 
-        # Summary Invoice
-        summary_invoice = SummaryInvoice(address=self.details['Physical_Address'],
-                                         quarter='Q' + str(self.master.param_dict['qtr']),
-                                         year=str(self.master.param_dict['year']),
-                                         sub_account=self.master.param_dict['sub_account'])
+        self.fetch_data()
+        self.render_invoices()
+        self.send_invoices()
 
-        for row in self._retrieve_summary_data():
-            summary_invoice.insert_line(row)
+    def fetch_data(self):
+        """
+        First stage of creating the invoices. Retrieves the data for both invoices from the
+        MySQL database and holds onto it until the invoices are rendered.
+        When resuming a run, nothing is fetched if both invoices were already saved.
+        :return: None
+        """
+        assert self.valid
+
+        if self._skip_status() is not None:
+            return
+
+        # Only the total from the earlier attempt is needed to send the email
+        if self._already_rendered('summary_rendered') and \
+                self._already_rendered('detail_rendered'):
+            self.total_due = Decimal(self.completed['fetched'])
+            return
+
+        # The detail data is fetched on another thread while the summary data is fetched here.
+        # Streamed detail rows are not read until the detail invoice is rendered.
+        if self.master.concurrent_invoices and not self.master.stream_detail:
+            with ThreadPoolExecutor(max_workers=1, thread_name_prefix='DETAIL FETCH') as executor:
+                detail_job = executor.submit(self._retrieve_detail_data)
+                self.summary_data = self._retrieve_summary_data()
+                self.detail_data = detail_job.result()
+        else:
+            self.summary_data = self._retrieve_summary_data()
+            self.detail_data = self._retrieve_detail_data()
+
+        self._record('fetched', str(self.total_due))
+
+    def render_invoices(self):
+        """
+        Second stage of creating the invoices. Creates both pdf invoices in memory from the
+        fetched data, and hands copies to the archive to be saved to the save location in the
+        background. The data is let go of once the invoices are rendered.
+        If there is a render pool, the summary invoice is rendered in one of its processes at
+        the same time as the detail invoice is rendered here. The detail data is by far the
+        bigger of the two, so it is not worth sending to another process and the rendered pdf
+        back again, and streamed detail rows can only be read in this process anyway.
+        When resuming a run, an invoice that was already saved is not rendered again.
+        :return: None
+        """
+        if self._skip_status() is not None:
+            return
 
         # The file name for saving the summary invoice
-        summary_file = '{}{} {} Summary Invoice Q{} {}.pdf'.format(
+        self.summary_file = '{}{} {} Summary Invoice Q{} {}.pdf'.format(
             self.master.save_location, self.details['Country_Name'],
-            self.master.param_dict['sub_account'], str(self.master.param_dict['qtr']),
-            str(self.master.param_dict['year']))
+            self.param_dict['sub_account'], str(self.param_dict['qtr']),
+            str(self.param_dict['year']))
 
-        summary_invoice.output(file_name=summary_file,
-                               company=self.master.prep_dict['company'],
-                               department=self.master.prep_dict['department'],
-                               name=self.master.prep_dict['officer'])
+        # The file name for saving the detail invoice, with the part number added to the end if
+        # it is split
+        self.detail_file = '{}{} {} Detail Invoice Q{} {}.pdf'.format(
+            self.master.save_location, self.details['Country_Name'],
+            self.param_dict['sub_account'], str(self.param_dict['qtr']),
+            str(self.param_dict['year']))
+
+        pool = self.master.render_pool
+        summary_job = None
+
+        if not self._already_rendered('summary_rendered'):
+            if pool is None:
+                with self.master.timer.time('summary render', self.param_dict['customer']):
+                    self.summary_pdf = self._render_summary()
+                self._archive(self.summary_file, self.summary_pdf, 'summary_rendered')
+            else:
+                summary_job = pool.submit(_render_in_process, 'summary render',
+                                          self.param_dict['customer'], render_summary,
+                                          *self._summary_args())
+
+        if self._already_rendered('detail_rendered'):
+            self.detail_files = self.completed['detail_rendered'].split('\n')
+        else:
+            with self.master.timer.time('detail render', self.param_dict['customer']):
+                self._render_detail()
 
-        del summary_invoice
+        if summary_job is not None:
+            self.summary_pdf = self._join(summary_job)
+            self._archive(self.summary_file, self.summary_pdf, 'summary_rendered')
 
-        # Detail Invoice
-        detail_invoice = DetailInvoice(customer=self.details['Country_Name'],
-                                       year=str(self.master.param_dict['year']),
-                                       quarter='Q' + str(self.master.param_dict['qtr']))
+        self.summary_data = None
+        self.detail_data = None
+        self.detail_groups = None
 
-        for row in self._retrieve_detail_data():
-            detail_invoice.insert_line(row)
+    def _archive(self, file_name, pdf, stage=None, detail=None, on_saved=None):
+        """
+        Hands a rendered invoice to the archive to be saved in the background, if the
+        archive_invoices setting is on. The invoice is only recorded in the run journal once it
+        has been saved, so that a resumed run can attach the saved file instead of rendering it
+        again.
+        :param file_name: The file to save the invoice to.
+        :param pdf: Bytes of the pdf.
+        :param stage: Either 'summary_rendered' or 'detail_rendered'. None to not record it,
+        such as for all but the last volume of a detail invoice.
+        :param detail: What to record with the stage. Defaults to the file name.
+        :param on_saved: Optional function to call once it has been saved, after it is recorded.
+        :return: None
+        """
+        if not self.master.archive_invoices:
+            return
 
-        # The file name for saving the detail invoice
-        detail_file = '{}{} {} Detail Invoice Q{} {}.pdf'.format(
-            self.master.save_location, self.details['Country_Name'],
-            self.master.param_dict['sub_account'], str(self.master.param_dict['qtr']),
-            str(self.master.param_dict['year']))
+        if stage is not None:
+            on_saved = partial(_after, partial(self._record, stage,
+                                               file_name if detail is None else detail), on_saved)
+
+        self.master.archive.save(file_name, pdf, on_saved, self.param_dict['customer'])
+
+    def _summary_args(self):
+        """
+        Puts together what the render_summary function needs.
+        :return: Tuple
+        """
+        assert self.summary_data is not None
+
+        return (self.summary_data, self.details['Physical_Address'], str(self.param_dict['year']),
+                'Q' + str(self.param_dict['qtr']), self.param_dict['sub_account'],
+                self.master.prep_dict['officer'], self.master.prep_dict['department'],
+                self.master.prep_dict['company'], self.master.output_profile)
+
+    def _render_summary(self):
+        """
+        Creates the summary invoice from the fetched data.
+        :return: Bytes of the pdf
+        """
+        return render_summary(*self._summary_args())
+
+    def _render_detail(self):
+        """
+        Creates the detail invoice from the fetched data, split into volumes if it reaches the
+        detail_volume_pages or detail_volume_mb settings. Each volume is handed to the archive
+        as soon as it is output, and kept in the detail_files and detail_pdfs attributes, see
+        _add_volume.
+        :return: None
+        """
+        assert self.detail_data is not None
+
+        self.detail_files = []
+        self.detail_pdfs = []
+
+        max_bytes = None
+        if self.master.detail_volume_mb is not None:
+            max_bytes = int(self.master.detail_volume_mb * 1024 ** 2)
+
+        detail_invoice = DetailVolumes(customer=self.details['Country_Name'],
+                                       year=str(self.param_dict['year']),
+                                       quarter='Q' + str(self.param_dict['qtr']),
+                                       max_pages=self.master.detail_volume_pages,
+                                       max_bytes=max_bytes, on_volume=self._add_volume,
+                                       profile=self.master.output_profile)
+
+        try:
+            detail_invoice.insert_lines(self.detail_data, self.detail_groups)
+        finally:
+            # Lets go of the database connection if the rows were being streamed and something
+            # went wrong part of the way through
+            if hasattr(self.detail_data, 'close'):
+                self.detail_data.close()
+
+        detail_invoice.finish()
+
+    def _join(self, job):
+        """
+        Waits for an invoice being rendered in the render pool, and adds the time it took there
+        to the run's timings.
+        :param job: Future of _render_in_process.
+        :return: What the render function returned.
+        """
+        result, timings = job.result()
+        self.master.timer.extend(timings)
+
+        return result
+
+    def _add_volume(self, part, pdf, last):
+        """
+        Keeps a volume of the detail invoice and hands it to the archive. The detail invoice is
+        recorded in the run journal with every volume's file name once the last one is saved.
+        Once a volume of a split invoice has been saved, its bytes are let go of, and it is
+        attached to its email from the saved file instead, so that the volumes are not all held
+        in memory until they are sent.
+        :param part: The part number, or None if the invoice was not split.
+        :param pdf: Bytes of the pdf.
+        :param last: Whether it is the last volume.
+        :return: None
+        """
+        if part is None:
+            file_name = self.detail_file
+        else:
+            file_name = '{} Part {}.pdf'.format(os.path.splitext(self.detail_file)[0], part)
+
+        self.detail_files.append(file_name)
+        self.detail_pdfs.append(pdf)
+
+        on_saved = None
+        if part is not None:
+            on_saved = partial(_forget_pdf, self.detail_pdfs, len(self.detail_pdfs) - 1)
 
-        detail_invoice.output(detail_file)
+        if last:
+            self._archive(file_name, pdf, 'detail_rendered', '\n'.join(self.detail_files),
+                          on_saved)
+        else:
+            self._archive(file_name, pdf, on_saved=on_saved)
 
-        del detail_invoice
+    def _skip_status(self):
+        """
+        Checks whether the invoices for this customer do not need to be created at all, either
+        because they were already emailed earlier in this run, or because the data behind them
+        has not changed since they were last emailed.
+        :return: The status to log if the customer should be skipped, otherwise None.
+        """
+        if 'emailed' in self.completed:
+            return 'Invoices were already emailed to {} in run {}.\n'.format(
+                self.completed['emailed'], self.master.journal.run_id)
 
-        # Sending the email
+        if self.unchanged_since is not None:
+            return 'Data unchanged since run {}, so invoices were not created or sent.\n' \
+                .format(self.unchanged_since)
 
-        # Total_less_coms removes the commas and dollar sign
-        # This is so we can run the number name function on the total amount due and include
-        # this text in the email to customers.
-        total_less_coms = self.total_due.replace(',', '')[1::]
-        first_num = number_name(int(total_less_coms.split('.')[0]))
-        second_num = total_less_coms.split('.')[1].lstrip('0')
+        return None
 
-        if second_num == '':
+    def _already_rendered(self, stage):
+        """
+        Checks the run journal for whether an invoice was saved by an earlier attempt at
+        this run, and that the files are still there.
+        :param stage: Either 'summary_rendered' or 'detail_rendered'.
+        :return: Boolean
+        """
+        return 'fetched' in self.completed and stage in self.completed and \
+            all([os.path.exists(x) for x in self.completed[stage].split('\n')])
+
+    def _record(self, stage, detail=None):
+        """
+        Records in the run journal that this customer has finished a stage, if the run
+        is being journaled.
+        :param stage: One of the stages of the RunJournal class.
+        :param detail: Optional string to keep with the stage.
+        :return: None
+        """
+        if self.master.journal is not None:
+            self.master.journal.record(self.param_dict['customer'], stage, detail)
+
+    def send_invoices(self):
+        """
+        Final stage of creating the invoices. Emails the rendered invoices to the customer and
+        records the outcome in the status attribute.
+        A detail invoice that was split into volumes is sent over several emails, so that no
+        one email has all of them, see _email_batches. The first email also has
+        the summary invoice, and if one of them cannot be sent the rest are not tried. Each one
+        that is sent is recorded in the run journal, with the invoices it had, so that a resumed
+        run only sends the invoices that were not sent yet.
+        When resuming a run, customers that were already emailed are not emailed again, and
+        neither are customers skipped because their data has not changed.
+        :return: None
+        """
+        if self._skip_status() is not None:
+            self.status = self._skip_status()
+            return
+
+        assert self.summary_file is not None and self.detail_files is not None
+
+        # Splitting the total amount due into dollars and cents, so we can run the number name
+        # function on them and include this text in the email to customers.
+        dollars = int(self.total_due)
+        cents = int(abs(self.total_due - dollars) * 100)
+        first_num = number_name(dollars)
+
+        if cents == 0:
             total_as_string = 'The total amount due is {} - {} dollars' \
-                .format(self.total_due, first_num)
+                .format(format_money(self.total_due), first_num)
         else:
-            second_num = number_name(int(second_num))
+            second_num = number_name(cents)
             total_as_string = 'The total amount due is {} - {} dollars and {} cents' \
-                .format(self.total_due, first_num, second_num)
+                .format(format_money(self.total_due), first_num, second_num)
 
         email_message = 'Hello,\n\nPlease find your invoice attached.\n\n' \
                         '{}.\n\n' \
@@ -459,25 +1251,121 @@ class Customer:
                         .format(total_as_string, self.master.prep_dict['officer'])
 
         email_subject = '{} Invoices Q{} {} From {}'.format(self.details['Country_Name'],
-                                                            str(self.master.param_dict['qtr']),
-                                                            str(self.master.param_dict['year']),
+                                                            str(self.param_dict['qtr']),
+                                                            str(self.param_dict['year']),
                                                             self.master.prep_dict['company'])
 
-        self.status = send_email_365(email_recipient=self.details['Email_Address'],
-                                     email_subject=email_subject,
-                                     email_message=email_message,
-                                     email_sender=self.master.prep_dict['email_sender'],
-                                     email_password=self.master.prep_dict['email_password'],
-                                     attachments=(summary_file, detail_file))[1]
+        # The emails of a split invoice already sent by an earlier attempt at the run, and the
+        # invoices they had
+        sent_emails = 0
+        sent_files = []
+        statuses = []
+        if 'emails_sent' in self.completed:
+            sent = self.completed['emails_sent'].split('\n')
+            sent_emails = int(sent[0])
+            sent_files = sent[1:]
+            statuses.append('{} email(s) were already sent in run {}.\n'
+                            .format(sent_emails, self.master.journal.run_id))
+
+        batches = self._email_batches(sent_files)
+        emails = sent_emails + len(batches)
+
+        for num, attachments in enumerate(batches, sent_emails + 1):
+            subject = email_subject
+            if emails > 1:
+                subject += ' ({} of {})'.format(num, emails)
+
+            self.valid, status = send_email_365(
+                email_recipient=self.details['Email_Address'],
+                email_subject=subject,
+                email_message=email_message,
+                email_sender=self.master.prep_dict['email_sender'],
+                email_password=self.master.prep_dict['email_password'],
+                attachments=attachments,
+                timer=partial(self.master.timer.time, customer=self.param_dict['customer']),
+                **self.master.smtp_dict)
+            statuses.append(status)
+
+            if not self.valid:
+                break
+
+            if emails > 1:
+                sent_files += [_attachment_name(x) for x in attachments]
+                self._record('emails_sent', '\n'.join([str(num)] + sent_files))
+
+        self.status = ''.join(statuses)
+        self.summary_pdf = None
+        self.detail_pdfs = None
+
+        if self.valid:
+            self._record('emailed', self.details['Email_Address'])
+
+            if self.master.journal is not None and self.fingerprint is not None:
+                self.master.journal.save_fingerprint(self.param_dict['customer'],
+                                                     self.master.quarter_key, self.fingerprint)
+
+    def _email_batches(self, sent_files=()):
+        """
+        Shares the invoices out between the emails to send. An invoice that was not split goes
+        in one email with the summary invoice. The volumes of a split one are sent one to an
+        email, or, with the email_max_mb setting, as many to an email as fit in that many
+        megabytes of attachments, before they are encoded. An email always has at least one
+        volume, even if it is bigger than that on its own.
+        Invoices still held in memory are attached straight from it, and those already saved,
+        whether by this attempt or an earlier attempt at the run, are attached from their files.
+        :param sent_files: The file names of invoices already sent, which are left out.
+        :return: List of tuples of attachments, see send_email_365.
+        """
+        # Taking a copy, as the volumes are let go of as they are saved in the background
+        detail_pdfs = list(self.detail_pdfs or [None] * len(self.detail_files))
+        attachments = [file_name if pdf is None else (file_name, pdf) for file_name, pdf in
+                       [(self.summary_file, self.summary_pdf)] +
+                       list(zip(self.detail_files, detail_pdfs))
+                       if file_name not in sent_files]
+
+        if len(self.detail_files) == 1:
+            return [tuple(attachments)]
+
+        max_bytes = 0
+        if self.master.email_max_mb is not None:
+            max_bytes = self.master.email_max_mb * 1024 ** 2
+
+        batches = []
+        size = 0
+        volumes = 0
+
+        # The summary invoice, if it is still to be sent, goes in with the first volume
+        for attachment in attachments:
+            if not batches or (volumes and size + _attachment_size(attachment) > max_bytes):
+                batches.append([])
+                size = 0
+                volumes = 0
+
+            batches[-1].append(attachment)
+            size += _attachment_size(attachment)
+            if _attachment_name(attachment) != self.summary_file:
+                volumes += 1
+
+        return [tuple(batch) for batch in batches]
+
+    def log_message(self):
+        """
+        Puts together the text describing the status of the customer that goes into the logs.
+        This text may include whether or not the email failed for instance, or if there were rates
+        issues found.
+        :return: String
+        """
+        if self.status is None:
+            return issues_message(self.rates_issues, self.details)
 
-        self.valid = self.status[0]
+        return self.status
 
     def log_status(self, cnt=1, file_name=None):
         """
         This method is used for logging the status of the customer to a txt file.
-        This text may include whether or not the email failed for instance, or if there were rates
-        issues found. The log will be appended to a file if it already exists, and will create a
-        new file otherwise.
+        The log will be appended to a file if it already exists, and will create a
+        new file otherwise. The file is opened and closed again for each call, so a whole run is
+        logged with a RunLog instead, which keeps the log files open.
         :param cnt: The number that will appear at the start of the log. Useful when logging
         many items into the same file.
         :param file_name: What txt file to log to. Will use the master date as the file name
@@ -488,85 +1376,540 @@ class Customer:
             file_name = '{}{}.txt'.format(self.master.log_location,
                                           self.master.date_stamp)
 
-        if self.status is None:
-            log_message = 'No files created and no emails sent.\n'
+        with open(file_name, 'a+') as log_file:
+            print('{}. {}\n{}'.format(cnt, self.param_dict['customer'],
+                                      self.log_message()), file=log_file)
+
+
+def render_summary(summary_data, address, year, quarter, sub_account, name, department,
+                   company, profile='standard'):
+    """
+    Creates a summary invoice. Kept outside of the Customer class so that it can be run in
+    another process, see the render_pool attribute of the Params class.
+    :param summary_data: List of tuples of strings, see Customer._retrieve_summary_data.
+    :param address: The customer's address.
+    :param year: Year string printed on the invoice.
+    :param quarter: Quarter string printed on the invoice, such as Q1.
+    :param sub_account: Sub account string printed on the invoice.
+    :param name: The processing officer, for the ending tag.
+    :param department: The department, for the ending tag.
+    :param company: The company, for the ending tag.
+    :param profile: How the pdf is output, one of the names in output_profiles.
+    :return: Bytes of the pdf
+    """
+    summary_invoice = SummaryInvoice(address=address, quarter=quarter, year=year,
+                                     sub_account=sub_account, profile=profile)
+
+    summary_invoice.insert_lines(summary_data)
+
+    return summary_invoice.output(file_name=None, company=company, department=department,
+                                  name=name)
+
+
+def _render_in_process(stage, customer, function, *args):
+    """
+    Runs one of the render functions in a process of the render pool, timing it there.
+    :param stage: Name of the stage for the timings, such as 'summary render'.
+    :param customer: The Country_Code of the customer.
+    :param function: The render function, such as render_summary.
+    :param args: What to call the function with.
+    :return: Tuple of what the function returned and the list of timing records.
+    """
+    timer = RunTimer()
+
+    with timer.time(stage, customer):
+        result = function(*args)
+
+    return result, timer.take()
+
+
+def _after(first, second):
+    """
+    Calls one function and then another, for when the archive can only be given one.
+    :param first: Function to call first.
+    :param second: Function to call next, or None.
+    :return: None
+    """
+    first()
+
+    if second is not None:
+        second()
+
+
+def _forget_pdf(pdfs, index):
+    """
+    Lets go of the bytes of an invoice once it has been saved, so it is attached from the file.
+    The list is passed in, rather than looked up on the customer, as it may have been let go of
+    as a whole by the time the invoice is saved.
+    :param pdfs: List of the bytes of the invoices, such as Customer.detail_pdfs.
+    :param index: Where the invoice is in the list.
+    :return: None
+    """
+    pdfs[index] = None
+
+
+def _attachment_name(attachment):
+    """
+    The file name of an email attachment.
+    :param attachment: A file name, or a tuple of a file name and the bytes of the file, as for
+    send_email_365.
+    :return: String
+    """
+    if isinstance(attachment, tuple):
+        return attachment[0]
+
+    return attachment
+
+
+def _attachment_size(attachment):
+    """
+    Works out the size of an email attachment.
+    :param attachment: A file name, or a tuple of a file name and the bytes of the file, as for
+    send_email_365.
+    :return: The number of bytes.
+    """
+    if isinstance(attachment, tuple):
+        return len(attachment[1])
+
+    return os.path.getsize(attachment)
+
+
+def issues_message(rates_issues, details):
+    """
+    Puts together the text describing why a customer's invoices could not be created, for the
+    logs and the validation report.
+    :param rates_issues: Tuple of the customer's missing rate references.
+    :param details: Dictionary of the customer's Country_Name, Physical_Address, Email_Address.
+    :return: String
+    """
+    message = 'No files created and no emails sent.\n'
+
+    if len(rates_issues) > 0:
+        message += '\n{} rate(s) issues were found:\n'.format(len(rates_issues))
+
+        for num, rate in enumerate(rates_issues):
+            message += '\t{}. {}\n'.format(num + 1, rate)
 
-            if len(self.rates_issues) > 0:
-                log_message += '\n{} rate(s) issues were found:\n'.format(len(self.rates_issues))
+    if None in details.values():
+        message += '\nCustomer address issue(s) found.\n'
+        message += '\tName: {}\n'.format(details['Country_Name'])
+        message += '\tAddress: {}\n'.format(details['Physical_Address'])
+        message += '\tEmail: {}\n'.format(details['Email_Address'])
 
-                for num, rate in enumerate(self.rates_issues):
-                    log_message += '\t{}. {}\n'.format(num + 1, rate)
+    return message
 
-            if None in self.details.values():
-                log_message += '\nCustomer address issue(s) found.\n'
-                log_message += '\tName: {}\n'.format(self.details['Country_Name'])
-                log_message += '\tAddress: {}\n'.format(self.details['Physical_Address'])
-                log_message += '\tEmail: {}\n'.format(self.details['Email_Address'])
 
+def process_customer(params, customer_code):
+    """
+    Creates and emails the invoices for a single customer.
+    Any error raised while creating the invoices is caught and recorded in the result, so that
+    one bad customer does not stop the rest of the run.
+    :param params: An instance of the Params class.
+    :param customer_code: The Country_Code of the customer.
+    :return: Dictionary containing the customer, the log message and whether it is an error.
+    """
+    customer = Customer(params, customer_code)
+
+    if customer.valid:
+        try:
+            customer.run_invoices()
+        except Exception as err:
+            customer.status = 'The following error occurred:\n{}.\n'.format(err)
+            error = True
         else:
-            log_message = self.status
+            error = False
+    else:
+        error = True
 
-        with open(file_name, 'a+') as log_file:
-            print('{}. {}\n{}'.format(cnt, self.master.param_dict['customer'],
-                                      log_message), file=log_file)
+    return {'customer': customer_code,
+            'message': customer.log_message(),
+            'error': error}
+
+
+# The Params instance belonging to a worker process, see _init_worker
+_worker_params = None
+
+
+def _init_worker(params):
+    """
+    Runs once in each worker process of the process pool. Each worker gets its own copy of the
+    parameters, which will create its own connection pool when the first query is run.
+    :param params: An instance of the Params class.
+    :return: None
+    """
+    global _worker_params
+    # Workers started by forking are handed the main process's objects as they are, open
+    # connections and all, so the parameters are always put through pickling to get a clean copy
+    _worker_params = pickle.loads(pickle.dumps(params))
+
+
+def _process_customer_in_worker(customer_code):
+    """
+    Calls process_customer in a worker process and adds the worker's database counters,
+    timings and archived invoices to the result, so that the main process can total them up for
+    the run log. The worker waits for its invoices to be saved before moving on, as the
+    background thread saving them would not survive the worker being shut down.
+    :param customer_code: The Country_Code of the customer.
+    :return: Dictionary, see process_customer.
+    """
+    queries_before = _worker_params.query_count
+    result = process_customer(_worker_params, customer_code)
+    result['query_count'] = _worker_params.query_count - queries_before
+    result['connection_ids'] = set(_worker_params.connection_ids)
+    result['timings'] = _worker_params.timer.take()
+    _worker_params.archive.wait()
+    result['archived'] = _worker_params.archive.take()
+    return result
+
+
+def parse_args(argv=None):
+    """
+    Reads the command line options for the process.
+    :param argv: List of strings to parse. Will use sys.argv if none provided.
+    :return: argparse Namespace
+    """
+    parser = argparse.ArgumentParser(description='Creates and emails invoices for a quarter.')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='load the whole quarter with a few bulk queries at the start '
+                             'instead of querying once per customer')
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help='number of worker processes creating invoices at once')
+    parser.add_argument('--resume', metavar='RUN_ID',
+                        help='carry on with an earlier run, skipping the work it already did')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip customers whose data has not changed since their invoices '
+                             'were last emailed for this quarter')
+    parser.add_argument('--stream-detail', action='store_true',
+                        help='read the detail rows a batch at a time while the detail invoice '
+                             'is rendered instead of holding them all in memory')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='run the fetch, render and send stages concurrently')
+    parser.add_argument('--concurrent-invoices', action='store_true',
+                        help="fetch each customer's summary and detail data at the same time, "
+                             'and render the summary invoice in another process while the '
+                             'detail invoice is rendered')
+    parser.add_argument('--output-profile', choices=list(output_profiles),
+                        help='how the pdf invoices are compressed and written, overriding the '
+                             'output_profile setting')
+    parser.add_argument('--fetch-workers', type=int, default=2, metavar='N',
+                        help='pipeline threads fetching data from the database')
+    parser.add_argument('--render-workers', type=int, default=1, metavar='N',
+                        help='pipeline threads rendering pdf invoices')
+    parser.add_argument('--send-workers', type=int, default=2, metavar='N',
+                        help='pipeline threads sending emails')
+    parser.add_argument('--queue-size', type=int, default=4, metavar='N',
+                        help='most customers that can wait between two pipeline stages')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the run with cProfile and save the stats next to the logs')
+    parser.add_argument('--schedule', choices=['largest-first', 'alphabetical'],
+                        default='largest-first',
+                        help='order customers are handed out in with --pipeline or --workers')
+    parser.add_argument('--shard', type=parse_shard, metavar='K/N',
+                        help='only invoice shard K of N, such as 3/8, to split the run across '
+                             'N machines')
+    parser.add_argument('--shard-by', choices=shard_methods, default='hash',
+                        help='split customers by a hash of their code, or balance the shards '
+                             'by their number of sales rows')
+    parser.add_argument('--merge-shards', nargs='+', metavar='RESULTS',
+                        help='merge the results files of every shard into one set of logs and '
+                             'email the process manager')
+
+    args = parser.parse_args(argv)
+
+    if args.pipeline and args.workers > 1:
+        parser.error('--pipeline and --workers cannot be used together')
+
+    # Worker processes already render customers side by side, and cannot start processes of
+    # their own that would be shut down cleanly
+    if args.concurrent_invoices and args.workers > 1:
+        parser.error('--concurrent-invoices and --workers cannot be used together')
+
+    # cProfile only sees the thread it was started in
+    if args.profile and (args.pipeline or args.workers > 1):
+        parser.error('--profile cannot be used with --pipeline or --workers')
+
+    if args.merge_shards is not None and args.shard is not None:
+        parser.error('--merge-shards and --shard cannot be used together')
+
+    return args
+
+
+def email_manager(params, err_num, attachments):
+    """
+    Emails the process manager about the errors in a run.
+    :param params: An instance of the Params class.
+    :param err_num: The number of customers with errors.
+    :param attachments: Tuple of the files to attach, such as the error log.
+    :return: None
+    """
+    err_subject = '{} errors encountered - Python Invoice Creation'\
+                  .format(number_name(err_num).capitalize())
+    err_message = '{}({}) errors have been encountered during the creation of invoices.\n\n' \
+                  'Please review attached file.'\
+                  .format(number_name(err_num).capitalize(), err_num)
+
+    send_email_365(email_recipient=params.manager_email, email_subject=err_subject,
+                   email_message=err_message, email_sender=params.prep_dict['email_sender'],
+                   email_password=params.prep_dict['email_password'],
+                   attachments=attachments, **params.smtp_dict)
 
 
-def main():
+def merge_shards(file_names):
+    """
+    Merges the results of every shard of a run into one full log, error log and validation
+    report, and emails the process manager once if any shard had errors.
+    :param file_names: List of the results JSON files written by each shard.
+    :return: None
+    """
+    params = Params(load_customers=False)
+
+    try:
+        shards = load_results(file_names)
+    except ValueError as err:
+        raise SystemExit(err)
+
+    full_log = '{}{} Merged Full Log.txt'.format(params.log_location, params.date_stamp)
+    err_log = '{}{} Merged Error Log.txt'.format(params.log_location, params.date_stamp)
+    valid_report = '{}{} Merged Validation Report.txt'.format(params.log_location,
+                                                              params.date_stamp)
+
+    err_num = merge_logs(shards, full_log, err_log, valid_report)
+
+    if err_num > 0:
+        email_manager(params, err_num, (err_log, valid_report))
+
+
+def main(argv=None):
     """
     Will run the full process.
     Appends a count of the time the process took onto the end of the log file.
     Will email the process manager if errors are present.
+    :param argv: Command line options, see parse_args.
     """
     start_time = time.perf_counter()
 
+    args = parse_args(argv)
+
+    if args.merge_shards is not None:
+        merge_shards(args.merge_shards)
+        return
+
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
     params = Params()
 
-    err_num = 0
+    # Checked before anything is started, so a run cannot fail on every customer instead
+    if args.output_profile is not None:
+        params.output_profile = args.output_profile
+    try:
+        check_profile(params.output_profile)
+    except (ValueError, ImportError) as err:
+        raise SystemExit('{}.'.format(err))
+
+    # Only the customers in this shard are invoiced, and the shard is added to the date stamp
+    # so that its logs and journal run ID cannot clash with the other shards
+    sizes = None
+    if args.shard is not None:
+        sizes = params.customer_sizes()
+        row_counts = {customer: size[0] for customer, size in sizes.items()}
+        params.customers = shard_customers(params.customers, *args.shard,
+                                           row_counts if args.shard_by == 'rows' else None)
+        shard_rows = sum([row_counts.get(x, 0) for x in params.customers])
+        params.date_stamp += ' Shard {} of {}'.format(*args.shard)
+
+    # Each run is journaled under its date stamp unless an earlier run is being resumed
+    if args.resume is None:
+        params.journal = RunJournal(params.journal_location, params.date_stamp)
+    else:
+        params.journal = RunJournal(params.journal_location, args.resume)
+        if not params.journal.run_exists():
+            raise SystemExit('Run {} was not found in {}.'.format(args.resume,
+                                                                  params.journal_location))
+
+    params.incremental = args.incremental
+    params.stream_detail = args.stream_detail
+    params.concurrent_invoices = args.concurrent_invoices
+    params.load_fingerprints()
+
+    # Checking every customer's rates and address up front
+    valid_report = '{}{} Validation Report.txt'.format(params.log_location, params.date_stamp)
+    invalid_num = params.validate_quarter(valid_report)
+
+    # Making sure the rollup table is up to date before any summaries are read from it
+    summary_status = None
+    if params.use_quarter_summary:
+        summary_status = params.check_quarter_summary()
+
+    prefetch_status = None
+    if args.prefetch:
+        prefetch_status = params.prefetch_quarter()
+
+    # What happened to each customer, kept for the results file when the run is sharded
+    entries = []
     # Full log will contain everything, error log will just contain errors
     full_log = '{}{} Full Log.txt'.format(params.log_location, params.date_stamp)
     err_log = '{}{} Error Log.txt'.format(params.log_location, params.date_stamp)
+    jsonl_log = None
+    if params.log_jsonl:
+        jsonl_log = '{}{} Full Log.jsonl'.format(params.log_location, params.date_stamp)
+
+    # Parallel runs hand out the most expensive customers first, so that a big customer is not
+    # left running on its own at the end of the run
+    costs = None
+    order = params.customers
+    if args.pipeline or args.workers > 1:
+        if sizes is None:
+            sizes = params.customer_sizes()
+        costs = {x: params.estimate_cost(*sizes.get(x, (0, 0))) for x in params.customers}
+        if args.schedule == 'largest-first':
+            order = lpt_order(params.customers, costs)
+
+    # A render process for each customer being rendered at once
+    if args.concurrent_invoices:
+        params.render_pool = ProcessPoolExecutor(
+            max_workers=args.render_workers if args.pipeline else 1)
 
     # Attempting to create invoices for each customer
-    for num, item in enumerate(params.customers):
-        params.param_dict['customer'] = item
-        customer = Customer(params)
-
-        if customer.valid:
-
-            try:
-                customer.run_invoices()
-            except Exception as err:
-                customer.status = 'The following error occurred:\n{}.\n'.format(err)
-                err_num += 1
-                customer.log_status(cnt=err_num, file_name=err_log)
-
-            customer.log_status(cnt=num+1, file_name=full_log)
-
-        else:
-            customer.log_status(cnt=num+1, file_name=full_log)
-            err_num += 1
-            customer.log_status(cnt=err_num, file_name=err_log)
+    pipeline = None
+    if args.pipeline:
+        executor = None
+        pipeline = InvoicePipeline(partial(Customer, params),
+                                   fetch_workers=args.fetch_workers,
+                                   render_workers=args.render_workers,
+                                   send_workers=args.send_workers,
+                                   queue_size=args.queue_size)
+        results = in_order(pipeline.run(order), params.customers)
+    elif args.workers > 1:
+        executor = ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                                       initargs=(params,))
+        # Map hands back the results in the order the customers were handed out
+        results = in_order(executor.map(_process_customer_in_worker, order), params.customers)
+    else:
+        executor = None
+        results = (process_customer(params, item) for item in params.customers)
+
+    run_log = RunLog(full_log, err_log, jsonl_log, params.log_flush_seconds)
+
+    for result in results:
+        run_log.customer(result)
+
+        if args.shard is not None:
+            entries.append({'customer': result['customer'],
+                            'message': result['message'],
+                            'error': result['error']})
+
+        if executor is not None:
+            params.query_count += result['query_count']
+            params.connection_ids.update(result['connection_ids'])
+            params.timer.extend(result['timings'])
+            params.archive.extend(result['archived'])
+
+    if executor is not None:
+        executor.shutdown()
+
+    if params.render_pool is not None:
+        params.render_pool.shutdown()
+
+    # Waiting for the last of the invoices to be saved
+    params.archive.wait()
+
+    # An invoice that could not be saved is an error of its customer's, as it was emailed but
+    # there is no copy of it in the save location. A shard's results are merged later, so the
+    # customer's entry is marked instead.
+    for customer, failures in params.archive.failures().items():
+        message = 'Invoices were emailed, but could not all be saved to {}:\n{}\n' \
+            .format(params.save_location, '\n'.join(failures))
+        run_log.error(customer, message)
+
+        for entry in entries:
+            if entry['customer'] == customer:
+                entry['error'] = True
+                entry['message'] += message
+
+    if profiler is not None:
+        profiler.disable()
+        profile_file = '{}{} Profile.prof'.format(params.log_location, params.date_stamp)
+        profiler.dump_stats(profile_file)
+
+    # Every timing recorded during the run, one JSON object per line
+    timings_file = '{}{} Timings.jsonl'.format(params.log_location, params.date_stamp)
+    params.timer.write(timings_file)
 
     # Append the elapsed time
-    elapsed_time = time.perf_counter() - start_time
-    elapsed_time = time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
-
-    with open(full_log, 'a+') as log_file:
-        print('=' * 100, end='\n\n', file=log_file)
-        print('ELAPSED TIME (Hours, Mins, Secs): {}.'.format(elapsed_time), file=log_file)
-
-    # Send email to process manager if errors
-    if err_num > 0:
-
-        err_subject = '{} errors encountered - Python Invoice Creation'\
-                      .format(number_name(err_num).capitalize())
-        err_message = '{}({}) errors have been encountered during the creation of invoices.\n\n' \
-                      'Please review attached file.'\
-                      .format(number_name(err_num).capitalize(), err_num)
-
-        send_email_365(email_recipient=params.manager_email, email_subject=err_subject,
-                       email_message=err_message, email_sender=params.prep_dict['email_sender'],
-                       email_password=params.prep_dict['email_password'], attachments=(err_log,))
+    elapsed_seconds = time.perf_counter() - start_time
+    elapsed_time = time.strftime("%H:%M:%S", time.gmtime(elapsed_seconds))
+
+    # The outcome of the shard, for merging with the other shards once they have all finished
+    if args.shard is not None:
+        results_file = '{}{} Results.json'.format(params.log_location, params.date_stamp)
+        with open(valid_report) as report:
+            validation = report.read()
+        write_results(results_file, {'shard': args.shard[0],
+                                     'count': args.shard[1],
+                                     'quarter': params.quarter_key,
+                                     'run_id': params.journal.run_id,
+                                     'customers': len(params.customers),
+                                     'rows': shard_rows,
+                                     'elapsed_seconds': round(elapsed_seconds, 3),
+                                     'validation': validation,
+                                     'entries': entries})
+
+    run_log.write('=' * 100 + '\n')
+    run_log.write('ELAPSED TIME (Hours, Mins, Secs): {}.'.format(elapsed_time))
+    run_log.write('VALIDATION: {} of {} customer(s) could not be invoiced, see {}.'
+                  .format(invalid_num, len(params.customers), os.path.basename(valid_report)))
+    if args.resume is None:
+        run_log.write('RUN ID: {}.'.format(params.journal.run_id))
+    else:
+        run_log.write('RUN ID: {} (resumed).'.format(params.journal.run_id))
+    if args.shard is not None:
+        run_log.write('SHARD: {} of {}, split by {}. {} customer(s), {:,} sales row(s). '
+                      'Results saved to {}, merge them with --merge-shards to email the '
+                      'process manager.'.format(args.shard[0], args.shard[1], args.shard_by,
+                                                len(params.customers), shard_rows,
+                                                os.path.basename(results_file)))
+    if summary_status is not None:
+        run_log.write('QUARTER SUMMARY: {}'.format(summary_status))
+    if prefetch_status is not None:
+        run_log.write('PREFETCH: {}'.format(prefetch_status))
+    if pipeline is not None:
+        for line in pipeline.report():
+            run_log.write('PIPELINE {}'.format(line))
+    if costs is not None:
+        run_log.write('SCHEDULE: {}, {} customer(s).'.format(args.schedule, len(order)))
+        for line in schedule_report(params.customers, order, costs,
+                                    params.timer.customer_totals(),
+                                    args.render_workers if args.pipeline else args.workers):
+            run_log.write('SCHEDULE {}'.format(line))
+    if params.archive_invoices:
+        archive_lines = params.archive.summary()
+        run_log.write('ARCHIVE: {}'.format(archive_lines[0]))
+        for line in archive_lines[1:]:
+            run_log.write('ARCHIVE {}'.format(line))
+    run_log.write('DATABASE CONNECTIONS OPENED: {} (pool size {}). QUERIES RUN: {}.'
+                  .format(len(params.connection_ids), params.pool_size, params.query_count))
+    run_log.write('TIMINGS: saved to {}.'.format(os.path.basename(timings_file)))
+    for line in params.timer.summary():
+        run_log.write('TIMING {}'.format(line))
+    if profiler is not None:
+        run_log.write('PROFILE: saved to {}, view it with python -m pstats.'
+                      .format(os.path.basename(profile_file)))
+
+    # The last line of the JSON lines log sums up the run
+    run_log.record({'run_id': params.journal.run_id,
+                    'quarter': params.quarter_key,
+                    'customers': run_log.count,
+                    'errors': run_log.err_num,
+                    'invalid': invalid_num,
+                    'elapsed_seconds': round(elapsed_seconds, 3)})
+    run_log.close()
+
+    # Send email to process manager if errors. Shards leave this to the merge.
+    if run_log.err_num > 0 and args.shard is None:
+        email_manager(params, run_log.err_num, (err_log, valid_report))
 
 
 if __name__ == '__main__':
@@ -3,14 +3,325 @@ Invoice PDF Objects - contains two classes for creating PDF invoices using PyFPD
 Objects have been designed for specific automated process in invoice_creation.py.
 """
 
+import importlib.util
+import io
+import itertools
+import zlib
 from datetime import datetime
+from decimal import Decimal
 from fpdf import FPDF
 
+from pagination import group_sizes, plan_pages
 
-class SummaryInvoice(FPDF):
+# The ways an invoice can be output, from the fastest to write to the smallest.
+# compression: The zlib level the page contents are compressed with, -1 for zlib's default
+# (which is what PyFPDF uses), or None to not compress them. Level 9 came out no smaller than
+# the default on the invoices, and took a fifth longer, as the pages are so alike already.
+# shared_header: Whether the header is written once, as a form that every page draws, instead
+# of onto every page. Only works when the header is cached, see InvoiceDocument.header.
+# linearize: Whether the pdf is rewritten by pikepdf (which has to be installed) to be
+# linearized, so it can be shown before it has finished downloading, with its objects packed
+# into compressed object streams.
+output_profiles = {'fast': {'compression': None, 'shared_header': False, 'linearize': False},
+                   'standard': {'compression': -1, 'shared_header': False, 'linearize': False},
+                   'small': {'compression': -1, 'shared_header': True, 'linearize': False},
+                   'linearized': {'compression': -1, 'shared_header': True, 'linearize': True}}
+
+
+class OutputBuffer:
     """
-    Class for the creation of summary style invoices.
+    Stands in for the string PyFPDF builds the finished pdf up in. PyFPDF adds every line onto
+    the end of the string, which copies everything written so far each time, so outputting an
+    invoice of thousands of pages took far longer than rendering it. The lines are kept in a
+    list instead and only joined once, when the pdf is asked for.
+    """
+
+    def __init__(self):
+        """
+        Initialise class
+        """
+        self.parts = []
+        self.length = 0
+
+    def __iadd__(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+        return self
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        joined = ''.join(self.parts)
+        self.parts = [joined]
+        return joined
+
+    def encode(self, *args):
+        """
+        Joins the lines and encodes them, in the same way as str.encode.
+        :return: Bytes
+        """
+        return str(self).encode(*args)
+
+
+class InvoiceDocument(FPDF):
+    """
+    What the summary and detail invoices have in common, which is how the header is drawn, how
+    the pages are planned and how the pdf is output.
     Inherits from the imported PyFPDF class.
+    """
+
+    # Whether the header is drawn once and copied onto later pages, see the header method
+    cache_header = True
+
+    # What the header changes about the position, font and colours, which is put back as the
+    # header would leave it when the header is copied onto a page
+    header_state = ('x', 'y', 'lasth', 'font_family', 'font_style', 'font_size_pt', 'font_size',
+                    'current_font', 'underline', 'fill_color', 'draw_color', 'text_color',
+                    'color_flag', 'line_width')
+
+    # The font the header starts in
+    header_font = ('Arial', '', 9)
+
+    # What the header is called in the pdf when it is shared between pages
+    header_form_name = 'Header'
+
+    def __init__(self, orientation, profile='standard'):
+        """
+        Initialise class
+        Calls the super class immediately to create a PDF, on A4 paper in millimetres.
+        :param orientation: 'P' for portrait or 'L' for landscape.
+        :param profile: How the pdf is output, one of the names in output_profiles.
+        """
+        check_profile(profile, need_package=False)
+
+        super().__init__(orientation=orientation, unit='mm', format='A4')
+        self.profile = profile
+        self.set_compression(output_profiles[profile]['compression'] is not None)
+        self.buffer = OutputBuffer()
+        # What the header added to the first page, and the state it left behind
+        self._header_cache = None
+        # The header's drawing instructions and object number, if it is shared between pages
+        self._header_form = None
+        self._header_form_n = None
+        # Where the lines start on each page, below the header
+        self.page_top = None
+        # The number of lines each page still to come has in the plan being followed, and how
+        # many more lines go on the current page, see follow_plan
+        self._page_plan = None
+        self.lines_left = None
+
+    def header(self):
+        """
+        According to the documentation, the header method is called whenever the 'add_page' method
+        is called in the super class. Here we override this method to put in a custom header,
+        which each invoice draws in its _draw_header method.
+        Nothing in the header changes from page to page, so it is only drawn on the first page.
+        What it adds to that page is kept, and copied straight onto each later page along with
+        the position, font and colours it leaves behind. Once the font has been set, the header
+        always starts from the same state, so the copy is exactly what drawing it again would
+        add. If the output profile shares the header, it is written once as a form instead, and
+        each page just draws the form.
+        :return: None
+        """
+        if self._page_plan is not None:
+            self.lines_left = next(self._page_plan, None)
+
+        self.set_font(*self.header_font)
+
+        if self.cache_header and self._header_cache is not None:
+            content, state = self._header_cache
+            self.pages[self.page] += content
+            self.__dict__.update(state)
+            return
+
+        start = len(self.pages[self.page])
+        self._draw_header()
+        self.page_top = self.y
+
+        if self.cache_header:
+            content = self.pages[self.page][start:]
+
+            # A form keeps any change it makes to the font, colours and line width to itself,
+            # so they are set again after it, as the rest of the page expects them
+            if output_profiles[self.profile]['shared_header']:
+                self._header_form = content
+                content = '\n'.join(['/{} Do'.format(self.header_form_name),
+                                      'BT /F%d %.2f Tf ET' % (self.current_font['i'],
+                                                              self.font_size_pt),
+                                      '%.2f w' % (self.line_width * self.k),
+                                      self.draw_color, self.fill_color]) + '\n'
+                self.pages[self.page] = self.pages[self.page][:start] + content
+
+            self._header_cache = (content,
+                                  {name: getattr(self, name) for name in self.header_state})
+
+    def _draw_header(self):
+        """
+        Draws the header from scratch, starting in the header_font at the top left of the page.
+        Overridden by each invoice.
+        :return: None
+        """
+        raise NotImplementedError
+
+    def lines_per_page(self):
+        """
+        Works out how many lines fit on a page below the header, adding up the height of each
+        line in the same way as the lines are added, so it comes out the same as where PyFPDF
+        would break the page.
+        :return: The number of lines
+        """
+        lines = 0
+        y = self.page_top
+
+        while not y + self.cell_height > self.page_break_trigger:
+            y += self.cell_height
+            lines += 1
+
+        return lines
+
+    def plan(self, groups, used=None):
+        """
+        Plans the pages of the rest of the invoice, see pagination.plan_pages.
+        :param groups: Iterable of the number of lines before each group's end.
+        :param used: The number of lines on the current page to plan around. Defaults to the
+        lines already on it.
+        :return: List of the number of lines on each page, starting with the current page. Its
+        length is the number of pages the invoice will have, counting from the current page.
+        """
+        if used is None:
+            used = round((self.y - self.page_top) / self.cell_height)
+
+        return plan_pages(groups, self.lines_per_page(), self.keep_lines, self.end_lines, used)
+
+    def follow_plan(self, pages):
+        """
+        Has insert_lines break the pages where a plan says, rather than only when the next line
+        does not fit. Pages still break as usual if a page ends up with more lines than planned.
+        :param pages: Iterable of the number of lines on each page, starting with the current
+        page, see the plan method.
+        :return: None
+        """
+        self._page_plan = iter(pages)
+        used = round((self.y - self.page_top) / self.cell_height)
+        self.lines_left = next(self._page_plan, used) - used
+
+    def _compress(self, content):
+        """
+        Compresses drawing instructions as the output profile says.
+        :param content: String of drawing instructions.
+        :return: Tuple of the filter to put in the stream's dictionary and the data.
+        """
+        level = output_profiles[self.profile]['compression']
+
+        if level is None:
+            return '', content
+
+        return '/Filter /FlateDecode ', zlib.compress(content.encode('latin1'), level)
+
+    def _putpages(self):
+        """
+        Writes each page into the pdf. Overrides the parent method, which is the same apart
+        from always compressing at zlib's default level. Links and pages turned to a different
+        orientation, which the invoices do not use, are left to the parent method.
+        :return: None
+        """
+        if self.page_links or self.orientation_changes or self.unifontsubset:
+            super()._putpages()
+            return
+
+        nb = self.page
+        if hasattr(self, 'str_alias_nb_pages'):
+            for n in range(1, nb + 1):
+                self.pages[n] = self.pages[n].replace(self.str_alias_nb_pages, str(nb))
+
+        if self.def_orientation == 'P':
+            w_pt, h_pt = self.fw_pt, self.fh_pt
+        else:
+            w_pt, h_pt = self.fh_pt, self.fw_pt
+
+        for n in range(1, nb + 1):
+            # Page
+            self._newobj()
+            self._out('<</Type /Page')
+            self._out('/Parent 1 0 R')
+            self._out('/Resources 2 0 R')
+            self._out('/Contents ' + str(self.n + 1) + ' 0 R>>')
+            self._out('endobj')
+
+            # Page content
+            stream_filter, data = self._compress(self.pages[n])
+            self._newobj()
+            self._out('<<' + stream_filter + '/Length ' + str(len(data)) + '>>')
+            self._putstream(data)
+            self._out('endobj')
+
+        # Pages root
+        self.offsets[1] = len(self.buffer)
+        self._out('1 0 obj')
+        self._out('<</Type /Pages')
+        self._out('/Kids [' + ''.join([str(3 + 2 * i) + ' 0 R ' for i in range(nb)]) + ']')
+        self._out('/Count ' + str(nb))
+        self._out('/MediaBox [0 0 %.2f %.2f]' % (w_pt, h_pt))
+        self._out('>>')
+        self._out('endobj')
+
+    def _putimages(self):
+        """
+        Writes the images into the pdf, and the shared header after them. Extends the parent
+        method.
+        :return: None
+        """
+        super()._putimages()
+
+        if self._header_form is None:
+            return
+
+        if self.def_orientation == 'P':
+            w_pt, h_pt = self.fw_pt, self.fh_pt
+        else:
+            w_pt, h_pt = self.fh_pt, self.fw_pt
+
+        stream_filter, data = self._compress(self._header_form)
+        self._newobj()
+        self._header_form_n = self.n
+        self._out('<</Type /XObject /Subtype /Form /BBox [0 0 %.2f %.2f] /Resources 2 0 R'
+                  % (w_pt, h_pt))
+        self._out(stream_filter + '/Length ' + str(len(data)) + '>>')
+        self._putstream(data)
+        self._out('endobj')
+
+    def _putxobjectdict(self):
+        """
+        Lists the images in the pdf's resources, and the shared header after them. Extends the
+        parent method.
+        :return: None
+        """
+        super()._putxobjectdict()
+
+        if self._header_form_n is not None:
+            self._out('/{} {} 0 R'.format(self.header_form_name, self._header_form_n))
+
+    def _save(self, file_name):
+        """
+        Finishes the pdf, and either saves it or returns it.
+        :param file_name: String for what the output file should be called. Can include path.
+        If None, the PDF is returned as bytes instead of being saved.
+        :return: Bytes of the PDF if no file name is given, otherwise None.
+        """
+        data = pdf_bytes(self)
+
+        if file_name is None:
+            return data
+
+        with open(file_name, 'wb') as pdf_file:
+            pdf_file.write(data)
+
+
+class SummaryInvoice(InvoiceDocument):
+    """
+    Class for the creation of summary style invoices.
+    Inherits from the InvoiceDocument class, and through it the imported PyFPDF class.
     Includes 4 methods and an init.
     3 of these methods override parent methods.
     """
@@ -27,10 +338,19 @@ class SummaryInvoice(FPDF):
                      'TD Item Rate', 'Item Amount', 'Weight Rate',
                      'TD Weight Rate', 'Weight Amount', 'Total Amount']
 
+    # The columns that are right aligned, the rest are centre aligned
+    right_columns = (5, 6, 9, 12, 13)
+
     # The default cell height for rows in the invoice
     cell_height = 5
 
-    def __init__(self, address, year, quarter, sub_account):
+    # The height of the two totals rows and the ending tag, in cell heights, down to the bottom
+    # of its last cell. The signing lines are drawn a cell height below that, which is still
+    # clear of the footer. Nothing else has to be kept on the same page as them.
+    end_lines = 11
+    keep_lines = 0
+
+    def __init__(self, address, year, quarter, sub_account, profile='standard'):
         """
         Initialise class
         Calls the super class immediately to create a PDF.
@@ -39,9 +359,10 @@ class SummaryInvoice(FPDF):
         :param year: Year string printed at top right hand corner of invoice.
         :param quarter: Quarter string printed at top right hand corner of invoice.
         :param sub_account: Sub account string printed at top right hand corner of invoice.
+        :param profile: How the pdf is output, one of the names in output_profiles.
         """
         # Default page is landscape A4
-        super().__init__(orientation='L', unit='mm', format='A4')
+        super().__init__(orientation='L', profile=profile)
         self.address = address
         self.year = year
         self.quarter = quarter
@@ -54,13 +375,11 @@ class SummaryInvoice(FPDF):
         self.alias_nb_pages()
         self.add_page()
 
-    def header(self):
+    def _draw_header(self):
         """
-        According to the documentation, the header method is called whenever the 'add_page' method
-        is called in the super class. Here we override this method to put in a custom header.
+        Draws the header from scratch, starting in Arial 9 at the top left of the page.
         :return: None
         """
-        self.set_font('Arial', size=9)
         address_list = self.address.split('\n')
 
         # Makes up the lines of our doc header
@@ -193,7 +512,7 @@ class SummaryInvoice(FPDF):
                     line = 0
 
                 # These columns specifically need to be right aligned
-                if num in [5, 6, 9, 12, 13]:
+                if num in self.right_columns:
                     align = 'R'
                 # Otherwise they should be centre aligned
                 else:
@@ -206,19 +525,13 @@ class SummaryInvoice(FPDF):
         else:
             # Deciding whether or not to insert a new page
 
-            # The logic behind this here is that because the orientation of this page is landscape
-            # and the size of the margin on all sides is 10mm, the writing space we have available
-            # to us per page is 190mm (A4 pages have a width of 210mm). What we are trying to
-            # assure it that the two totals rows and the ending tag are on the same page regardless
-            # of the number of rows in the invoice.
-
-            # The assumption this works under is that the height of the two totals rows and the
-            # ending tag (in output method below) combined is equal to 12 regular cell heights.
-            # Therefore, if the current position of y plus the product of these 12 cells and the
-            # default cell height is greater than the writing space of 190mm, we will need to add
-            # a new page.
+            # What we are trying to assure is that the two totals rows and the ending tag are on
+            # the same page regardless of the number of rows in the invoice. Together they are
+            # end_lines regular cell heights tall (the ending tag is in the output method below),
+            # so if their last cell would go past the point where PyFPDF breaks the page, we add a
+            # new page first. This is the same decision the plan method makes for the last page.
 
-            if (int(self.get_y()) + 12 * self.cell_height) > 190:
+            if self.get_y() + self.end_lines * self.cell_height > self.page_break_trigger:
                 self.add_page()
 
             # Setting the colour for the blank cells as grey
@@ -261,16 +574,26 @@ class SummaryInvoice(FPDF):
             self.cell(self.column_widths[-2] + self.column_widths[-1], self.cell_height,
                       txt=line_items[4], border=1, ln=1, align='R')
 
+    def insert_lines(self, lines):
+        """
+        Adds many lines into the invoice at once, exactly as calling insert_line for each of them
+        would, but much faster. See RowLayout.
+        :param lines: Iterable of lists (or tuples) of strings, each one as for insert_line.
+        :return: None
+        """
+        insert_rows(self, lines)
+
     def output(self, file_name, name, department, company):
         """
         Output is a method of the parent class and creates the actual PDF document output.
         This overrides the parent method, adding in an ending tag for the invoice, before
         calling the parent output method.
         :param file_name: String for what the output file should be called. Can include path.
+        If None, the PDF is returned as bytes instead of being saved.
         :param name: The string name of the processing officer that will appear on the invoice.
         :param department: The string name of the department.
         :param company: The string name of the company.
-        :return: None
+        :return: Bytes of the PDF if no file name is given, otherwise None.
         """
         # Add line break
         self.ln(self.cell_height*2)
@@ -316,14 +639,13 @@ class SummaryInvoice(FPDF):
         self.line(current_x + sum(self.column_widths[0:8]), current_y,
                   current_x + sum(self.column_widths[0:-1]), current_y)
 
-        # Calling parent class
-        super().output(file_name)
+        return self._save(file_name)
 
 
-class DetailInvoice(FPDF):
+class DetailInvoice(InvoiceDocument):
     """
     Class for the creation of detail style invoices.
-    Inherits from the imported PyFPDF class.
+    Inherits from the InvoiceDocument class, and through it the imported PyFPDF class.
     Contains 3 methods and an init. 2 of those methods override the parent class.
     Is very similar in structure to the SummaryInvoice class, although it does not have an ending
     tag and is portrait instead of landscape. It can also have multiple totals rows instead of
@@ -337,22 +659,39 @@ class DetailInvoice(FPDF):
     column_titles = ['Despatch Date', 'Origin', 'Destination', 'Category',
                      'Subclass', 'Serial Number', 'Items', 'Weight']
 
+    # The columns that are right aligned, the rest are centre aligned
+    right_columns = (6, 7)
+
     # The default cell height for rows in the invoice
     cell_height = 5
 
-    def __init__(self, customer, year, quarter):
+    # The font the header starts in
+    header_font = ('Arial', 'B', 9)
+
+    # Each rates combination ends in one totals row, which always has at least keep_lines of
+    # the combination's lines on the same page, see the plan method
+    end_lines = 1
+    keep_lines = 2
+
+    def __init__(self, customer, year, quarter, part=None, profile='standard'):
         """
         Initialise class
         Calls the super class immediately to create a PDF.
         :param customer: Name string of customer that appears at top of invoice.
         :param year: Year string printed at top of invoice.
         :param quarter: Quarter string printed at top of invoice.
+        :param part: Number printed in the title if the invoice is one part of a longer invoice,
+        see DetailVolumes.
+        :param profile: How the pdf is output, one of the names in output_profiles.
         """
         # Default page is portrait A4
-        super().__init__(orientation='P', unit='mm', format='A4')
+        super().__init__(orientation='P', profile=profile)
         self.customer = customer
         self.year = year
         self.quarter = quarter
+        self.part = part
+        # The position, font and colours the title is drawn in, see set_part
+        self._title_state = None
         # Allows new pages to be created automatically
         self.accept_page_break()
         self.date_stamp = datetime.now().strftime('%Y-%m-%d')
@@ -361,18 +700,16 @@ class DetailInvoice(FPDF):
         self.alias_nb_pages()
         self.add_page()
 
-    def header(self):
+    def _draw_header(self):
         """
-        According to the documentation, the header method is called whenever the 'add_page' method
-        is called in the super class. Here we override this method to put in a custom header.
+        Draws the header from scratch, starting in Arial bold 9 at the top left of the page.
         :return: None
         """
-        self.set_font('Arial', 'B', 9)
         self.set_fill_color(169, 169, 169)
 
         # Title
-        self.cell(0, self.cell_height*2, txt='DETAILED ACCOUNT', border=1,
-                  ln=1, fill=True, align='C')
+        self._title_state = {name: getattr(self, name) for name in self.header_state}
+        self._draw_title()
         self.ln(self.cell_height)
 
         # Second line
@@ -423,6 +760,52 @@ class DetailInvoice(FPDF):
             self.cell(col, self.cell_height*2, txt=self.column_titles[num],
                       ln=line, align='C', border=1)
 
+    def _draw_title(self):
+        """
+        Draws the title, with the part number if there is one.
+        :return: String of what was added to the page.
+        """
+        title = 'DETAILED ACCOUNT'
+        if self.part is not None:
+            title += ' - PART {}'.format(self.part)
+
+        start = len(self.pages[self.page])
+        self.cell(0, self.cell_height*2, txt=title, border=1, ln=1, fill=True, align='C')
+
+        return self.pages[self.page][start:]
+
+    def set_part(self, part):
+        """
+        Changes the part number in the title of the pages drawn so far, for an invoice that only
+        turns out to be one part of a longer one once it is under way, see DetailVolumes.
+        The title is drawn again with each number, from where it was drawn in the header, and
+        the first is swapped for the second on each page. What is drawn is then taken off the
+        page again, and the position, font and colours are put back.
+        :param part: The new part number, or None for no part number.
+        :return: None
+        """
+        content = self.pages[self.page]
+        state = {name: getattr(self, name) for name in self.header_state}
+
+        self.__dict__.update(self._title_state)
+        old = self._draw_title()
+        self.part = part
+        self.__dict__.update(self._title_state)
+        new = self._draw_title()
+
+        self.pages[self.page] = content
+        self.__dict__.update(state)
+
+        for n in self.pages:
+            self.pages[n] = self.pages[n].replace(old, new, 1)
+
+        if self._header_form is not None:
+            self._header_form = self._header_form.replace(old, new, 1)
+
+        if self._header_cache is not None:
+            self._header_cache = (self._header_cache[0].replace(old, new, 1),
+                                  self._header_cache[1])
+
     def footer(self):
         """
         According to the documentation, the footer method is also called whenever the 'add_page'
@@ -437,6 +820,16 @@ class DetailInvoice(FPDF):
         page = 'Page ' + str(self.page_no()) + ' of {nb}'
         self.cell(0, 10, page, 0, 0, 'C')
 
+    def output(self, file_name=None):
+        """
+        Creates the actual PDF document output. Overrides the parent method so that, like the
+        summary invoice, the PDF can be kept in memory.
+        :param file_name: String for what the output file should be called. Can include path.
+        If None, the PDF is returned as bytes instead of being saved.
+        :return: Bytes of the PDF if no file name is given, otherwise None.
+        """
+        return self._save(file_name)
+
     def insert_line(self, line_items):
         """
         Method that adds all of the lines into the invoice. Lines should be added one at a time.
@@ -461,7 +854,7 @@ class DetailInvoice(FPDF):
                     line = 0
 
                 # These columns specifically need to be right aligned
-                if num in [6, 7]:
+                if num in self.right_columns:
                     align = 'R'
                 # Otherwise they should be centre aligned
                 else:
@@ -472,11 +865,431 @@ class DetailInvoice(FPDF):
 
         # If we only have 2 elements in the list, we have a totals row
         else:
-            self.set_font('', 'B', 8)
+            self.insert_totals(line_items)
+
+    def insert_totals(self, line_items, label='Total'):
+        """
+        Adds a totals row into the invoice.
+        :param line_items: List (or tuple) of the two totals strings, items and weight.
+        :param label: What the row is called, printed on the left.
+        :return: None
+        """
+        self.set_font('', 'B', 8)
+
+        self.cell(sum(self.column_widths[0:-2]), self.cell_height, txt=label, border=1,
+                  align='L')
+        self.cell(self.column_widths[-2], self.cell_height, txt=line_items[0], border=1,
+                  align='R')
+        self.cell(self.column_widths[-1], self.cell_height, txt=line_items[1], border=1,
+                  align='R', ln=1)
+
+    def insert_lines(self, lines, groups=None):
+        """
+        Adds many lines into the invoice at once, much faster than calling insert_line for each
+        of them. See RowLayout. The pages are planned first, so that a rates combination that
+        fits on a page is not split across two, and a totals row is never left on its own at
+        the top of a page. See the plan method.
+        :param lines: Iterable of lists (or tuples) of strings, each one as for insert_line. Can
+        be a generator, so the lines do not all have to be held in memory.
+        :param groups: List of the number of lines in each rates combination, not counting its
+        totals row, in order. Worked out from the lines if they are a list. Otherwise, if not
+        given, the pages just break when they are full.
+        :return: None
+        """
+        if groups is None and isinstance(lines, (list, tuple)):
+            groups = group_sizes(lines, len(self.column_widths))
+
+        if groups is not None:
+            self.follow_plan(self.plan(groups))
+
+        insert_rows(self, lines)
+
+
+class DetailVolumes:
+    """
+    A detail invoice that is split into several pdfs, or volumes, once it reaches a number of
+    pages or bytes.
+    FPDF keeps every page of a document in memory until it is output, so a detail invoice for a
+    big customer running to thousands of pages takes up a lot of memory, and can be too big an
+    attachment for some mail servers. Each volume is output as soon as it is full, and the
+    invoice carries on in the next volume, which has the same header with its part number in
+    the title. The first volume gets its part number once it is full. If a volume ends part of
+    the way through a rates combination, the subtotal so far is shown at the bottom as carried
+    forward and at the top of the next volume as brought forward. The totals row at the end of
+    the combination is still the total for all of it.
+    The pages of each volume are planned in the same way as a DetailInvoice, and a volume can
+    end where its plan breaks a page early as well as where a page is full.
+    An invoice that never fills a volume comes out the same as a DetailInvoice.
+    """
+
+    def __init__(self, customer, year, quarter, max_pages=None, max_bytes=None, on_volume=None,
+                 profile='standard'):
+        """
+        Initialise class
+        :param customer: Name string of customer that appears at top of invoice.
+        :param year: Year string printed at top of invoice.
+        :param quarter: Quarter string printed at top of invoice.
+        :param max_pages: The most pages in a volume. None for no limit.
+        :param max_bytes: The most bytes of page content in a volume, before it is compressed,
+        so the pdfs themselves come out smaller. Checked at the end of each page, so a volume
+        can go over by up to a page. None for no limit.
+        :param on_volume: Function called with the part number, the bytes and whether it is the
+        last volume, for each volume as soon as it is output, such as to save it. The part
+        number is None if the invoice was not split.
+        :param profile: How each volume is output, one of the names in output_profiles.
+        """
+        self.customer = customer
+        self.year = year
+        self.quarter = quarter
+        self.max_pages = max_pages
+        self.max_bytes = max_bytes
+        self.on_volume = on_volume
+        self.profile = profile
+        self.parts = 0
+        # Items and weight of the rates combination so far, since its last totals row
+        self.subtotal = None
+        # The number of lines in each rates combination still to come, if known, and the number
+        # of lines of the first of them added so far, for planning the pages of each volume
+        self.groups = None
+        self.group_num = 0
+        self.group_lines = 0
+        self.invoice = DetailInvoice(customer, year, quarter, profile=profile)
+
+    def full(self):
+        """
+        Whether the current volume has reached its number of pages or bytes.
+        :return: Boolean
+        """
+        if self.max_pages is not None and self.invoice.page_no() >= self.max_pages:
+            return True
+
+        if self.max_bytes is not None and \
+                sum([len(x) for x in self.invoice.pages.values()]) >= self.max_bytes:
+            return True
+
+        return False
+
+    def _until_full(self, lines, held):
+        """
+        Hands lines over to the current volume until it is full, keeping track of the subtotal.
+        A volume is full once it has reached its limit and the next line would leave no room
+        at the bottom of the page for the carried forward row, or would start a new page.
+        :param lines: Iterator of lines, see DetailInvoice.insert_line.
+        :param held: Empty list, which the line that did not fit is put into.
+        :return: Generator of lines
+        """
+        invoice = self.invoice
+
+        for line_items in lines:
+            if (invoice.y + 2 * invoice.cell_height > invoice.page_break_trigger or
+                    invoice.lines_left is not None and invoice.lines_left <= 0) and \
+                    self.full():
+                held.append(line_items)
+                return
+
+            if len(line_items) == 2:
+                self.subtotal = None
+                self.group_num += 1
+                self.group_lines = 0
+            else:
+                self.group_lines += 1
+
+                if self.subtotal is None:
+                    self.subtotal = [Decimal(x.replace(',', '')) for x in line_items[-2:]]
+                else:
+                    self.subtotal = [total + Decimal(x.replace(',', ''))
+                                     for total, x in zip(self.subtotal, line_items[-2:])]
+
+            yield line_items
+
+    def insert_lines(self, lines, groups=None):
+        """
+        Adds many lines into the invoice, starting a new volume whenever one is full.
+        :param lines: Iterable of lists (or tuples) of strings, as for DetailInvoice.insert_line.
+        :param groups: List of the number of lines in each rates combination, as for
+        DetailInvoice.insert_lines.
+        :return: None
+        """
+        if groups is None and isinstance(lines, (list, tuple)):
+            groups = group_sizes(lines, len(DetailInvoice.column_widths))
+
+        self.groups = groups
+        lines = iter(lines)
+
+        while True:
+            held = []
+            if self.groups is not None:
+                self._plan_volume()
+            self.invoice.insert_lines(self._until_full(lines, held))
+
+            if not held:
+                return
+
+            self._next_volume()
+            lines = itertools.chain(held, lines)
+
+    def _plan_volume(self):
+        """
+        Plans the pages of the current volume from the rates combinations still to come. If the
+        volume starts part of the way through one, its brought forward row is planned as one of
+        its lines, so that it is kept with the rest of them.
+        :return: None
+        """
+        groups = self.groups[self.group_num:]
+        used = None
+
+        if groups and self.group_lines:
+            groups[0] -= self.group_lines - 1
+            used = 0
+
+        self.invoice.follow_plan(self.invoice.plan(groups, used))
+
+    def _next_volume(self):
+        """
+        Outputs the current volume and starts the next one.
+        :return: None
+        """
+        # Decimal keeps the number of places it was read with
+        subtotal = None
+        if self.subtotal is not None:
+            subtotal = ['{:,}'.format(x) for x in self.subtotal]
+            self.invoice.insert_totals(subtotal, label='Carried forward')
+
+        # The first volume was started without a part number, as it was not known to be full
+        if self.parts == 0:
+            self.invoice.set_part(1)
+
+        self._output(self.parts + 1, False)
+        self.invoice = DetailInvoice(self.customer, self.year, self.quarter, part=self.parts + 1,
+                                     profile=self.profile)
+
+        if subtotal is not None:
+            self.invoice.insert_totals(subtotal, label='Brought forward')
+
+    def _output(self, part, last):
+        """
+        Outputs the current volume and hands it to on_volume.
+        :param part: The part number, or None if the invoice was not split.
+        :param last: Whether it is the last volume.
+        :return: None
+        """
+        pdf = self.invoice.output()
+        self.invoice = None
+        self.parts += 1
+
+        if self.on_volume is not None:
+            self.on_volume(part, pdf, last)
+
+    def finish(self):
+        """
+        Outputs the last volume.
+        :return: The number of volumes.
+        """
+        self._output(None if self.parts == 0 else self.parts + 1, True)
+
+        return self.parts
+
+
+class RowLayout:
+    """
+    Where each column of an invoice's lines goes on the page, worked out once for a document.
+    For each item in a line, FPDF's cell method works out the column's position, the width of
+    the text, whether a new page is needed, and then adds a short string to the page, which
+    copies everything on the page so far. On an invoice with many thousands of lines this is
+    where nearly all of the time goes. Instead the parts of each cell that are the same on every
+    line are kept here, along with where each bit of text already seen in a column goes, and a
+    whole line is added to the page at once. What is added is exactly what cell would have added.
+    """
+
+    def __init__(self, pdf):
+        """
+        Initialise class
+        :param pdf: A SummaryInvoice or DetailInvoice, with the font for its lines already set.
+        """
+        self.key = self.state(pdf)
+        self.columns = []
+        # For each column, the text already seen in it and its position in the column
+        self.texts = [{} for _ in pdf.column_widths]
+
+        k = pdf.k
+        x = pdf.l_margin
+        for num, width in enumerate(pdf.column_widths):
+            # The start and end of the cell's border, either side of its distance from the top
+            self.columns.append((x, width, num in pdf.right_columns, '%.2f ' % (x * k),
+                                 ' %.2f %.2f re S ' % (width * k, -pdf.cell_height * k)))
+            # Added up in the same way as cell moves along the line, so x comes out the same
+            x += width
+
+    @staticmethod
+    def state(pdf):
+        """
+        What the layout depends on, to tell when it needs working out again.
+        :param pdf: An instance of FPDF, or one of the invoice classes.
+        :return: Tuple
+        """
+        return (pdf.font_family, pdf.font_style, pdf.font_size_pt, pdf.l_margin, pdf.c_margin,
+                pdf.h, pdf.k)
+
+    @staticmethod
+    def fits(pdf):
+        """
+        Whether a line can be added by the layout. Lines are added the usual way if the line does
+        not start at the left margin or the font needs anything cell does differently.
+        :param pdf: An instance of FPDF, or one of the invoice classes.
+        :return: Boolean
+        """
+        return pdf.x == pdf.l_margin and not (pdf.ws or pdf.unifontsubset or pdf.underline)
+
+    @staticmethod
+    def text(pdf, column, item):
+        """
+        Works out where a bit of text goes in a column, in the same way as cell.
+        :param pdf: The invoice the layout was worked out for.
+        :param column: Tuple from the layout's columns.
+        :param item: The string to put in the column.
+        :return: Tuple of the strings that go before and after the height of the text.
+        """
+        x, width, right = column[:3]
+
+        if right:
+            dx = width - pdf.c_margin - pdf.get_string_width(item)
+        else:
+            dx = (width - pdf.get_string_width(item)) / 2.0
+
+        return '%.2f ' % ((x + dx) * pdf.k), ' Td (%s) Tj ET' % pdf._escape(item)
+
+    def write(self, pdf, line_items):
+        """
+        Adds a line to the page, starting a new page first if it does not fit.
+        :param pdf: The invoice the layout was worked out for.
+        :param line_items: List (or tuple) of strings, one for each column.
+        :return: None
+        """
+        height = pdf.cell_height
+
+        # The one page break check for the whole line, as the rest of its cells are no lower
+        if (pdf.y + height > pdf.page_break_trigger and not pdf.in_footer
+                and pdf.accept_page_break()):
+            x = pdf.x
+            pdf.add_page(pdf.cur_orientation)
+            pdf.x = x
+
+        k = pdf.k
+        top = '%.2f' % ((pdf.h - pdf.y) * k)
+        baseline = '%.2f' % ((pdf.h - (pdf.y + .5 * height + .3 * pdf.font_size)) * k)
+
+        if pdf.color_flag:
+            start, end = 'q ' + pdf.text_color + ' BT ', ' Q'
+        else:
+            start, end = 'BT ', ''
+
+        cells = []
+        for column, texts, item in zip(self.columns, self.texts, line_items):
+            cell = column[3] + top + column[4]
+
+            if item != '':
+                text = texts.get(item)
+                if text is None:
+                    text = texts[item] = self.text(pdf, column, item)
+
+                cell += start + text[0] + baseline + text[1] + end
+
+            cells.append(cell)
+
+        # cell adds each of these followed by a new line
+        pdf._out('\n'.join(cells))
+
+        pdf.lasth = height
+        pdf.y += height
+        pdf.x = pdf.l_margin
+
+
+def insert_rows(pdf, lines):
+    """
+    Adds many lines into an invoice, for the insert_lines methods. Full lines are added using
+    the invoice's RowLayout and anything else, such as a totals row, using insert_line. Pages
+    are broken where the invoice's plan says, if it is following one.
+    :param pdf: A SummaryInvoice or DetailInvoice.
+    :param lines: Iterable of lists (or tuples) of strings, each one as for insert_line.
+    :return: None
+    """
+    columns = len(pdf.column_widths)
+    # Whether the font for the lines is still set from the line before
+    font_set = False
+
+    for line_items in lines:
+        # Breaking the page early if that is where the plan of the pages says, if there is one
+        if pdf.lines_left is not None and pdf.lines_left <= 0:
+            pdf.add_page(pdf.cur_orientation)
+
+        if len(line_items) != columns or not RowLayout.fits(pdf):
+            pdf.insert_line(line_items)
+            font_set = False
+        else:
+            if not font_set:
+                pdf.set_font('', '', 8)
+                font_set = True
+
+                layout = getattr(pdf, '_row_layout', None)
+                if layout is None or layout.key != RowLayout.state(pdf):
+                    layout = pdf._row_layout = RowLayout(pdf)
+
+            layout.write(pdf, line_items)
+
+        # Counted once the line is added, as it can start a new page of its own if it did not fit
+        if pdf.lines_left is not None:
+            pdf.lines_left -= 1
+
+
+def pdf_bytes(pdf):
+    """
+    Finishes a PDF and returns it as bytes rather than saving it. FPDF builds the document up
+    as a latin-1 string, which is the same as what it would write to a file. Invoices whose
+    output profile linearizes them are linearized as well.
+    :param pdf: An instance of FPDF, or one of the invoice classes.
+    :return: Bytes
+    """
+    data = FPDF.output(pdf, dest='S').encode('latin1')
+
+    if output_profiles[getattr(pdf, 'profile', 'standard')]['linearize']:
+        data = linearize(data)
+
+    return data
+
+
+def check_profile(profile, need_package=True):
+    """
+    Makes sure an output profile exists, and that what it needs is installed.
+    :param profile: The name of the output profile.
+    :param need_package: Whether to check that pikepdf is installed if the profile linearizes.
+    :return: None
+    """
+    if profile not in output_profiles:
+        raise ValueError('{} is not an output profile, expected one of {}'
+                         .format(profile, ', '.join(output_profiles)))
+
+    if (need_package and output_profiles[profile]['linearize']
+            and importlib.util.find_spec('pikepdf') is None):
+        raise ImportError('The {} output profile needs the pikepdf package, pip install pikepdf'
+                          .format(profile))
+
+
+def linearize(data):
+    """
+    Rewrites a pdf to be linearized, with its objects packed into compressed object streams.
+    Needs the pikepdf package, which is only imported when a pdf is linearized.
+    :param data: Bytes of a pdf.
+    :return: Bytes of the linearized pdf.
+    """
+    try:
+        import pikepdf
+    except ImportError:
+        raise ImportError('Linearizing a pdf needs the pikepdf package, pip install pikepdf')
+
+    output = io.BytesIO()
+
+    with pikepdf.open(io.BytesIO(data)) as pdf:
+        pdf.save(output, linearize=True, compress_streams=True,
+                 object_stream_mode=pikepdf.ObjectStreamMode.generate)
 
-            self.cell(sum(self.column_widths[0:-2]), self.cell_height, txt='Total', border=1,
-                      align='L')
-            self.cell(self.column_widths[-2], self.cell_height, txt=line_items[0], border=1,
-                      align='R')
-            self.cell(self.column_widths[-1], self.cell_height, txt=line_items[1], border=1,
-                      align='R', ln=1)
+    return output.getvalue()
@@ -0,0 +1,265 @@
+"""
+Invoice Pipeline - runs the invoice process as three concurrent stages connected by queues.
+The stages are fetching the data from the database, rendering the pdf invoices, and emailing
+them to the customer. While one customer is being emailed, the next can be rendered and the one
+after that can be fetched. Each stage has its own number of worker threads and the queues
+between the stages are bounded, so a slow stage holds up the stages before it rather than
+letting fetched data pile up in memory.
+"""
+
+import queue
+import threading
+import time
+
+
+class Stage:
+    """
+    A single stage of the pipeline. Worker threads take customers off the input queue, do the
+    work for this stage, and put them onto the output queue for the next stage.
+    Keeps count of how many customers went through the stage, how long the workers spent busy,
+    and how long customers sat in the input queue waiting for a worker.
+    """
+
+    def __init__(self, name, work, workers, in_queue, out_queue, results):
+        """
+        Initialise class
+        :param name: Name of the stage that will appear in the run log.
+        :param work: Function that takes a job dictionary and does the work for this stage.
+        :param workers: The number of worker threads for this stage.
+        :param in_queue: Queue the stage takes customers from.
+        :param out_queue: Queue the stage passes finished customers on to. None for the last
+        stage, in which case customers go straight onto the results queue.
+        :param results: Queue that all finished and failed customers end up on.
+        """
+        self.name = name
+        self.work = work
+        self.workers = workers
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.results = results
+
+        self.count = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self.first_start = None
+        self.last_finish = None
+
+        # Set by the pipeline, so the last worker knows how many stop signals to pass on
+        self.next_stage_workers = 0
+
+        self._lock = threading.Lock()
+        self._running = workers
+        self._threads = [threading.Thread(target=self._run, name='{} {}'.format(name, num + 1),
+                                          daemon=True)
+                         for num in range(workers)]
+
+    def start(self):
+        """
+        Starts the worker threads.
+        :return: None
+        """
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self):
+        """
+        The loop each worker thread runs. A None on the input queue tells the worker to stop.
+        The last worker to stop tells every worker of the next stage to stop as well.
+        :return: None
+        """
+        while True:
+            job = self.in_queue.get()
+
+            if job is None:
+                break
+
+            start = time.perf_counter()
+
+            try:
+                self.work(job)
+            except _InvalidCustomer:
+                job['error'] = True
+            except Exception as err:
+                job['error'] = True
+                job['status'] = 'The following error occurred:\n{}.\n'.format(err)
+
+            finish = time.perf_counter()
+
+            with self._lock:
+                self.count += 1
+                self.busy_time += finish - start
+                self.wait_time += start - job['queued']
+                if self.first_start is None:
+                    self.first_start = start
+                self.last_finish = finish
+
+            # Customers that failed skip the rest of the stages
+            if job['error'] or self.out_queue is None:
+                self.results.put(job)
+            else:
+                job['queued'] = time.perf_counter()
+                self.out_queue.put(job)
+
+        with self._lock:
+            self._running -= 1
+            last_worker = self._running == 0
+
+        if last_worker and self.out_queue is not None:
+            for _ in range(self.next_stage_workers):
+                self.out_queue.put(None)
+
+    def report(self):
+        """
+        Describes the throughput of this stage for the run log.
+        :return: String
+        """
+        if self.count == 0:
+            return '{}: no customers.'.format(self.name)
+
+        elapsed = max(self.last_finish - self.first_start, 1e-9)
+
+        return '{}: {} customer(s) with {} worker(s) in {:.2f}s ({:.2f} customers/sec). ' \
+               'Busy {:.2f}s. Queue wait {:.2f}s total, {:.2f}s average.' \
+               .format(self.name, self.count, self.workers, elapsed, self.count / elapsed,
+                       self.busy_time, self.wait_time, self.wait_time / self.count)
+
+
+class InvoicePipeline:
+    """
+    Runs the fetch, render and send stages for a list of customers.
+    Results are handed back in the same order as the customers, however the customers happen
+    to finish, so the run logs stay in a predictable order.
+    """
+
+    def __init__(self, create_customer, fetch_workers=1, render_workers=1, send_workers=1,
+                 queue_size=4):
+        """
+        Initialise class
+        :param create_customer: Function that takes a Country_Code and returns an instance of
+        the Customer class from invoice_creation.py.
+        :param fetch_workers: Number of threads fetching data from the database.
+        :param render_workers: Number of threads rendering pdf invoices.
+        :param send_workers: Number of threads sending emails.
+        :param queue_size: The most customers that can wait between two stages.
+        """
+        self.create_customer = create_customer
+        self.queue_size = queue_size
+
+        self._fetch_queue = queue.Queue(maxsize=queue_size)
+        render_queue = queue.Queue(maxsize=queue_size)
+        send_queue = queue.Queue(maxsize=queue_size)
+        self._results = queue.Queue()
+
+        self.stages = (Stage('FETCH', self._fetch, fetch_workers,
+                             self._fetch_queue, render_queue, self._results),
+                       Stage('RENDER', self._render, render_workers,
+                             render_queue, send_queue, self._results),
+                       Stage('SEND', self._send, send_workers,
+                             send_queue, None, self._results))
+
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next_stage_workers = next_stage.workers
+
+    def _fetch(self, job):
+        """
+        Work for the fetch stage. Creates the customer, which checks its rates and address, and
+        then fetches the invoice data. Customers that are not valid are failed here so that they
+        go straight to the results, which is how they are logged as errors.
+        :param job: Job dictionary for the customer.
+        :return: None
+        """
+        job['customer'] = self.create_customer(job['customer_code'])
+
+        if not job['customer'].valid:
+            raise _InvalidCustomer
+
+        job['customer'].fetch_data()
+
+    @staticmethod
+    def _render(job):
+        """
+        Work for the render stage.
+        :param job: Job dictionary for the customer.
+        :return: None
+        """
+        job['customer'].render_invoices()
+
+    @staticmethod
+    def _send(job):
+        """
+        Work for the send stage.
+        :param job: Job dictionary for the customer.
+        :return: None
+        """
+        job['customer'].send_invoices()
+
+    def _feed(self, customers):
+        """
+        Puts the customers onto the first queue, waiting whenever the queue is full.
+        Tells the fetch workers to stop once every customer has been queued.
+        :param customers: Tuple of Country_Codes.
+        :return: None
+        """
+        for num, customer_code in enumerate(customers):
+            self._fetch_queue.put({'num': num, 'customer_code': customer_code, 'customer': None,
+                                   'error': False, 'status': None,
+                                   'queued': time.perf_counter()})
+
+        for _ in range(self.stages[0].workers):
+            self._fetch_queue.put(None)
+
+    def run(self, customers):
+        """
+        Runs every customer through the pipeline.
+        :param customers: Iterable of Country_Codes.
+        :return: Generator of result dictionaries in customer order, in the same form as
+        invoice_creation.process_customer.
+        """
+        customers = tuple(customers)
+
+        for stage in self.stages:
+            stage.start()
+
+        feeder = threading.Thread(target=self._feed, args=(customers,), name='FEED', daemon=True)
+        feeder.start()
+
+        # Results arrive in whatever order customers finish, so they are held here until
+        # every customer before them has been handed back
+        waiting = {}
+        next_num = 0
+
+        while next_num < len(customers):
+            job = self._results.get()
+            waiting[job['num']] = job
+
+            while next_num in waiting:
+                job = waiting.pop(next_num)
+                next_num += 1
+
+                # The customer may not exist if the error happened while creating it
+                if job['customer'] is None:
+                    message = job['status']
+                else:
+                    if job['status'] is not None:
+                        job['customer'].status = job['status']
+                    message = job['customer'].log_message()
+
+                yield {'customer': job['customer_code'],
+                       'message': message,
+                       'error': job['error']}
+
+        feeder.join()
+
+    def report(self):
+        """
+        Describes the throughput of each stage for the run log.
+        :return: List of strings
+        """
+        return [stage.report() for stage in self.stages]
+
+
+class _InvalidCustomer(Exception):
+    """
+    Raised by the fetch stage for customers with rates or address issues.
+    """
+
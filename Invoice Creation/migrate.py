@@ -0,0 +1,182 @@
+"""
+Migrate - applies the versioned schema changes in the migrations folder to the MySQL database.
+Each migration is a .sql file whose name starts with its version number, such as
+001_composite_indexes.sql. The versions that have been applied are recorded in the
+schema_migrations table, so running this again only applies the migrations that are new.
+The connection details are read from the same params shelve database as invoice_creation.py,
+and the migrations can be applied to either of the database backends in database.py.
+"""
+
+import argparse
+import os
+import shelve
+from datetime import datetime
+
+from database import create_backend
+
+# The folder the migration files are kept in, next to this file
+migrations_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+def connect(database=None, backend=None):
+    """
+    Opens a single connection to the database using the details in the params shelve database.
+    :param database: The database to connect to, or the file for SQLite. Defaults to the
+    database_name in the shelve.
+    :param backend: 'mysql' or 'sqlite'. Defaults to the database_backend in the shelve.
+    :return: Connection, see database.py
+    """
+    with shelve.open('params') as data_base:
+        return create_backend(backend or data_base.get('database_backend', 'mysql'),
+                              database or data_base['database_name'],
+                              user=data_base.get('user'),
+                              password=data_base.get('password'),
+                              host=data_base.get('host'),
+                              pool_size=None).connect()
+
+
+def split_statements(script):
+    """
+    Splits a SQL script into its statements. Lines starting with -- are treated as comments
+    and every statement must end with a semicolon at the end of a line.
+    :param script: String of SQL.
+    :return: List of statement strings, without their semicolons.
+    """
+    statements = []
+    current = []
+
+    for line in script.splitlines():
+        if line.strip().startswith('--'):
+            continue
+
+        current.append(line)
+
+        if line.rstrip().endswith(';'):
+            statements.append('\n'.join(current).strip().rstrip(';'))
+            current = []
+
+    if '\n'.join(current).strip():
+        statements.append('\n'.join(current).strip())
+
+    return statements
+
+
+def run_script(cnx, file_name):
+    """
+    Runs every statement in a SQL file, such as db_setup.sql.
+    :param cnx: MySQL connection.
+    :param file_name: The SQL file. Can include path.
+    :return: The number of statements run.
+    """
+    with open(file_name) as script:
+        statements = split_statements(script.read())
+
+    cursor = cnx.cursor()
+    for statement in statements:
+        cursor.execute(statement)
+    cursor.close()
+    cnx.commit()
+
+    return len(statements)
+
+
+def load_migrations(folder=migrations_folder):
+    """
+    Finds the migration files in a folder.
+    :param folder: The folder to look in.
+    :return: List of (version, file name) tuples sorted by version.
+    """
+    migrations = []
+
+    for file_name in os.listdir(folder):
+        version = file_name.split('_')[0]
+        if file_name.endswith('.sql') and version.isdigit():
+            migrations.append((int(version), file_name))
+
+    return sorted(migrations)
+
+
+def applied_versions(cnx):
+    """
+    Looks up the migrations that have already been applied, creating the schema_migrations
+    table first if this database has never been migrated.
+    :param cnx: MySQL connection.
+    :return: Set of version numbers.
+    """
+    cursor = cnx.cursor()
+    cursor.execute('CREATE TABLE IF NOT EXISTS schema_migrations ('
+                   'Version INT PRIMARY KEY, '
+                   'File_Name VARCHAR(100), '
+                   'Applied DATETIME);')
+    cursor.execute('SELECT Version FROM schema_migrations;')
+    versions = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+
+    return versions
+
+
+def apply_migrations(cnx, folder=migrations_folder, target=None):
+    """
+    Applies every migration that has not been applied yet, in version order.
+    MySQL cannot roll back changes to a table's structure, so each migration is recorded as
+    soon as it has finished. If one fails part of the way through, the ones before it stay
+    recorded and it will be tried again on the next run.
+    :param cnx: MySQL connection.
+    :param folder: The folder the migration files are in.
+    :param target: The highest version to apply. None applies all of them.
+    :return: List of the file names that were applied.
+    """
+    done = applied_versions(cnx)
+    applied = []
+
+    for version, file_name in load_migrations(folder):
+        if version in done or (target is not None and version > target):
+            continue
+
+        run_script(cnx, os.path.join(folder, file_name))
+
+        cursor = cnx.cursor()
+        cursor.execute('INSERT INTO schema_migrations VALUES (%s, %s, %s);',
+                       (version, file_name, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        cursor.close()
+        cnx.commit()
+
+        applied.append(file_name)
+
+    return applied
+
+
+def main(argv=None):
+    """
+    Applies the outstanding migrations, or lists which have been applied with --status.
+    :param argv: List of command line arguments. Defaults to sys.argv.
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Applies schema migrations to the database.')
+    parser.add_argument('--database',
+                        help='Database to migrate. Defaults to the database_name in the params '
+                             'shelve.')
+    parser.add_argument('--target', type=int, metavar='VERSION',
+                        help='Only apply migrations up to and including this version.')
+    parser.add_argument('--status', action='store_true',
+                        help='List the migrations and whether they have been applied.')
+    args = parser.parse_args(argv)
+
+    cnx = connect(args.database)
+
+    if args.status:
+        done = applied_versions(cnx)
+        for version, file_name in load_migrations():
+            print('{} {}'.format('APPLIED' if version in done else 'PENDING', file_name))
+    else:
+        applied = apply_migrations(cnx, target=args.target)
+        for file_name in applied:
+            print('Applied {}'.format(file_name))
+        if not applied:
+            print('Nothing to apply.')
+
+    cnx.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+-- Composite indexes for the access paths used by invoice_creation.py.
+
+-- Every query filters sales_data on the sub account, year and quarter, and the per customer
+-- queries on the Country_Code as well, so these lead the index. The rest of the columns are
+-- the ones the summary, detail, validation and fingerprint queries read, so that they can be
+-- answered from the index alone without going back to the table. Origin, Destination,
+-- Mail_Category and Subclass come first so the detail subtotals can be grouped in index order.
+ALTER TABLE sales_data
+    ADD INDEX ix_sales_quarter_customer (Sub_Account_Type, Despatch_Year, Qtr, Country_Code,
+        Origin, Destination, Mail_Category, Subclass, Operator, PL,
+        Serial_Number, Despatch_Date, No_of_ItRates, Weight_Kgs);
+
+-- Sales rows are joined to their rates on these five columns. The four rates are included so
+-- the join never has to read the table itself.
+ALTER TABLE rates_data
+    ADD INDEX ix_rates_lookup (Despatch_Year, Operator, PL, Mail_Category, Subclass,
+        Rate_Ltr_Itm, Rate_Bulk_Itm, Rate_Ltr_Kg, Rate_Bulk_Kg);
@@ -0,0 +1,35 @@
+-- Quarterly rollup of sales_data for the summary invoices.
+
+-- One row for every combination of the columns the summary invoice groups by and the columns
+-- sales rows are joined to their rates on. The rates are not stored here, they are joined on
+-- when the summary is read, so editing a rate does not leave the rollup out of date.
+-- The totals have the same names as the sales_data columns they add up, so the summary
+-- queries can be pointed at this table without any other changes.
+CREATE TABLE sales_quarter_summary (
+    Sub_Account_Type VARCHAR(50) NOT NULL,
+    Despatch_Year SMALLINT NOT NULL,
+    Qtr TINYINT NOT NULL,
+    Country_Code CHAR(2) NOT NULL,
+    Operator CHAR(3) NOT NULL,
+    PL CHAR(2) NOT NULL,
+    Origin CHAR(6) NOT NULL,
+    Destination CHAR(6) NOT NULL,
+    Mail_Category CHAR(1) NOT NULL,
+    Subclass CHAR(2) NOT NULL,
+    No_of_ItRates BIGINT NOT NULL,
+    Weight_Kgs DECIMAL(16 , 4 ) NOT NULL,
+    Sales_Rows INT NOT NULL,
+    PRIMARY KEY (Sub_Account_Type, Despatch_Year, Qtr, Country_Code, Operator, PL,
+        Origin, Destination, Mail_Category, Subclass)
+);
+
+-- Filling it from the sales rows that are already loaded
+INSERT INTO sales_quarter_summary
+SELECT
+    COALESCE(Sub_Account_Type, ''), COALESCE(Despatch_Year, 0), COALESCE(Qtr, 0),
+    COALESCE(Country_Code, ''), COALESCE(Operator, ''), COALESCE(PL, ''),
+    COALESCE(Origin, ''), COALESCE(Destination, ''), COALESCE(Mail_Category, ''),
+    COALESCE(Subclass, ''),
+    COALESCE(SUM(No_of_ItRates), 0), COALESCE(SUM(Weight_Kgs), 0), COUNT(*)
+FROM sales_data
+GROUP BY 1, 2, 3, 4, 5, 6, 7, 8, 9, 10;
@@ -0,0 +1,149 @@
+"""
+Output Benchmark - compares the output profiles of the pdf invoices (see output_profiles in
+invoice_pdf_objects.py) by the size of the pdfs and how long they take.
+A summary invoice and a detail invoice are rendered from synthetic lines in each profile, and
+both rendering and outputting them are timed, as compressing the pages happens when the pdf is
+output. The standard profile is also compared against the pdfs as PyFPDF would write them, to
+make sure it makes no difference to the document. The linearized profile is left out if pikepdf
+is not installed.
+
+Usage:
+    python output_benchmark.py --lines 2000 --detail-lines 20000 --repeat 3
+"""
+
+import argparse
+import importlib.util
+import statistics
+import time
+
+from fpdf import FPDF
+
+from invoice_pdf_objects import DetailInvoice, SummaryInvoice, output_profiles
+from render_benchmark import address, signature, summary_lines, detail_lines, same_document
+
+
+def render(kind, lines, profile):
+    """
+    Renders and outputs an invoice into memory.
+    :param kind: 'summary' or 'detail'.
+    :param lines: List of tuples from summary_lines or detail_lines.
+    :param profile: The name of the output profile.
+    :return: Tuple of the invoice, the bytes of the pdf and the seconds taken.
+    """
+    start = time.perf_counter()
+
+    if kind == 'summary':
+        invoice = SummaryInvoice(address=address, year='2019', quarter='Q1',
+                                 sub_account='Standard', profile=profile)
+        invoice.insert_lines(lines)
+        pdf = invoice.output(file_name=None, **signature)
+    else:
+        invoice = DetailInvoice(customer='Customer Name', year='2019', quarter='Q1',
+                                profile=profile)
+        invoice.insert_lines(lines)
+        pdf = invoice.output()
+
+    return invoice, pdf, time.perf_counter() - start
+
+
+def plain_output(kind, lines):
+    """
+    Outputs an invoice the way PyFPDF itself would, into a string and with its own method of
+    writing the pages, as it was before the output profiles.
+    :param kind: 'summary' or 'detail'.
+    :param lines: List of tuples from summary_lines or detail_lines.
+    :return: Bytes of the pdf
+    """
+    if kind == 'summary':
+        invoice = SummaryInvoice(address=address, year='2019', quarter='Q1',
+                                 sub_account='Standard')
+    else:
+        invoice = DetailInvoice(customer='Customer Name', year='2019', quarter='Q1')
+
+    invoice.insert_lines(lines)
+    invoice.buffer = ''
+    invoice._putpages = FPDF._putpages.__get__(invoice)
+
+    if kind == 'summary':
+        return invoice.output(file_name=None, **signature)
+
+    return invoice.output()
+
+
+def measure(kind, lines, profiles, repeat):
+    """
+    Renders the same invoice a number of times in each profile, taking turns so that anything
+    else slowing the machine down affects them all the same.
+    :param kind: 'summary' or 'detail'.
+    :param lines: List of tuples from summary_lines or detail_lines.
+    :param profiles: List of the names of the output profiles.
+    :param repeat: How many times to render it in each profile.
+    :return: Dictionary of profile names to tuples of the bytes of the last pdf, its number of
+    pages and the median seconds.
+    """
+    seconds = {profile: [] for profile in profiles}
+    pdfs = {}
+
+    for _ in range(repeat):
+        for profile in profiles:
+            invoice, pdf, taken = render(kind, lines, profile)
+            seconds[profile].append(taken)
+            pdfs[profile] = (pdf, invoice.page_no())
+
+    return {profile: pdfs[profile] + (statistics.median(seconds[profile]),)
+            for profile in profiles}
+
+
+def main(argv=None):
+    """
+    Runs the benchmark and prints the results.
+    :param argv: List of command line arguments. Defaults to sys.argv.
+    :return: Dictionary of the results.
+    """
+    parser = argparse.ArgumentParser(description='Compares the output profiles of invoices.')
+    parser.add_argument('--lines', type=int, default=2000,
+                        help='Number of lines on the summary invoice.')
+    parser.add_argument('--detail-lines', type=int, default=20000,
+                        help='Number of lines on the detail invoice.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of times to render each invoice, the median is reported.')
+    args = parser.parse_args(argv)
+
+    profiles = [profile for profile, settings in output_profiles.items()
+                if not settings['linearize'] or importlib.util.find_spec('pikepdf') is not None]
+    skipped = [profile for profile in output_profiles if profile not in profiles]
+
+    results = {}
+
+    for kind, lines in (('summary', summary_lines(args.lines)),
+                        ('detail', detail_lines(args.detail_lines))):
+        # Rendering once first so that no profile pays for the imports and font setup
+        render(kind, lines[:10] + lines[-1:], 'standard')
+
+        measured = measure(kind, lines, profiles, args.repeat)
+        pages = measured['standard'][1]
+        results[kind] = {'pages': pages,
+                         'identical': same_document(measured['standard'][0],
+                                                    plain_output(kind, lines))}
+
+        print('{} invoice, {:,} line(s) over {:,} page(s).'.format(kind.capitalize(),
+                                                                   len(lines), pages))
+        for profile in profiles:
+            pdf, _, taken = measured[profile]
+            results[kind][profile] = {'bytes_per_page': round(len(pdf) / pages),
+                                      'ms_per_page': round(taken / pages * 1000, 3)}
+            print('{:<12}{:>10,} bytes per page{:>10.3f}ms per page'
+                  .format(profile, results[kind][profile]['bytes_per_page'],
+                          results[kind][profile]['ms_per_page']))
+        print('The standard profile and PyFPDF output are {}.'
+              .format('identical' if results[kind]['identical'] else 'DIFFERENT'))
+        print()
+
+    if skipped:
+        print('Left out {}, as pikepdf is not installed.'.format(', '.join(skipped)))
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
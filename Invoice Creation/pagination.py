@@ -0,0 +1,94 @@
+"""
+Pagination - works out where the pages of an invoice will break before it is rendered.
+The lines of a detail invoice come in groups, one for each rates combination, each ending in a
+totals row. Left to PyFPDF, a page simply breaks when the next line does not fit, which can split
+a short group across two pages or leave a totals row on its own at the top of a page. Knowing how
+many lines are in each group up front, the page breaks are planned in one pass instead. A group
+that fits on a page is never split, and the end of a longer group always keeps a few of its lines
+on the same page as its totals. The summary invoice is a single group, whose totals rows and
+ending tag are kept together in the same way.
+As the plan is only worked out from the number of lines, it also says how many pages an invoice
+will have before any of it is rendered.
+"""
+
+
+def group_sizes(lines, columns):
+    """
+    Counts the lines in each group of an invoice's lines, for lines that are already all held in
+    memory.
+    :param lines: List of lists (or tuples) of strings, as for the invoice's insert_line method.
+    :param columns: The number of columns of the invoice. Any line with fewer items is the end of
+    a group, such as a totals row.
+    :return: List of the number of lines before each group's end. Lines after the last end are
+    counted as one more group.
+    """
+    sizes = []
+    count = 0
+
+    for line_items in lines:
+        if len(line_items) == columns:
+            count += 1
+        else:
+            sizes.append(count)
+            count = 0
+
+    if count:
+        sizes.append(count)
+
+    return sizes
+
+
+def plan_pages(groups, page_lines, keep_lines=2, end_lines=1, used=0):
+    """
+    Works out how many lines go on each page.
+    Each group goes on the current page if it fits in what is left of it, and otherwise starts
+    a new page if it fits on a page of its own. A group too long for one page starts on the
+    current page and breaks wherever the pages are full, apart from its last keep_lines lines,
+    which go on the same page as its end.
+    :param groups: Iterable of the number of lines before each group's end, see group_sizes.
+    :param page_lines: The number of lines that fit on a page.
+    :param keep_lines: The fewest lines of a long group kept on the same page as its end.
+    :param end_lines: The number of lines the end of each group takes up, which always go on
+    the same page.
+    :param used: The number of lines already on the first page.
+    :return: List of the number of lines on each page. Its length is the number of pages.
+    """
+    if end_lines + keep_lines > page_lines:
+        raise ValueError('The end of a group takes {} lines but only {} fit on a page.'
+                         .format(end_lines + keep_lines, page_lines))
+
+    pages = []
+
+    for lines in groups:
+        size = lines + end_lines
+
+        if used + size <= page_lines:
+            used += size
+            continue
+
+        if size <= page_lines:
+            pages.append(used)
+            used = size
+            continue
+
+        # The lines that can break anywhere, and the ones that stay with the end
+        tail = min(lines, keep_lines) + end_lines
+        head = lines - min(lines, keep_lines)
+
+        while head > 0:
+            if used == page_lines:
+                pages.append(used)
+                used = 0
+
+            taken = min(head, page_lines - used)
+            used += taken
+            head -= taken
+
+        if used + tail > page_lines:
+            pages.append(used)
+            used = 0
+        used += tail
+
+    pages.append(used)
+
+    return pages
@@ -1,19 +1,23 @@
-import mysql.connector
 import csv
 
+import migrate
+import quarter_summary
+
 file = 'MyFile.csv'
 
-cnx = mysql.connector.connect(user='user', password='password',
-                              host='host',
-                              database='billings')
+# Connects to the database in the params shelve, which can be MySQL or SQLite
+cnx = migrate.connect()
 
 mycursor = cnx.cursor()
 
 SQL = "INSERT INTO sales_data (Sub_Account_Type, Despatch_Year, Despatch_Month, Despatch_Date, " \
       "Qtr, Despatch_ID, Serial_Number, Origin, Destination, Mail_Category, Class, Subclass, " \
-      "PL, Country_Office, Country_Code, No_of_ItRates, Weight_Kgs) " \
+      "PL, Operator, Country_Code, No_of_ItRates, Weight_Kgs) " \
       "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);"
 
+# Totals for the sales_quarter_summary rollup, added on once all the rows are in
+deltas = {}
+
 with open(file) as my_file:
     reader = csv.reader(my_file)
 
@@ -25,6 +29,9 @@ with open(file) as my_file:
         row[-1] = float(row[-1])
 
         mycursor.execute(SQL, tuple(row))
+        quarter_summary.add_sales_row(deltas, row)
+
+quarter_summary.apply_deltas(mycursor, deltas)
 
 cnx.commit()
 
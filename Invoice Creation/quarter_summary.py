@@ -0,0 +1,207 @@
+"""
+Quarter Summary - keeps the sales_quarter_summary table (see migrations) up to date.
+The table holds the item and weight totals of sales_data for every combination of the columns
+the summary invoice groups by, so the summary invoices can be read from a few hundred rollup
+rows instead of adding up every sales row in the quarter.
+Loaders add to the rollup as they insert sales rows with add_sales_row and apply_deltas. If
+sales rows are ever edited or deleted, the quarter can be rebuilt from scratch, and the check
+compares the rollup against the live totals from sales_data.
+
+Usage:
+    python quarter_summary.py --check
+    python quarter_summary.py --rebuild
+
+Both work on the sub account, year and quarter in the params shelve database.
+"""
+
+import argparse
+import shelve
+from decimal import Decimal
+
+import migrate
+
+# The columns that identify a row of the rollup
+key_columns = ('Sub_Account_Type', 'Despatch_Year', 'Qtr', 'Country_Code', 'Operator', 'PL',
+               'Origin', 'Destination', 'Mail_Category', 'Subclass')
+
+# Where the key columns and the totalled columns are in a sales row, in the order that
+# populating_sales_data.py inserts them
+sales_row_key = (0, 1, 4, 14, 13, 12, 7, 8, 9, 11)
+sales_row_items = 15
+sales_row_weight = 16
+
+# sales_data keeps weights to 4 decimal places, so rows are rounded to match as they are added up
+weight_places = Decimal('0.0001')
+
+# Adds a set of totals onto the matching rollup row, creating it if it is new
+upsert_sql = 'INSERT INTO sales_quarter_summary ' \
+             'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) ' \
+             'ON DUPLICATE KEY UPDATE ' \
+             'No_of_ItRates = No_of_ItRates + VALUES(No_of_ItRates), ' \
+             'Weight_Kgs = Weight_Kgs + VALUES(Weight_Kgs), ' \
+             'Sales_Rows = Sales_Rows + VALUES(Sales_Rows);'
+
+delete_sql = 'DELETE FROM sales_quarter_summary ' \
+             'WHERE ' \
+             'Sub_Account_Type = %(sub_account)s AND ' \
+             'Despatch_Year = %(year)s AND ' \
+             'Qtr = %(qtr)s;'
+
+rebuild_sql = 'INSERT INTO sales_quarter_summary ' \
+              'SELECT ' \
+              'COALESCE(Sub_Account_Type, \'\'), COALESCE(Despatch_Year, 0), ' \
+              'COALESCE(Qtr, 0), COALESCE(Country_Code, \'\'), COALESCE(Operator, \'\'), ' \
+              'COALESCE(PL, \'\'), COALESCE(Origin, \'\'), COALESCE(Destination, \'\'), ' \
+              'COALESCE(Mail_Category, \'\'), COALESCE(Subclass, \'\'), ' \
+              'COALESCE(SUM(No_of_ItRates), 0), COALESCE(SUM(Weight_Kgs), 0), COUNT(*) ' \
+              '' \
+              'FROM sales_data ' \
+              '' \
+              'WHERE ' \
+              'Sub_Account_Type = %(sub_account)s AND ' \
+              'Despatch_Year = %(year)s AND ' \
+              'Qtr = %(qtr)s ' \
+              '' \
+              'GROUP BY 1, 2, 3, 4, 5, 6, 7, 8, 9, 10;'
+
+# Adds up the live totals and takes away the rollup totals for each group in the quarter.
+# Any group that does not come out at zero is out of step. SQLite adds up the weights in floating
+# point, so a weight difference only counts from half of the last of its 4 decimal places.
+check_sql = 'SELECT ' \
+            'Country_Code, Operator, PL, Origin, Destination, Mail_Category, Subclass, ' \
+            'SUM(No_of_ItRates), SUM(Weight_Kgs), SUM(Sales_Rows) ' \
+            '' \
+            'FROM (' \
+            'SELECT ' \
+            'COALESCE(Country_Code, \'\') AS Country_Code, ' \
+            'COALESCE(Operator, \'\') AS Operator, ' \
+            'COALESCE(PL, \'\') AS PL, COALESCE(Origin, \'\') AS Origin, ' \
+            'COALESCE(Destination, \'\') AS Destination, ' \
+            'COALESCE(Mail_Category, \'\') AS Mail_Category, ' \
+            'COALESCE(Subclass, \'\') AS Subclass, ' \
+            'COALESCE(No_of_ItRates, 0) AS No_of_ItRates, ' \
+            'COALESCE(Weight_Kgs, 0) AS Weight_Kgs, ' \
+            '1 AS Sales_Rows ' \
+            'FROM sales_data ' \
+            'WHERE ' \
+            'Sub_Account_Type = %(sub_account)s AND ' \
+            'Despatch_Year = %(year)s AND ' \
+            'Qtr = %(qtr)s ' \
+            '' \
+            'UNION ALL ' \
+            '' \
+            'SELECT ' \
+            'Country_Code, Operator, PL, Origin, Destination, Mail_Category, Subclass, ' \
+            '-No_of_ItRates, -Weight_Kgs, -Sales_Rows ' \
+            'FROM sales_quarter_summary ' \
+            'WHERE ' \
+            'Sub_Account_Type = %(sub_account)s AND ' \
+            'Despatch_Year = %(year)s AND ' \
+            'Qtr = %(qtr)s' \
+            ') differences ' \
+            '' \
+            'GROUP BY Country_Code, Operator, PL, Origin, Destination, Mail_Category, Subclass ' \
+            '' \
+            'HAVING SUM(No_of_ItRates) <> 0 OR ABS(SUM(Weight_Kgs)) >= 0.00005 OR ' \
+            'SUM(Sales_Rows) <> 0 ' \
+            '' \
+            'ORDER BY Country_Code, Operator, PL, Origin, Destination, Mail_Category, Subclass;'
+
+
+def add_sales_row(deltas, row):
+    """
+    Adds a sales row that is being inserted onto the totals waiting to go into the rollup.
+    :param deltas: Dictionary of rollup keys to lists of item, weight and row totals. Start
+    with an empty dictionary and pass it to apply_deltas once all the rows are inserted.
+    :param row: Tuple of sales_data values, in the order populating_sales_data.py inserts them.
+    :return: None
+    """
+    key = tuple([row[i] for i in sales_row_key])
+    totals = deltas.setdefault(key, [0, Decimal(0), 0])
+    totals[0] += row[sales_row_items]
+    totals[1] += Decimal(str(row[sales_row_weight])).quantize(weight_places)
+    totals[2] += 1
+
+
+def apply_deltas(cursor, deltas):
+    """
+    Adds the waiting totals onto the rollup. This should be done before the sales rows are
+    committed, so that the sales rows and the rollup are committed together.
+    :param cursor: MySQL cursor.
+    :param deltas: Dictionary built up by add_sales_row.
+    :return: The number of rollup rows that were added to.
+    """
+    if deltas:
+        cursor.executemany(upsert_sql, [key + tuple(totals) for key, totals in deltas.items()])
+
+    return len(deltas)
+
+
+def rebuild_quarter(cnx, param_dict):
+    """
+    Replaces the rollup rows for a quarter with fresh totals from sales_data.
+    :param cnx: MySQL connection.
+    :param param_dict: Dictionary with the year, sub_account and qtr.
+    :return: The number of rollup rows written.
+    """
+    cursor = cnx.cursor()
+    cursor.execute(delete_sql, param_dict)
+    cursor.execute(rebuild_sql, param_dict)
+    row_count = cursor.rowcount
+    cursor.close()
+    cnx.commit()
+
+    return row_count
+
+
+def check_message(differences):
+    """
+    Describes the result of check_sql.
+    :param differences: The rows returned by check_sql.
+    :return: String
+    """
+    if not differences:
+        return 'The rollup matches the sales data.'
+
+    lines = ['{} rollup group(s) do not match the sales data '
+             '(live minus rollup items, weight and rows):'.format(len(differences))]
+    for row in differences:
+        lines.append('\t{} {} {} {} {} {} {}: {}, {}, {}'.format(*row))
+
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """
+    Checks or rebuilds the rollup for the quarter in the params shelve database.
+    :param argv: List of command line arguments. Defaults to sys.argv.
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description='Checks or rebuilds the quarterly rollup.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--check', action='store_true',
+                       help='Compare the rollup against the live sales data.')
+    group.add_argument('--rebuild', action='store_true',
+                       help='Rebuild the rollup from the live sales data.')
+    args = parser.parse_args(argv)
+
+    with shelve.open('params') as data_base:
+        param_dict = {'year': data_base['year'],
+                      'sub_account': data_base['sub_account'],
+                      'qtr': data_base['qtr']}
+
+    cnx = migrate.connect()
+
+    if args.rebuild:
+        print('{} rollup rows written.'.format(rebuild_quarter(cnx, param_dict)))
+    else:
+        cursor = cnx.cursor()
+        cursor.execute(check_sql, param_dict)
+        print(check_message(cursor.fetchall()))
+        cursor.close()
+
+    cnx.close()
+
+
+if __name__ == '__main__':
+    main()
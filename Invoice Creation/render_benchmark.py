@@ -0,0 +1,268 @@
+"""
+Render Benchmark - measures how long the pdf invoices take to render, per page.
+A summary invoice is rendered from synthetic lines with its header drawn on every page, and
+again with the header drawn once and copied onto later pages (see SummaryInvoice.header). Both
+are rendered into memory, so only rendering is timed, and the two pdfs are compared to make sure
+the copied header makes no difference to the document.
+A detail invoice is also rendered from synthetic lines, added one at a time with insert_line and
+all at once with insert_lines, and the two pdfs compared in the same way. Only adding the lines
+is timed, as finishing the pdf takes the same time either way.
+
+Usage:
+    python render_benchmark.py --lines 2000 --repeat 5 --detail-lines 100000
+"""
+
+import argparse
+import random
+import re
+import statistics
+import time
+
+from invoice_pdf_objects import DetailInvoice, SummaryInvoice
+
+# Used for the address, officer, department and company on the synthetic invoices
+address = 'Customer Name\n1 Example Street\nExample City\nExample Country'
+signature = {'name': 'Officer Name', 'department': 'Accounts Department',
+             'company': 'Example Company'}
+
+
+class TimedSummaryInvoice(SummaryInvoice):
+    """
+    Summary invoice that adds up the time spent in the header, as well as rendering as usual.
+    """
+
+    header_seconds = 0
+
+    def header(self):
+        start = time.perf_counter()
+        super().header()
+        self.header_seconds += time.perf_counter() - start
+
+
+def summary_lines(count, seed=0):
+    """
+    Makes up lines for a summary invoice, formatted the way invoice_creation.py formats them.
+    :param count: The number of lines, not counting the totals.
+    :param seed: Seed for the random numbers, so every run renders the same invoice.
+    :return: List of tuples of strings, ending with the totals.
+    """
+    rand = random.Random(seed)
+    lines = []
+
+    for num in range(count):
+        items = rand.randint(1, 5000)
+        weight = rand.uniform(1, 2000)
+        lines.append(('AAX', 'AUSYDA', 'AA{:04}'.format(num % 10000), 'A', 'UA',
+                      '{:,}'.format(items), '{:,.2f}'.format(weight), '1.2345', '1.2345',
+                      '{:,.2f}'.format(items * 1.2345), '2.3456', '2.3456',
+                      '{:,.2f}'.format(weight * 2.3456),
+                      '{:,.2f}'.format(items * 1.2345 + weight * 2.3456)))
+
+    lines.append(('1,000', '2,000.00', '3,000.00', '4,000.00', '$7,000.00'))
+
+    return lines
+
+
+def detail_lines(count, seed=0):
+    """
+    Makes up lines for a detail invoice, formatted the way invoice_creation.py formats them,
+    with a totals row after each despatch date.
+    :param count: The number of lines, not counting the totals.
+    :param seed: Seed for the random numbers, so every run renders the same invoice.
+    :return: List of tuples of strings.
+    """
+    rand = random.Random(seed)
+    lines = []
+    items_total = 0
+    weight_total = 0
+
+    for num in range(count):
+        items = rand.randint(1, 50)
+        weight = rand.uniform(0.1, 30)
+        items_total += items
+        weight_total += weight
+        lines.append(('2019-01-{:02}'.format(num // 1000 % 28 + 1), 'AUSYDA',
+                      'AA{:04}'.format(num % 10000), 'A', 'UA',
+                      'EE{:09}AU'.format(rand.randint(0, 10 ** 9 - 1)),
+                      '{:,}'.format(items), '{:,.2f}'.format(weight)))
+
+        if num % 1000 == 999 or num == count - 1:
+            lines.append(('{:,}'.format(items_total), '{:,.2f}'.format(weight_total)))
+            items_total = 0
+            weight_total = 0
+
+    return lines
+
+
+def render_detail(lines, bulk):
+    """
+    Adds lines to a detail invoice.
+    :param lines: List of tuples from detail_lines.
+    :param bulk: Whether the lines are added all at once with insert_lines, rather than one at a
+    time with insert_line.
+    :return: Tuple of the invoice, not yet output, and the seconds taken.
+    """
+    start = time.perf_counter()
+
+    invoice = DetailInvoice(customer='Customer Name', year='2019', quarter='Q1')
+
+    # Handed over as an iterator, so that the pages are not planned and break in the same
+    # places as adding the lines one at a time
+    if bulk:
+        invoice.insert_lines(iter(lines))
+    else:
+        for line in lines:
+            invoice.insert_line(line)
+
+    return invoice, time.perf_counter() - start
+
+
+def render_summary(lines, cache_header):
+    """
+    Renders a summary invoice into memory.
+    :param lines: List of tuples from summary_lines.
+    :param cache_header: Whether the header is copied onto later pages instead of redrawn.
+    :return: Tuple of the bytes of the pdf, its number of pages, the seconds taken and the
+    seconds of that spent in the header.
+    """
+    start = time.perf_counter()
+
+    invoice = TimedSummaryInvoice(address=address, year='2019', quarter='Q1',
+                                  sub_account='Standard')
+    invoice.cache_header = cache_header
+
+    for line in lines:
+        invoice.insert_line(line)
+
+    pdf = invoice.output(file_name=None, **signature)
+
+    return pdf, invoice.page_no(), time.perf_counter() - start, invoice.header_seconds
+
+
+def same_document(first, second):
+    """
+    Compares two pdfs, leaving out the creation date which is down to the second.
+    :param first: Bytes of a pdf.
+    :param second: Bytes of a pdf.
+    :return: Boolean
+    """
+    pattern = re.compile(rb'/CreationDate \(D:\d+\)')
+    return pattern.sub(b'', first) == pattern.sub(b'', second)
+
+
+def measure(lines, repeat):
+    """
+    Renders the same invoice a number of times with the header drawn on every page and with it
+    copied, taking turns so that anything else slowing the machine down affects both the same.
+    :param lines: List of tuples from summary_lines.
+    :param repeat: How many times to render it each way.
+    :return: Dictionary of False (drawn) and True (copied) to tuples of the bytes of the last
+    pdf, its number of pages, the median seconds and the median seconds spent in the header.
+    """
+    seconds = {False: [], True: []}
+    header_seconds = {False: [], True: []}
+    pdfs = {}
+
+    for _ in range(repeat):
+        for cache_header in seconds:
+            pdf, pages, taken, header_taken = render_summary(lines, cache_header)
+            seconds[cache_header].append(taken)
+            header_seconds[cache_header].append(header_taken)
+            pdfs[cache_header] = (pdf, pages)
+
+    return {cache_header: pdfs[cache_header] + (statistics.median(seconds[cache_header]),
+                                                statistics.median(header_seconds[cache_header]))
+            for cache_header in seconds}
+
+
+def measure_detail(lines, repeat):
+    """
+    Renders the same detail invoice a number of times one line at a time and all at once,
+    taking turns in the same way as measure.
+    :param lines: List of tuples from detail_lines.
+    :param repeat: How many times to render it each way.
+    :return: Dictionary of False (one at a time) and True (all at once) to tuples of the bytes
+    of the last pdf, its number of pages and the median seconds.
+    """
+    seconds = {False: [], True: []}
+    invoices = {}
+
+    for _ in range(repeat):
+        for bulk in seconds:
+            invoices[bulk], taken = render_detail(lines, bulk)
+            seconds[bulk].append(taken)
+
+    return {bulk: (invoices[bulk].output(), invoices[bulk].page_no(),
+                   statistics.median(seconds[bulk]))
+            for bulk in seconds}
+
+
+def main(argv=None):
+    """
+    Runs the benchmark and prints the results.
+    :param argv: List of command line arguments. Defaults to sys.argv.
+    :return: Dictionary of the results.
+    """
+    parser = argparse.ArgumentParser(description='Measures how long invoices take to render.')
+    parser.add_argument('--lines', type=int, default=2000,
+                        help='Number of lines on the summary invoice.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of times to render it, the median is reported.')
+    parser.add_argument('--detail-lines', type=int, default=100000,
+                        help='Number of lines on the detail invoice, 0 to leave it out.')
+    parser.add_argument('--detail-repeat', type=int, default=1,
+                        help='Number of times to render the detail invoice.')
+    args = parser.parse_args(argv)
+
+    lines = summary_lines(args.lines)
+    # Rendering once first so that neither mode pays for the imports and font setup
+    render_summary(lines[:10] + lines[-1:], True)
+
+    measured = measure(lines, args.repeat)
+    before_pdf, pages, before, before_header = measured[False]
+    after_pdf, _, after, after_header = measured[True]
+
+    results = {'lines': args.lines,
+               'pages': pages,
+               'before_ms_per_page': round(before / pages * 1000, 3),
+               'after_ms_per_page': round(after / pages * 1000, 3),
+               'before_header_ms_per_page': round(before_header / pages * 1000, 3),
+               'after_header_ms_per_page': round(after_header / pages * 1000, 3),
+               'identical': same_document(before_pdf, after_pdf)}
+
+    print('Summary invoice, {lines:,} line(s) over {pages:,} page(s).'.format(**results))
+    print('Header drawn on every page: {before_ms_per_page}ms per page, '
+          '{before_header_ms_per_page}ms of it in the header.'.format(**results))
+    print('Header copied onto later pages: {after_ms_per_page}ms per page ({:.1f}% faster), '
+          '{after_header_ms_per_page}ms of it in the header.'
+          .format((before - after) / before * 100, **results))
+    print('The two pdfs are {}.'.format('identical' if results['identical'] else 'DIFFERENT'))
+
+    if args.detail_lines:
+        lines = detail_lines(args.detail_lines)
+        render_detail(lines[:10], True)
+
+        measured = measure_detail(lines, args.detail_repeat)
+        before_pdf, pages, before = measured[False]
+        after_pdf, _, after = measured[True]
+
+        results.update({'detail_lines': args.detail_lines,
+                        'detail_pages': pages,
+                        'detail_before_seconds': round(before, 3),
+                        'detail_after_seconds': round(after, 3),
+                        'detail_identical': same_document(before_pdf, after_pdf)})
+
+        print()
+        print('Detail invoice, {detail_lines:,} line(s) over {detail_pages:,} page(s).'
+              .format(**results))
+        print('Lines added one at a time: {detail_before_seconds}s.'.format(**results))
+        print('Lines added all at once: {detail_after_seconds}s ({:.1f}x as fast).'
+              .format(before / after, **results))
+        print('The two pdfs are {}.'.format('identical' if results['detail_identical']
+                                            else 'DIFFERENT'))
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
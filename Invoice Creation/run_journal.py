@@ -0,0 +1,124 @@
+"""
+Run Journal - records how far each customer got in an invoice run in a SQLite database.
+If a run crashes or the email server drops out part of the way through, the run can be
+resumed with the same run ID and the journal is used to skip the work that was already done.
+"""
+
+import sqlite3
+from datetime import datetime
+
+
+class RunJournal:
+    """
+    Class for reading and writing the run journal.
+    A new connection is opened for every read and write so that the journal can be shared by
+    worker processes and threads, with SQLite taking care of the locking.
+    """
+
+    # The stages a customer goes through, in order. emails_sent is recorded after each email of
+    # an invoice that is sent over several, and emailed once they have all been sent.
+    stages = ('fetched', 'summary_rendered', 'detail_rendered', 'emails_sent', 'emailed')
+
+    def __init__(self, file_name, run_id):
+        """
+        Initialise class
+        Creates the journal table if the database file is new.
+        :param file_name: The SQLite database file. Can include path.
+        :param run_id: String identifying the run. Resuming a run means using its run ID again.
+        """
+        self.file_name = file_name
+        self.run_id = run_id
+
+        with self._connect() as cnx:
+            cnx.execute('CREATE TABLE IF NOT EXISTS journal ('
+                        'Run_ID TEXT NOT NULL, '
+                        'Country_Code TEXT NOT NULL, '
+                        'Stage TEXT NOT NULL, '
+                        'Detail TEXT, '
+                        'Recorded TEXT NOT NULL, '
+                        'PRIMARY KEY (Run_ID, Country_Code, Stage));')
+            cnx.execute('CREATE TABLE IF NOT EXISTS fingerprints ('
+                        'Country_Code TEXT NOT NULL, '
+                        'Quarter TEXT NOT NULL, '
+                        'Fingerprint TEXT NOT NULL, '
+                        'Run_ID TEXT NOT NULL, '
+                        'Recorded TEXT NOT NULL, '
+                        'PRIMARY KEY (Country_Code, Quarter));')
+        cnx.close()
+
+    def _connect(self):
+        """
+        Opens a connection to the journal, waiting up to 30 seconds if another process is
+        writing to it.
+        :return: sqlite3 Connection
+        """
+        return sqlite3.connect(self.file_name, timeout=30)
+
+    def record(self, customer, stage, detail=None):
+        """
+        Records that a customer has finished a stage of this run.
+        :param customer: The Country_Code of the customer.
+        :param stage: One of the names in the stages class attribute.
+        :param detail: Optional string to keep with the stage, such as a file name.
+        :return: None
+        """
+        assert stage in self.stages
+
+        with self._connect() as cnx:
+            cnx.execute('INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?);',
+                        (self.run_id, customer, stage, detail,
+                         datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        cnx.close()
+
+    def completed(self, customer):
+        """
+        Looks up the stages a customer has already finished in this run.
+        :param customer: The Country_Code of the customer.
+        :return: Dictionary of stage names to the detail recorded with them.
+        """
+        cnx = self._connect()
+        rows = cnx.execute('SELECT Stage, Detail FROM journal '
+                           'WHERE Run_ID = ? AND Country_Code = ?;',
+                           (self.run_id, customer)).fetchall()
+        cnx.close()
+        return dict(rows)
+
+    def run_exists(self):
+        """
+        Checks whether anything has been recorded for this run yet.
+        :return: Boolean
+        """
+        cnx = self._connect()
+        row = cnx.execute('SELECT COUNT(*) FROM journal WHERE Run_ID = ?;',
+                          (self.run_id,)).fetchone()
+        cnx.close()
+        return row[0] > 0
+
+    def save_fingerprint(self, customer, quarter, fingerprint):
+        """
+        Remembers the fingerprint of the data a customer was last invoiced from, so that later
+        runs of the same quarter can tell whether anything has changed.
+        :param customer: The Country_Code of the customer.
+        :param quarter: String identifying the sub account, year and quarter.
+        :param fingerprint: String fingerprint of the customer's data.
+        :return: None
+        """
+        with self._connect() as cnx:
+            cnx.execute('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?);',
+                        (customer, quarter, fingerprint, self.run_id,
+                         datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        cnx.close()
+
+    def last_fingerprint(self, customer, quarter):
+        """
+        Looks up the fingerprint a customer was last invoiced from for a quarter.
+        :param customer: The Country_Code of the customer.
+        :param quarter: String identifying the sub account, year and quarter.
+        :return: Tuple of the fingerprint and the run ID it was saved in, or None.
+        """
+        cnx = self._connect()
+        row = cnx.execute('SELECT Fingerprint, Run_ID FROM fingerprints '
+                          'WHERE Country_Code = ? AND Quarter = ?;',
+                          (customer, quarter)).fetchone()
+        cnx.close()
+        return row
@@ -0,0 +1,184 @@
+"""
+Run Log - writes the full log and error log of an invoice run.
+The logs are kept open for the whole run instead of being opened and closed again for every
+customer, which is slow when the logs are kept on a network share. Writes are buffered, and a
+background thread flushes them every few seconds so the logs can still be followed during a run.
+Anything left is flushed when the log is closed, or when Python exits if the run falls over.
+A JSON lines version of the full log can also be written, with one object per customer, for
+other programs to read.
+"""
+
+import atexit
+import json
+import threading
+from datetime import datetime
+
+
+class RunLog:
+    """
+    The logs of one run. Customers are numbered in the order they are logged, separately in the
+    full log and the error log. Can be used in a with block, which closes it at the end.
+    """
+
+    # Size of the write buffer of each log file, in bytes
+    buffer_bytes = 64 * 1024
+
+    def __init__(self, full_log, err_log=None, jsonl_log=None, flush_seconds=5):
+        """
+        Initialise class
+        :param full_log: The txt file every customer is logged to. Can include path.
+        :param err_log: The txt file customers with errors are also logged to. It is only
+        created once there is an error to log. None to leave out.
+        :param jsonl_log: The JSON lines file customers are also logged to. None to leave out.
+        :param flush_seconds: How often the logs are flushed to disk. None only flushes them
+        when the log is closed.
+        """
+        self.file_names = {'full': full_log, 'error': err_log, 'jsonl': jsonl_log}
+        self.flush_seconds = flush_seconds
+        self.count = 0
+        self.err_num = 0
+
+        self._files = {}
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flusher = None
+
+        if flush_seconds is not None:
+            self._flusher = threading.Thread(target=self._flush_loop, name='RUN LOG',
+                                             daemon=True)
+            self._flusher.start()
+
+        atexit.register(self.close)
+
+    def _file(self, kind):
+        """
+        Opens one of the log files the first time it is written to.
+        :param kind: 'full', 'error' or 'jsonl'.
+        :return: The open file, or None if that log is left out.
+        """
+        if kind not in self._files:
+            if self.file_names[kind] is None:
+                self._files[kind] = None
+            else:
+                self._files[kind] = open(self.file_names[kind], 'a',
+                                         buffering=self.buffer_bytes)
+
+        return self._files[kind]
+
+    def _write(self, kind, text):
+        """
+        Writes a line of text to one of the logs.
+        :param kind: 'full', 'error' or 'jsonl'.
+        :param text: String, without the line ending.
+        :return: None
+        """
+        with self._lock:
+            if self._closed.is_set():
+                raise ValueError('The run log is closed.')
+
+            log_file = self._file(kind)
+            if log_file is not None:
+                print(text, file=log_file)
+
+    def customer(self, result):
+        """
+        Logs the outcome of a customer to the full log, the error log if it is an error, and the
+        JSON lines log.
+        :param result: Dictionary with the customer, message and error keys, see
+        invoice_creation.process_customer.
+        :return: None
+        """
+        self.count += 1
+        self._write('full', '{}. {}\n{}'.format(self.count, result['customer'],
+                                                result['message']))
+
+        if result['error']:
+            self.err_num += 1
+            self._write('error', '{}. {}\n{}'.format(self.err_num, result['customer'],
+                                                     result['message']))
+
+        self.record({'num': self.count,
+                     'customer': result['customer'],
+                     'error': result['error'],
+                     'message': result['message'],
+                     'logged': datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+
+    def error(self, customer, message):
+        """
+        Logs an error that belongs to a customer already logged by the customer method, such
+        as an invoice that could not be saved once the customer was done with. It goes in the
+        error log and is counted in err_num like any other, and under the customer's name, but
+        without a number, in the full log, so that the customer is not counted twice.
+        :param customer: The Country_Code of the customer.
+        :param message: String describing the error.
+        :return: None
+        """
+        self.err_num += 1
+        self._write('full', '{}\n{}'.format(customer, message))
+        self._write('error', '{}. {}\n{}'.format(self.err_num, customer, message))
+
+        self.record({'num': None,
+                     'customer': customer,
+                     'error': True,
+                     'message': message,
+                     'logged': datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+
+    def write(self, text=''):
+        """
+        Writes a line to the full log only, such as the lines at the end of the run.
+        :param text: String, without the line ending.
+        :return: None
+        """
+        self._write('full', text)
+
+    def record(self, values):
+        """
+        Writes an object to the JSON lines log only.
+        :param values: Dictionary that can be turned into JSON.
+        :return: None
+        """
+        self._write('jsonl', json.dumps(values))
+
+    def flush(self):
+        """
+        Flushes whatever has been written so far to disk.
+        :return: None
+        """
+        with self._lock:
+            for log_file in self._files.values():
+                if log_file is not None and not log_file.closed:
+                    log_file.flush()
+
+    def _flush_loop(self):
+        """
+        Flushes the logs every flush_seconds until the log is closed.
+        :return: None
+        """
+        while not self._closed.wait(self.flush_seconds):
+            self.flush()
+
+    def close(self):
+        """
+        Flushes and closes the logs. Does nothing if they are already closed.
+        :return: None
+        """
+        with self._lock:
+            if self._closed.is_set():
+                return
+
+            self._closed.set()
+
+            for log_file in self._files.values():
+                if log_file is not None:
+                    log_file.close()
+
+        if self._flusher is not None:
+            self._flusher.join()
+
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,155 @@
+"""
+Run Timings - records how long each stage of the invoice run takes for each customer.
+Every stage that is timed, such as getting a connection, each query, rendering each invoice and
+sending the email, becomes one record. The records are saved as JSON lines at the end of the run
+and summarised in the run log with the median, 95th percentile and slowest time of each stage.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def percentile(values, pct):
+    """
+    Works out a percentile using the nearest rank method.
+    :param values: Sorted list of numbers.
+    :param pct: The percentile wanted, between 0 and 100.
+    :return: The value at that percentile, or None if there are no values.
+    """
+    if not values:
+        return None
+
+    rank = max(math.ceil(pct / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+class RunTimer:
+    """
+    Collects the timing records for a run. Can be shared by threads.
+    When sent to a worker process it arrives empty, so that each process only holds the records
+    of the work it did, and the main process collects them with the take and extend methods.
+    """
+
+    def __init__(self):
+        """
+        Initialise class
+        """
+        self.records = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """
+        Called when the timer is pickled to be sent to a worker process. The lock and the
+        records of the main process are left behind.
+        :return: Dictionary of the instance attributes
+        """
+        return {'records': []}
+
+    def __setstate__(self, state):
+        """
+        Called when the timer is unpickled in a worker process. Recreates the lock that was
+        left out by __getstate__.
+        :param state: Dictionary of the instance attributes
+        :return: None
+        """
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, stage, customer=None):
+        """
+        Times the code inside a with block and records it, even if the code raises an error.
+        :param stage: Name of the stage, such as 'detail render'.
+        :param customer: The Country_Code the work was for. None for work on the whole quarter.
+        :return: Context manager
+        """
+        started = datetime.now()
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            record = {'customer': customer,
+                      'stage': stage,
+                      'started': started.strftime('%Y-%m-%d %H:%M:%S.%f'),
+                      'seconds': round(time.perf_counter() - start, 6),
+                      'process': os.getpid(),
+                      'thread': threading.current_thread().name}
+
+            with self._lock:
+                self.records.append(record)
+
+    def take(self):
+        """
+        Hands over the records collected so far and starts again with none.
+        :return: List of record dictionaries
+        """
+        with self._lock:
+            records, self.records = self.records, []
+
+        return records
+
+    def extend(self, records):
+        """
+        Adds records collected somewhere else, such as in a worker process.
+        :param records: List of record dictionaries
+        :return: None
+        """
+        with self._lock:
+            self.records.extend(records)
+
+    def write(self, file_name):
+        """
+        Saves the records as JSON lines, one record per line.
+        :param file_name: The file to write to. Can include path.
+        :return: None
+        """
+        with self._lock:
+            records = list(self.records)
+
+        with open(file_name, 'w') as timings_file:
+            for record in records:
+                print(json.dumps(record), file=timings_file)
+
+    def customer_totals(self):
+        """
+        Adds up the time spent on each customer, leaving out the work on the whole quarter.
+        :return: Dictionary of Country_Codes to seconds.
+        """
+        totals = {}
+
+        with self._lock:
+            for record in self.records:
+                if record['customer'] is not None:
+                    totals[record['customer']] = totals.get(record['customer'], 0) + \
+                                                 record['seconds']
+
+        return totals
+
+    def summary(self):
+        """
+        Summarises each stage for the run log, in the order the stages were first recorded.
+        :return: List of strings
+        """
+        stages = {}
+
+        with self._lock:
+            for record in self.records:
+                stages.setdefault(record['stage'], []).append(record['seconds'])
+
+        lines = []
+
+        for stage, seconds in stages.items():
+            seconds.sort()
+            lines.append('{}: {} time(s), p50 {:.1f}ms, p95 {:.1f}ms, max {:.1f}ms, '
+                         'total {:.2f}s.'.format(stage, len(seconds),
+                                                 percentile(seconds, 50) * 1000,
+                                                 percentile(seconds, 95) * 1000,
+                                                 seconds[-1] * 1000, sum(seconds)))
+
+        return lines
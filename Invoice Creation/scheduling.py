@@ -0,0 +1,88 @@
+"""
+Scheduling - decides the order customers are handed out in a parallel run.
+Handing customers out in Country_Code order can leave one or two of the biggest customers
+running on their own at the end of the run while every other worker sits idle. Instead each
+customer's cost is estimated from its sales rows and lanes, and the most expensive customers are
+handed out first (longest processing time first), so the small ones fill in the gaps at the end.
+The makespan, the time until the last worker finishes, is worked out for both orders so the
+gain can be checked in the run log.
+"""
+
+import heapq
+
+
+def lpt_order(customers, costs):
+    """
+    Puts the customers in longest processing time first order.
+    :param customers: Tuple of Country_Codes in their usual order.
+    :param costs: Dictionary of Country_Codes to their estimated cost.
+    :return: Tuple of Country_Codes, most expensive first. Customers with the same cost stay in
+    their usual order.
+    """
+    position = {customer: num for num, customer in enumerate(customers)}
+
+    return tuple(sorted(customers, key=lambda x: (-costs.get(x, 0), position[x])))
+
+
+def makespan(order, durations, workers):
+    """
+    Works out how long a run would take if each customer, in order, went to whichever worker
+    was free first.
+    :param order: Tuple of Country_Codes in the order they are handed out.
+    :param durations: Dictionary of Country_Codes to how long each customer takes.
+    :param workers: The number of workers.
+    :return: The time the last worker finishes, in the same units as durations.
+    """
+    finish_times = [0] * max(workers, 1)
+
+    for customer in order:
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + durations.get(customer, 0))
+
+    return max(finish_times)
+
+
+def in_order(results, customers):
+    """
+    Hands back the results of a run in the usual customer order, however they were handed out,
+    so the run logs stay in Country_Code order. Each result is held until every customer before
+    it has been handed back.
+    :param results: Iterable of result dictionaries, see invoice_creation.process_customer.
+    :param customers: Tuple of Country_Codes in their usual order.
+    :return: Generator of result dictionaries.
+    """
+    position = {customer: num for num, customer in enumerate(customers)}
+    waiting = {}
+    next_num = 0
+
+    for result in results:
+        waiting[position[result['customer']]] = result
+
+        while next_num in waiting:
+            yield waiting.pop(next_num)
+            next_num += 1
+
+
+def schedule_report(customers, order, costs, durations, workers):
+    """
+    Compares the makespan of the order the customers were handed out in against Country_Code
+    order, both from the estimated costs and from the time each customer actually took.
+    :param customers: Tuple of Country_Codes in their usual order.
+    :param order: Tuple of Country_Codes in the order they were handed out.
+    :param costs: Dictionary of Country_Codes to their estimated cost in milliseconds.
+    :param durations: Dictionary of Country_Codes to the seconds each customer took.
+    :param workers: The number of workers the customers were handed out to.
+    :return: List of strings
+    """
+    lines = []
+
+    for name, values, scale in (('Estimated', costs, 1000), ('Measured', durations, 1)):
+        used = makespan(order, values, workers) / scale
+        naive = makespan(customers, values, workers) / scale
+        # Adding 0.0 turns a rounded -0.0 into 0.0
+        gain = round((naive - used) / naive * 100, 1) + 0.0 if naive else 0.0
+
+        lines.append('{} makespan over {} worker(s): {:.2f}s as scheduled, {:.2f}s in '
+                     'Country_Code order ({:.1f}% shorter).'.format(name, workers, used, naive,
+                                                                   gain))
+
+    return lines
@@ -0,0 +1,188 @@
+"""
+Sharding - splits the invoice run for a quarter across several machines.
+Each machine is given a shard, such as 3/8 for the third of eight, and only invoices the
+customers in that shard. Customers are split either by a hash of their Country_Code, which puts
+a customer in the same shard every quarter, or by their number of sales rows, so that every
+shard has about the same amount of work. Every machine must read the same database for the
+shards to line up.
+Each shard writes its own logs, journal and a results JSON file. Once all the shards have
+finished, their results files are merged into one set of logs and a single email is sent to
+the process manager.
+
+Usage:
+    python invoice_creation.py --shard 3/8 --shard-by rows
+    python invoice_creation.py --merge-shards results/*Results.json
+"""
+
+import argparse
+import heapq
+import json
+import zlib
+
+from run_log import RunLog
+
+# The ways customers can be split between shards
+shard_methods = ('hash', 'rows')
+
+
+def parse_shard(spec):
+    """
+    Reads a shard from the command line, such as 3/8 for the third of eight shards.
+    :param spec: String in the form number/count.
+    :return: Tuple of the shard number, starting at 1, and the number of shards.
+    """
+    try:
+        shard, count = [int(x) for x in spec.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('{} is not a shard, expected something like 3/8'
+                                         .format(spec))
+
+    if not 1 <= shard <= count:
+        raise argparse.ArgumentTypeError('shard {} must be between 1 and {}'
+                                         .format(shard, count))
+
+    return shard, count
+
+
+def hash_shard(customer, count):
+    """
+    Picks the shard for a customer from a checksum of its Country_Code. The built in hash
+    function is not used as it changes between Python processes.
+    :param customer: The Country_Code of the customer.
+    :param count: The number of shards.
+    :return: The shard number, starting at 1.
+    """
+    return zlib.crc32(customer.encode()) % count + 1
+
+
+def balance_shards(row_counts, count):
+    """
+    Splits customers between shards so that each shard has about the same number of sales
+    rows. The largest customers are handed out first, each to the shard with the fewest rows so
+    far. Ties go to the customer code and then the shard number that comes first, so every
+    machine comes up with the same split.
+    :param row_counts: Dictionary of Country_Codes to their number of sales rows.
+    :param count: The number of shards.
+    :return: Dictionary of Country_Codes to shard numbers, starting at 1.
+    """
+    shards = [(0, shard) for shard in range(1, count + 1)]
+    assigned = {}
+
+    for customer in sorted(row_counts, key=lambda x: (-row_counts[x], x)):
+        rows, shard = heapq.heappop(shards)
+        assigned[customer] = shard
+        heapq.heappush(shards, (rows + row_counts[customer], shard))
+
+    return assigned
+
+
+def shard_customers(customers, shard, count, row_counts=None):
+    """
+    Picks out the customers belonging to one shard.
+    :param customers: Tuple of every customer's Country_Code.
+    :param shard: The shard number, starting at 1.
+    :param count: The number of shards.
+    :param row_counts: Dictionary of Country_Codes to their number of sales rows, to balance
+    the shards by. Will split by hash if none provided.
+    :return: Tuple of the Country_Codes in the shard, in the same order as customers.
+    """
+    if row_counts is None:
+        return tuple([x for x in customers if hash_shard(x, count) == shard])
+
+    assigned = balance_shards({x: row_counts.get(x, 0) for x in customers}, count)
+
+    return tuple([x for x in customers if assigned[x] == shard])
+
+
+def write_results(file_name, results):
+    """
+    Saves the outcome of one shard for merging later.
+    :param file_name: The JSON file to write to. Can include path.
+    :param results: Dictionary with the shard, count, quarter, run_id, customers, rows,
+    elapsed_seconds, validation and entries keys, see main in invoice_creation.py.
+    :return: None
+    """
+    with open(file_name, 'w') as results_file:
+        json.dump(results, results_file, indent=1)
+
+
+def load_results(file_names):
+    """
+    Reads the results of every shard in a run and makes sure they belong together.
+    :param file_names: List of JSON files written by write_results.
+    :return: List of results dictionaries, in shard order.
+    """
+    shards = []
+
+    for file_name in file_names:
+        with open(file_name) as results_file:
+            shards.append(json.load(results_file))
+
+    shards.sort(key=lambda x: x['shard'])
+    count = shards[0]['count']
+
+    if len({(x['count'], x['quarter']) for x in shards}) > 1:
+        raise ValueError('The results files are from different quarters or shard counts.')
+
+    numbers = [x['shard'] for x in shards]
+    missing = sorted(set(range(1, count + 1)) - set(numbers))
+
+    if missing:
+        raise ValueError('Results are missing for shard(s) {} of {}.'
+                         .format(', '.join([str(x) for x in missing]), count))
+
+    if len(numbers) > count:
+        raise ValueError('More than one results file was given for the same shard.')
+
+    return shards
+
+
+def merge_logs(shards, full_log, err_log, valid_report):
+    """
+    Combines the results of every shard into one full log, error log and validation report,
+    with the customers back in Country_Code order as they would be in a run on one machine.
+    :param shards: List of results dictionaries, see load_results.
+    :param full_log: The full log txt file to write to.
+    :param err_log: The error log txt file to write to. Only written if there are errors.
+    :param valid_report: The validation report txt file to write to.
+    :return: The number of customers with errors.
+    """
+    entries = sorted([entry for shard in shards for entry in shard['entries']],
+                     key=lambda x: x['customer'])
+    run_log = RunLog(full_log, err_log, flush_seconds=None)
+
+    for entry in entries:
+        run_log.customer(entry)
+
+    with open(valid_report, 'w') as report:
+        for shard in shards:
+            print('SHARD {} OF {}'.format(shard['shard'], shard['count']), file=report)
+            print(shard['validation'], file=report)
+
+    # The run takes as long as its slowest shard
+    slowest = max([x['elapsed_seconds'] for x in shards])
+
+    run_log.write('=' * 100 + '\n')
+    run_log.write('ELAPSED TIME (Hours, Mins, Secs): {} (slowest shard).'
+                  .format(time_format(slowest)))
+    run_log.write('MERGED: {} shard(s) of {}, {} customer(s), {} error(s).'
+                  .format(len(shards), shards[0]['quarter'], run_log.count, run_log.err_num))
+    for shard in shards:
+        run_log.write('SHARD {} OF {}: {} customer(s), {:,} sales row(s), {} error(s), '
+                      'elapsed {}, run ID {}.'
+                      .format(shard['shard'], shard['count'], shard['customers'], shard['rows'],
+                              len([x for x in shard['entries'] if x['error']]),
+                              time_format(shard['elapsed_seconds']), shard['run_id']))
+    run_log.close()
+
+    return run_log.err_num
+
+
+def time_format(seconds):
+    """
+    Formats a number of seconds in the same way as the elapsed time in the logs.
+    :param seconds: Number of seconds.
+    :return: String in the form HH:MM:SS
+    """
+    return '{:02}:{:02}:{:02}'.format(int(seconds // 3600), int(seconds % 3600 // 60),
+                                      int(seconds % 60))
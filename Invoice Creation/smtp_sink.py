@@ -0,0 +1,112 @@
+"""
+SMTP Sink - a local stand-in for the email server, for benchmarking and testing.
+It speaks just enough SMTP for smtplib to hand it emails, counts them, and throws them away.
+It does not support TLS or logging in, so it should be used with the smtp_tls setting turned off.
+"""
+
+import socketserver
+import threading
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Handles one connection to the sink, replying OK to everything.
+    """
+
+    def _reply(self, text):
+        """
+        Sends a reply line to the client.
+        :param text: String reply, starting with the status code.
+        :return: None
+        """
+        self.wfile.write((text + '\r\n').encode())
+
+    def handle(self):
+        """
+        Reads commands until the client quits. The lines between DATA and the line with a
+        single full stop are the email itself.
+        :return: None
+        """
+        self._reply('220 localhost SMTP sink')
+        in_data = False
+        size = 0
+
+        for line in self.rfile:
+            if in_data:
+                if line.rstrip(b'\r\n') == b'.':
+                    in_data = False
+                    self.server.sink.received(size)
+                    self._reply('250 OK')
+                else:
+                    size += len(line)
+                continue
+
+            command = line[:4].upper()
+
+            if command == b'DATA':
+                in_data = True
+                size = 0
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+            elif command == b'QUIT':
+                self._reply('221 Bye')
+                break
+            else:
+                self._reply('250 OK')
+
+
+class SMTPSink:
+    """
+    Runs the sink on a background thread and keeps count of the emails it has received.
+    Can be used in a with block, which starts and stops it.
+    """
+
+    def __init__(self, host='localhost', port=0):
+        """
+        Initialise class
+        :param host: The host name to listen on.
+        :param port: The port to listen on. 0 picks any free port, see the port attribute.
+        """
+        self.messages = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+        self._server = socketserver.ThreadingTCPServer((host, port), _SMTPHandler)
+        self._server.daemon_threads = True
+        self._server.sink = self
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    def received(self, size):
+        """
+        Counts an email that has been received.
+        :param size: The size of the email in bytes.
+        :return: None
+        """
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+
+    def start(self):
+        """
+        Starts listening for emails on a background thread.
+        :return: None
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, name='SMTP SINK',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops listening and closes the socket.
+        :return: None
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
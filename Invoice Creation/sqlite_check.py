@@ -0,0 +1,179 @@
+"""
+SQLite Check - checks that the SQLite backend works out the amounts on the invoices the same as
+MySQL does.
+MySQL multiplies and adds up the DECIMAL columns exactly, and the invoices round the amounts to
+cents half away from zero (see round_decimal in invoice_creation.py), so an amount that lands
+exactly on a half cent is where any error in SQLite's arithmetic would show. A scratch SQLite
+database is filled with a grid of rates and weights whose amounts all land on half cents, each
+one for its own customer and split over two sales rows, and the summary totals are read back
+through the backend, from sales_data and from the rollup. Every amount has to be the same as
+the exact product of the rate and weight, which is what MySQL gives.
+
+Usage:
+    python sqlite_check.py --cases 500
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from datetime import date
+from decimal import Decimal
+
+import migrate
+import quarter_summary
+import synthetic_data
+from database import create_backend
+from invoice_creation import Customer, number_formatter
+
+script_folder = os.path.dirname(os.path.abspath(__file__))
+
+# The quarter the check data is made for
+param_dict = {'year': 2019, 'sub_account': synthetic_data.sub_accounts[0], 'qtr': 1}
+
+# The weights the rates are multiplied by, and the item rate, which lands on whole cents
+weights = ('0.5000', '1.5000', '2.5000', '7.5000', '12.5000', '0.2500', '0.7500', '33.3750',
+           '49.8750')
+item_rate = Decimal('0.0100')
+
+
+def half_cent_cases(count):
+    """
+    Picks rates and weights whose product is exactly a half cent, spread evenly over every one
+    of them with a rate of up to 20 dollars.
+    :param count: How many cases to pick.
+    :return: List of (rate, weight) tuples of Decimals.
+    """
+    cases = []
+
+    for weight in [Decimal(x) for x in weights]:
+        for rate in range(1, 200001):
+            rate = Decimal(rate).scaleb(-4)
+            amount = rate * weight
+
+            if amount == amount.quantize(Decimal('0.001')) and amount * 1000 % 10 == 5:
+                cases.append((rate, weight))
+
+    step = max(len(cases) // count, 1)
+
+    return cases[::step][:count]
+
+
+def seed(cnx, cases):
+    """
+    Fills the tables with a customer for each case, which has one rate and two sales rows.
+    :param cnx: Connection to the scratch database.
+    :param cases: List of (rate, weight) tuples, see half_cent_cases.
+    :return: Dictionary of Country_Codes to their (rate, weight) tuples.
+    """
+    migrate.run_script(cnx, os.path.join(script_folder, 'db_setup.sql'))
+
+    customers = synthetic_data.customer_codes(len(cases))
+    rates = []
+    sales = []
+
+    for num, (code, (rate, weight)) in enumerate(zip(customers, cases)):
+        operator = synthetic_data.operator(code)
+        rates.append(('{}{}UAUA'.format(param_dict['year'], operator), operator,
+                      param_dict['year'], param_dict['sub_account'], 'U', code, 'A', 'UA',
+                      rate, item_rate, Decimal(0), Decimal(0)))
+
+        # Split over two rows, so that adding up is checked as well as multiplying
+        first = (weight / 3).quantize(Decimal('0.0001'))
+        for part, part_weight in enumerate((first, weight - first)):
+            sales.append((param_dict['sub_account'], param_dict['year'], 1,
+                          date(param_dict['year'], 1, 1), param_dict['qtr'],
+                          'DSP{:010d}'.format(2 * num + part), 2 * num + part, 'AUSYDA',
+                          code + 'SYDA', 'A', 'L', 'UA', 'U', operator, code, part + 1,
+                          part_weight))
+
+    cursor = cnx.cursor()
+    cursor.executemany(synthetic_data.address_sql, synthetic_data.address_rows(customers))
+    cursor.executemany(synthetic_data.rates_sql, rates)
+    cursor.close()
+    cnx.commit()
+    synthetic_data.insert_sales(cnx, sales)
+
+    migrate.apply_migrations(cnx)
+    quarter_summary.rebuild_quarter(cnx, param_dict)
+
+    return dict(zip(customers, cases))
+
+
+def differences(cnx, sql, expected):
+    """
+    Reads the summary totals for every customer and compares them with the exact amounts.
+    :param cnx: Connection to the scratch database.
+    :param sql: Customer.summary_totals_sql or summary_totals_rollup_sql.
+    :param expected: Dictionary from seed.
+    :return: List of strings describing each amount that is not the same.
+    """
+    cursor = cnx.cursor()
+    cursor.execute(sql.format(customer_filter=''), param_dict)
+    rows = cursor.fetchall()
+    cursor.close()
+
+    formatter = number_formatter(2)
+    found = []
+
+    for code, items, weight, item_amount, kg_amount, total in rows:
+        rate, exact_weight = expected[code]
+        exact = (item_rate * 3, rate * exact_weight, item_rate * 3 + rate * exact_weight)
+
+        for name, amount, exact_amount in zip(('item amount', 'kg amount', 'total'),
+                                              (item_amount, kg_amount, total), exact):
+            if amount != exact_amount or formatter(amount) != formatter(exact_amount):
+                found.append('{} rate {} weight {}: {} {} ({}), MySQL {} ({})'.format(
+                    code, rate, exact_weight, name, amount, formatter(amount), exact_amount,
+                    formatter(exact_amount)))
+
+        if weight != exact_weight:
+            found.append('{}: weight {}, MySQL {}'.format(code, weight, exact_weight))
+
+    if len(rows) != len(expected):
+        found.append('{} customer(s) read back, expected {}'.format(len(rows), len(expected)))
+
+    return found
+
+
+def main(argv=None):
+    """
+    Runs the check and prints the results.
+    :param argv: List of command line arguments. Defaults to sys.argv.
+    :return: List of strings describing each amount that is not the same as MySQL's.
+    """
+    parser = argparse.ArgumentParser(description='Checks the amounts worked out by the SQLite '
+                                                 'backend against MySQL\'s exact arithmetic.')
+    parser.add_argument('--cases', type=int, default=500,
+                        help='Number of half cent cases, up to {}.'
+                        .format(len(synthetic_data.customer_codes(26 ** 2))))
+    args = parser.parse_args(argv)
+
+    folder = tempfile.mkdtemp(prefix='sqlite_check_')
+
+    try:
+        cnx = create_backend('sqlite', os.path.join(folder, 'check.db')).connect()
+        expected = seed(cnx, half_cent_cases(args.cases))
+
+        found = []
+        for name, sql in (('sales_data', Customer.summary_totals_sql),
+                          ('rollup', Customer.summary_totals_rollup_sql)):
+            found_here = differences(cnx, sql, expected)
+            print('{} half cent case(s) read from {}: {}.'.format(
+                len(expected), name, 'all the same as MySQL' if not found_here else
+                '{} amount(s) differ'.format(len(found_here))))
+            found += found_here
+
+        cnx.close()
+    finally:
+        shutil.rmtree(folder)
+
+    for line in found[:20]:
+        print('\t' + line)
+
+    return found
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main() else 0)
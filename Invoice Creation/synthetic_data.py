@@ -0,0 +1,241 @@
+"""
+Synthetic Data - fills the database with made up but consistent sales, rates and address data,
+so that the process can be benchmarked at sizes well beyond a real quarter.
+Every customer gets its own operator with a rate for every combination of year, PL, mail
+category and subclass that its sales rows use, so every customer passes validation.
+Sales rows can be made in two ways. The random rows are spread across two sub accounts, two
+years and all four quarters, so only an eighth of the table belongs to any one quarter, the same
+as a real database that has built up history. The lane rows all belong to one quarter, with a set
+number of lanes per customer and rows per lane, so the size of each invoice can be controlled.
+"""
+
+import random
+import string
+from datetime import date
+from itertools import product
+
+# The values the sales rows are made up from
+sub_accounts = ('Standard', 'Express')
+pls = ('U', 'P')
+mail_categories = ('A', 'B', 'C')
+subclasses = ('UA', 'UB', 'UN')
+origins = ('AUSYDA', 'AUMELA', 'AUBNEA', 'AUPERA')
+cities = ('SYD', 'MEL', 'BNE')
+
+sales_sql = 'INSERT INTO sales_data (Sub_Account_Type, Despatch_Year, Despatch_Month, ' \
+            'Despatch_Date, Qtr, Despatch_ID, Serial_Number, Origin, Destination, ' \
+            'Mail_Category, Class, Subclass, PL, Operator, Country_Code, No_of_ItRates, ' \
+            'Weight_Kgs) ' \
+            'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);'
+
+rates_sql = 'INSERT INTO rates_data (Rate_Reference, Operator, Despatch_Year, Sub_Account_Type, ' \
+            'PL, Country_Code, Mail_Category, Subclass, Rate_Ltr_Kg, Rate_Ltr_Itm, ' \
+            'Rate_Bulk_Kg, Rate_Bulk_Itm) ' \
+            'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);'
+
+address_sql = 'INSERT INTO address_data (Country_Code, Physical_Address, Country_Name, ' \
+              'Email_Address) ' \
+              'VALUES (%s, %s, %s, %s);'
+
+
+def customer_codes(count):
+    """
+    Makes up two letter Country_Codes.
+    :param count: How many codes are needed. No more than 676.
+    :return: Tuple of codes in alphabetical order, starting from AA.
+    """
+    return tuple([a + b for a, b in product(string.ascii_uppercase, repeat=2)][:count])
+
+
+def operator(customer):
+    """
+    The operator code used for a customer's sales and rates.
+    :param customer: Country_Code
+    :return: String
+    """
+    return customer + 'X'
+
+
+def address_rows(customers, email_domain='example.com'):
+    """
+    Makes up an address_data row for each customer.
+    :param customers: Tuple of Country_Codes.
+    :param email_domain: The domain the customers' email addresses are at.
+    :return: List of row tuples.
+    """
+    return [(code,
+             '{} Example Street\nExample City\n{}'.format(num + 1, code),
+             'Customer {}'.format(code),
+             '{}@{}'.format(code.lower(), email_domain))
+            for num, code in enumerate(customers)]
+
+
+def rate_rows(customers, year, seed=0):
+    """
+    Makes up a rates_data row for every combination of customer, year, PL, mail category and
+    subclass that the sales rows can use.
+    :param customers: Tuple of Country_Codes.
+    :param year: The latest year of the sales rows. Rates are made for this year and the one
+    before.
+    :param seed: Seed for the random rates, so the same data can be made again.
+    :return: List of row tuples.
+    """
+    rng = random.Random(seed)
+    rows = []
+
+    for code, despatch_year, pl, category, subclass in product(customers, (year - 1, year), pls,
+                                                                 mail_categories, subclasses):
+        rows.append(('{}{}{}{}{}'.format(despatch_year, operator(code), pl, category, subclass),
+                     operator(code), despatch_year, sub_accounts[0], pl, code, category,
+                     subclass, round(rng.uniform(1, 20), 4), round(rng.uniform(0, 1), 4),
+                     round(rng.uniform(1, 20), 4), round(rng.uniform(0, 1), 4)))
+
+    return rows
+
+
+def sales_rows(count, customers, year, seed=0):
+    """
+    Makes up sales_data rows, one at a time so that millions of them never have to be held in
+    memory at once.
+    :param count: How many rows to make.
+    :param customers: Tuple of Country_Codes. Each row belongs to one picked at random.
+    :param year: The latest year of the sales rows.
+    :param seed: Seed for the random data, so the same data can be made again.
+    :return: Generator of row tuples.
+    """
+    rng = random.Random(seed)
+
+    for num in range(count):
+        code = rng.choice(customers)
+        despatch_year = year - rng.randint(0, 1)
+        qtr = rng.randint(1, 4)
+        month = (qtr - 1) * 3 + rng.randint(1, 3)
+
+        yield (rng.choice(sub_accounts), despatch_year, month,
+               date(despatch_year, month, rng.randint(1, 28)), qtr,
+               'DSP{:010d}'.format(num), num + 1, rng.choice(origins),
+               code + rng.choice(cities) + 'A', rng.choice(mail_categories),
+               'L', rng.choice(subclasses), rng.choice(pls), operator(code), code,
+               rng.randint(1, 200), round(rng.uniform(0.1, 50), 4))
+
+
+def customer_lanes(customer, count):
+    """
+    The lanes a customer's sales go along. A lane is a combination of origin, destination,
+    mail category, subclass and PL, which is one line of the summary invoice.
+    :param customer: Country_Code
+    :param count: How many lanes. No more than the max_lanes function allows.
+    :return: List of (origin, destination, mail category, subclass, PL) tuples.
+    """
+    lanes = list(product(origins, [customer + city + 'A' for city in cities], mail_categories,
+                         subclasses, pls))
+
+    assert count <= len(lanes)
+    return lanes[:count]
+
+
+def max_lanes():
+    """
+    The most lanes a customer can have.
+    :return: Integer
+    """
+    return len(origins) * len(cities) * len(mail_categories) * len(subclasses) * len(pls)
+
+
+def lane_sales_rows(customers, lanes, rows_per_lane, year, qtr, sub_account=sub_accounts[0],
+                    seed=0):
+    """
+    Makes up sales_data rows for a single quarter, with the same number of lanes for every
+    customer and the same number of rows on every lane.
+    :param customers: Tuple of Country_Codes.
+    :param lanes: How many lanes each customer has.
+    :param rows_per_lane: How many sales rows each lane has.
+    :param year: The year of the sales rows.
+    :param qtr: The quarter of the sales rows.
+    :param sub_account: The sub account of the sales rows.
+    :param seed: Seed for the random data, so the same data can be made again.
+    :return: Generator of row tuples.
+    """
+    rng = random.Random(seed)
+    num = 0
+
+    for code in customers:
+        for origin, destination, category, subclass, pl in customer_lanes(code, lanes):
+            for _ in range(rows_per_lane):
+                month = (qtr - 1) * 3 + rng.randint(1, 3)
+                num += 1
+
+                yield (sub_account, year, month, date(year, month, rng.randint(1, 28)), qtr,
+                       'DSP{:010d}'.format(num), num, origin, destination, category, 'L',
+                       subclass, pl, operator(code), code, rng.randint(1, 200),
+                       round(rng.uniform(0.1, 50), 4))
+
+
+def seed_reference_data(cnx, customers, year, seed=0, email_domain='example.com'):
+    """
+    Fills empty address_data and rates_data tables with synthetic data for some customers.
+    :param cnx: MySQL connection.
+    :param customers: Tuple of Country_Codes.
+    :param year: The latest year of the sales rows.
+    :param seed: Seed for the random rates, so the same data can be made again.
+    :param email_domain: The domain the customers' email addresses are at.
+    :return: None
+    """
+    cursor = cnx.cursor()
+    cursor.executemany(address_sql, address_rows(customers, email_domain))
+    cursor.executemany(rates_sql, rate_rows(customers, year, seed))
+    cursor.close()
+    cnx.commit()
+
+
+def insert_sales(cnx, rows, batch_size=10000):
+    """
+    Inserts sales rows, committing them in batches.
+    :param cnx: MySQL connection.
+    :param rows: Iterable of row tuples, such as from sales_rows or lane_sales_rows.
+    :param batch_size: How many sales rows to insert at a time.
+    :return: The number of rows inserted.
+    """
+    cursor = cnx.cursor()
+    batch = []
+    count = 0
+
+    for row in rows:
+        batch.append(row)
+
+        if len(batch) == batch_size:
+            cursor.executemany(sales_sql, batch)
+            cnx.commit()
+            count += len(batch)
+            batch = []
+
+    if batch:
+        cursor.executemany(sales_sql, batch)
+        cnx.commit()
+        count += len(batch)
+
+    cursor.close()
+
+    return count
+
+
+def seed_database(cnx, rows, customers=50, year=2019, batch_size=10000, seed=0,
+                  email_domain='example.com'):
+    """
+    Fills empty address_data, rates_data and sales_data tables with synthetic data.
+    The sales rows are inserted and committed in batches.
+    :param cnx: MySQL connection.
+    :param rows: The number of sales rows to insert.
+    :param customers: The number of customers to spread the sales rows across.
+    :param year: The latest year of the sales rows.
+    :param batch_size: How many sales rows to insert at a time.
+    :param seed: Seed for the random data, so the same data can be made again.
+    :param email_domain: The domain the customers' email addresses are at.
+    :return: Tuple of the Country_Codes that were used.
+    """
+    codes = customer_codes(customers)
+
+    seed_reference_data(cnx, codes, year, seed, email_domain)
+    insert_sales(cnx, sales_rows(rows, codes, year, seed), batch_size)
+
+    return codes